@@ -0,0 +1,197 @@
+"""
+Index of accounts with their creation and last login day
+in a sqlite database, kept up to date by doveauth, lastlogin
+and delete_inactive_users when `account_index_path` is set,
+so that listing, counting and expiring accounts
+does not need to walk `mailboxes_dir`.
+
+The password files stay authoritative.
+doveauth and delete_inactive_users build the index from them
+if it was never built, and it is rebuilt from them with
+
+    python -m chatmaild.accountindex /usr/local/lib/chatmaild/chatmail.ini rebuild
+
+and compared with them with the `check` command.
+"""
+
+import argparse
+import logging
+import sqlite3
+import sys
+import threading
+import time
+
+from .config import read_config
+from .user import get_daytimestamp
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    addr TEXT PRIMARY KEY,
+    created INTEGER,
+    last_login INTEGER
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS accounts_last_login ON accounts (last_login);
+"""
+
+
+class AccountIndex:
+    def __init__(self, path):
+        self.path = path
+        # sqlite connections can not be shared between threads
+        self.local = threading.local()
+
+    @property
+    def conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    @property
+    def built(self):
+        """True if the index was built from `mailboxes_dir` with `rebuild`."""
+        return self.conn.execute("PRAGMA user_version").fetchone()[0] > 0
+
+    def ensure_built(self, config):
+        """Rebuild the index if it was never built, e.g. because it is new."""
+        if not self.built:
+            count = self.rebuild(config)
+            logging.info(f"built account index with {count} accounts")
+
+    def add(self, addr, created, last_login=None):
+        """Add an account, or update its days if it is already indexed."""
+        self.conn.execute(
+            "INSERT INTO accounts (addr, created, last_login) VALUES (?, ?, ?) "
+            "ON CONFLICT (addr) DO UPDATE SET created = excluded.created, "
+            "last_login = excluded.last_login",
+            (addr, created, last_login),
+        )
+
+    def set_last_login(self, addr, last_login):
+        self.conn.execute(
+            "INSERT INTO accounts (addr, last_login) VALUES (?, ?) "
+            "ON CONFLICT (addr) DO UPDATE SET last_login = excluded.last_login",
+            (addr, last_login),
+        )
+
+    def remove(self, addr):
+        self.conn.execute("DELETE FROM accounts WHERE addr = ?", (addr,))
+
+    def get(self, addr):
+        """Return the creation and last login day of an account or `None`."""
+        return self.conn.execute(
+            "SELECT created, last_login FROM accounts WHERE addr = ?", (addr,)
+        ).fetchone()
+
+    def iter_addrs(self):
+        for (addr,) in self.conn.execute("SELECT addr FROM accounts ORDER BY addr"):
+            yield addr
+
+    def iter_inactive(self, cutoff):
+        """Iterate over accounts whose last login is before `cutoff`."""
+        query = "SELECT addr FROM accounts WHERE last_login < ? ORDER BY addr"
+        for (addr,) in self.conn.execute(query, (cutoff,)):
+            yield addr
+
+    def count(self):
+        return self.conn.execute("SELECT count(*) FROM accounts").fetchone()[0]
+
+    def read_disk(self, config):
+        """Return the last login day of each account in `mailboxes_dir`."""
+        accounts = {}
+        for addr in config.iter_addrs():
+            user = config.get_user(addr)
+            last_login = user.get_last_login_timestamp()
+            if last_login is not None:
+                accounts[addr] = get_daytimestamp(last_login)
+        return accounts
+
+    def rebuild(self, config):
+        """Replace the index with the accounts in `mailboxes_dir`.
+
+        Creation days are not stored on disk,
+        they are kept for indexed accounts and unknown for others.
+        """
+        accounts = self.read_disk(config)
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            created = dict(conn.execute("SELECT addr, created FROM accounts"))
+            conn.execute("DELETE FROM accounts")
+            conn.executemany(
+                "INSERT INTO accounts (addr, created, last_login) VALUES (?, ?, ?)",
+                (
+                    (addr, created.get(addr), last_login)
+                    for addr, last_login in accounts.items()
+                ),
+            )
+            conn.execute("PRAGMA user_version = 1")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return len(accounts)
+
+    def check(self, config):
+        """Compare the index with `mailboxes_dir` and return a list of problems."""
+        accounts = self.read_disk(config)
+        indexed = dict(self.conn.execute("SELECT addr, last_login FROM accounts"))
+        problems = []
+        for addr in sorted(accounts.keys() - indexed.keys()):
+            problems.append(f"{addr}: not indexed")
+        for addr in sorted(indexed.keys() - accounts.keys()):
+            problems.append(f"{addr}: indexed but does not exist")
+        for addr in sorted(accounts.keys() & indexed.keys()):
+            if accounts[addr] != indexed[addr]:
+                problems.append(
+                    f"{addr}: indexed last login {indexed[addr]} "
+                    f"but {accounts[addr]} on disk"
+                )
+        return problems
+
+
+def get_account_index(config):
+    """Return the `AccountIndex` of `config` or `None` if it is not enabled."""
+    if config.account_index_path is None:
+        return None
+    return AccountIndex(config.account_index_path)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("config", help="path to chatmail.ini")
+    parser.add_argument(
+        "command",
+        choices=["rebuild", "check", "count", "inactive"],
+        help="rebuild the index from disk, compare it with disk, count accounts "
+        "or list accounts which would be deleted as inactive",
+    )
+    args = parser.parse_args(args)
+
+    config = read_config(args.config)
+    index = get_account_index(config)
+    if index is None:
+        print("account_index_path is not set", file=sys.stderr)
+        return 1
+
+    if args.command == "rebuild":
+        print(f"indexed {index.rebuild(config)} accounts")
+    elif args.command == "check":
+        problems = index.check(config)
+        for problem in problems:
+            print(problem)
+        return 1 if problems else 0
+    elif args.command == "count":
+        print(index.count())
+    elif args.command == "inactive":
+        cutoff = time.time() - config.delete_inactive_users_after * 86400
+        for addr in index.iter_inactive(cutoff):
+            print(addr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""
+Microbenchmarks for the dovecot dict protocol handling.
+
+Runs pipelined request sequences through `DictProxy.handle_requests`
+of doveauth and lastlogin dict proxies on a temporary mailboxes directory
+and prints operations/sec per scenario as JSON,
+so that results can be compared between versions:
+
+    python -m chatmaild.bench_dictproxy --number 20000
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from .config import read_config, write_initial_config
+from .doveauth import AuthDictProxy, split_and_unescape
+from .lastlogin import LastLoginDictProxy
+
+MAIL_DOMAIN = "bench.example.org"
+
+PASSWORD = 'pass\\"word\\\\with\\"escapes' * 4
+
+SCENARIOS = [
+    "unescape",
+    "lookup-passdb",
+    "lookup-userdb",
+    "iterate",
+    "transaction",
+]
+
+
+def make_requests(scenario, addr, number):
+    """Return the request lines of `number` operations of `scenario`."""
+    if scenario == "lookup-passdb":
+        line = f'Lshared/passdb/{PASSWORD}"{addr}\t{addr}'.encode()
+        return [line] * number
+    if scenario == "lookup-userdb":
+        return [f"Lshared/userdb/{addr}\t{addr}".encode()] * number
+    if scenario == "iterate":
+        return [b"I0\t0\tshared/userdb/"] * number
+    if scenario == "transaction":
+        lines = []
+        for i in range(number):
+            lines.append(f"B{i}\t{addr}".encode())
+            lines.append(f"S{i}\tshared/last-login/{addr}\t1700000000".encode())
+            lines.append(f"C{i}".encode())
+        return lines
+    raise ValueError(scenario)
+
+
+def measure(func, number):
+    start = time.perf_counter()
+    func()
+    duration = time.perf_counter() - start
+    return dict(
+        operations=number,
+        duration=duration,
+        operations_per_second=number / duration,
+        microseconds_per_operation=duration / number * 1e6,
+    )
+
+
+def run_benchmark(scenarios=None, number=10000, users=100, batch=100):
+    scenarios = scenarios or SCENARIOS
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inipath = Path(tmpdir).joinpath("chatmail.ini")
+        overrides = dict(mailboxes_dir=tmpdir)
+        write_initial_config(inipath, MAIL_DOMAIN, overrides=overrides)
+        config = read_config(inipath)
+
+        auth = AuthDictProxy(config=config)
+        lastlogin = LastLoginDictProxy(config=config)
+        # localparts have the default length of 9 characters
+        addrs = [f"user{i:05d}@{MAIL_DOMAIN}" for i in range(users)]
+        for addr in addrs:
+            if not auth.lookup_passdb(addr, PASSWORD):
+                raise RuntimeError(f"could not create {addr}")
+
+        for scenario in scenarios:
+            if scenario == "unescape":
+                key = f'{PASSWORD}"{addrs[0]}'
+
+                def func():
+                    for _ in range(number):
+                        list(split_and_unescape(key))
+
+                results[scenario] = measure(func, number)
+                continue
+
+            dictproxy = lastlogin if scenario == "transaction" else auth
+            lines = make_requests(scenario, addrs[0], number)
+            step = batch * len(lines) // number
+
+            def func():
+                transactions = {}
+                for i in range(0, len(lines), step):
+                    dictproxy.handle_requests(lines[i : i + step], transactions)
+
+            results[scenario] = measure(func, number)
+    return dict(number=number, users=users, batch=batch, scenarios=results)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--scenario",
+        dest="scenarios",
+        action="append",
+        choices=SCENARIOS,
+        help="scenario to run, can be given multiple times (default: all)",
+    )
+    parser.add_argument("--number", type=int, default=10000)
+    parser.add_argument(
+        "--users", type=int, default=100, help="number of accounts to iterate"
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=100,
+        help="operations handed to handle_requests at once, like pipelined requests",
+    )
+    parser.add_argument("--output", type=Path, help="write JSON to file")
+    args = parser.parse_args(args)
+
+    summary = run_benchmark(
+        scenarios=args.scenarios,
+        number=args.number,
+        users=args.users,
+        batch=args.batch,
+    )
+    out = json.dumps(summary, indent=2)
+    if args.output:
+        args.output.write_text(out + "\n")
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
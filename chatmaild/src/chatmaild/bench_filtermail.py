@@ -0,0 +1,353 @@
+"""
+Offline throughput benchmark for filtermail.
+
+Starts filtermail on loopback in a forked process,
+with a local aiosmtpd sink standing in for postfix's reinject port,
+replays a generated corpus of messages with configurable concurrency
+and prints messages/sec and latency percentiles as JSON,
+so that results can be compared between versions:
+
+    python -m chatmaild.bench_filtermail --concurrency 20 --repeat 50
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from aiosmtpd.controller import Controller
+
+from .config import read_config, write_initial_config
+from .filtermail import serve
+from .smtpclient import SMTPConnection, SMTPReplyError
+
+MAIL_DOMAIN = "bench.example.org"
+
+KINDS = [
+    "encrypted-small",
+    "encrypted-large",
+    "securejoin",
+    "cleartext-rejected",
+    "many-recipients",
+]
+
+ENCRYPTED_TEMPLATE = """\
+From: <{from_addr}>
+To: <{to_addr}>
+Subject: [...]
+Date: Sun, 15 Oct 2023 16:43:21 +0000
+Message-ID: <{message_id}@{domain}>
+Chat-Version: 1.0
+MIME-Version: 1.0
+Content-Type: multipart/encrypted; protocol="application/pgp-encrypted";
+\tboundary="YFrteb74qSXmggbOxZL9dRnhymywAi"
+
+
+--YFrteb74qSXmggbOxZL9dRnhymywAi
+Content-Description: PGP/MIME version identification
+Content-Type: application/pgp-encrypted
+
+Version: 1
+
+
+--YFrteb74qSXmggbOxZL9dRnhymywAi
+Content-Description: OpenPGP encrypted message
+Content-Disposition: inline; filename="encrypted.asc";
+Content-Type: application/octet-stream; name="encrypted.asc"
+
+{armored}
+
+
+--YFrteb74qSXmggbOxZL9dRnhymywAi--
+"""
+
+SECUREJOIN_TEMPLATE = """\
+From: <{from_addr}>
+To: <{to_addr}>
+Subject: [...]
+Date: Sun, 15 Oct 2023 16:43:25 +0000
+Message-ID: <{message_id}@{domain}>
+Chat-Version: 1.0
+Secure-Join: vc-request
+Secure-Join-Invitenumber: RANDOM-TOKEN
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="Gl92xgZjOShJ5PGHntqYkoo2OK2Dvi"
+
+
+--Gl92xgZjOShJ5PGHntqYkoo2OK2Dvi
+Content-Type: text/plain; charset=utf-8
+
+Secure-Join: vc-request
+
+
+--Gl92xgZjOShJ5PGHntqYkoo2OK2Dvi--
+"""
+
+PLAIN_TEMPLATE = """\
+From: <{from_addr}>
+To: <{to_addr}>
+Subject: Hello
+Date: Sun, 15 Oct 2023 16:41:44 +0000
+Message-ID: <{message_id}@{domain}>
+MIME-Version: 1.0
+Content-Type: text/plain; charset=utf-8
+
+Hi!
+"""
+
+
+def armored_payload(size):
+    """Return an ASCII-armored PKESK + SEIPD packet sequence
+    with `size` random ciphertext bytes."""
+    pkesk = bytes([0xC1, 94]) + os.urandom(94)
+    seipd = bytes([0xD2, 0xFF]) + size.to_bytes(4, "big") + os.urandom(size)
+    encoded = base64.b64encode(pkesk + seipd).decode()
+    lines = [encoded[i : i + 64] for i in range(0, len(encoded), 64)]
+    return "\n".join(
+        ["-----BEGIN PGP MESSAGE-----", ""]
+        + lines
+        + ["=AAAA", "-----END PGP MESSAGE-----"]
+    )
+
+
+def make_corpus(large_size=25_000_000, num_recipients=50):
+    """Return a dict mapping corpus kinds to `(mail_from, rcpt_tos, content)`.
+
+    `large_size` is the approximate size of the large encrypted message.
+    """
+    from_addr = f"sender@{MAIL_DOMAIN}"
+    to_addr = "recipient@other.example.org"
+
+    def render(template, to_addrs, **kw):
+        text = template.format(
+            from_addr=from_addr,
+            to_addr=">,\n\t<".join(to_addrs),
+            message_id=os.urandom(8).hex(),
+            domain=MAIL_DOMAIN,
+            **kw,
+        )
+        return (from_addr, to_addrs, text.replace("\n", "\r\n").encode())
+
+    many = [f"r{i}@other{i % 10}.example.org" for i in range(num_recipients)]
+    return {
+        "encrypted-small": render(
+            ENCRYPTED_TEMPLATE, [to_addr], armored=armored_payload(1000)
+        ),
+        "encrypted-large": render(
+            ENCRYPTED_TEMPLATE, [to_addr], armored=armored_payload(large_size * 3 // 4)
+        ),
+        "securejoin": render(SECUREJOIN_TEMPLATE, [to_addr]),
+        "cleartext-rejected": render(PLAIN_TEMPLATE, [to_addr]),
+        "many-recipients": render(
+            ENCRYPTED_TEMPLATE, many, armored=armored_payload(1000)
+        ),
+    }
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def serve_until_interrupted(config):
+    try:
+        serve(config)
+    except KeyboardInterrupt:
+        pass
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class SinkHandler:
+    """Stand-in for postfix's reinject port which accepts everything."""
+
+    def __init__(self):
+        self.received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return "250 OK"
+
+
+async def replay(port, jobs, concurrency):
+    """Send `jobs` over `concurrency` connections and return the results."""
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+    results = []
+
+    async def worker():
+        conn = await SMTPConnection.connect("127.0.0.1", port)
+        try:
+            while not queue.empty():
+                kind, (mail_from, rcpt_tos, content) = queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    await conn.sendmail(mail_from, rcpt_tos, content)
+                except SMTPReplyError:
+                    accepted = False
+                    await conn.rset()
+                else:
+                    accepted = True
+                results.append((kind, accepted, time.perf_counter() - start))
+        finally:
+            conn.close()
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return results
+
+
+def summarize(results, duration, concurrency):
+    def stats(items):
+        latencies = [latency for _, _, latency in items]
+        return dict(
+            messages=len(items),
+            rejected=sum(1 for _, accepted, _ in items if not accepted),
+            latency_p50=percentile(latencies, 0.50),
+            latency_p99=percentile(latencies, 0.99),
+        )
+
+    kinds = {}
+    for result in results:
+        kinds.setdefault(result[0], []).append(result)
+
+    summary = stats(results)
+    summary.update(
+        concurrency=concurrency,
+        duration=duration,
+        messages_per_second=len(results) / duration,
+        kinds={kind: stats(items) for kind, items in sorted(kinds.items())},
+    )
+    return summary
+
+
+def run_benchmark(
+    kinds=None, repeat=10, concurrency=10, large_size=25_000_000, settings=None
+):
+    corpus = make_corpus(large_size=large_size)
+    kinds = kinds or KINDS
+    jobs = [(kind, corpus[kind]) for _ in range(repeat) for kind in kinds]
+
+    sink = SinkHandler()
+    sink_port = get_free_port()
+    sink_controller = Controller(sink, hostname="127.0.0.1", port=sink_port)
+    sink_controller.start()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inipath = Path(tmpdir).joinpath("chatmail.ini")
+        overrides = dict(
+            filtermail_smtp_port=str(get_free_port()),
+            postfix_reinject_port=str(sink_port),
+            max_user_send_per_minute=str(len(jobs) + 1),
+            filtermail_metrics_port="0",
+            mailboxes_dir=tmpdir,
+        )
+        overrides.update(settings or {})
+        write_initial_config(inipath, MAIL_DOMAIN, overrides=overrides)
+        config = read_config(inipath)
+
+        ctx = multiprocessing.get_context("fork")
+        # not a daemon process, which could not start check workers
+        process = ctx.Process(target=serve_until_interrupted, args=(config,))
+        process.start()
+        try:
+            wait_for_port(config.filtermail_smtp_port)
+            start = time.perf_counter()
+            results = asyncio.run(
+                replay(config.filtermail_smtp_port, jobs, concurrency)
+            )
+            duration = time.perf_counter() - start
+        finally:
+            # stop like on Ctrl-C so that filtermail shuts down its workers
+            os.kill(process.pid, signal.SIGINT)
+            process.join(timeout=10)
+            if process.exitcode is None:
+                process.terminate()
+                process.join()
+            sink_controller.stop()
+
+    summary = summarize(results, duration, concurrency)
+    summary["reinjected"] = sink.received
+    summary["expected_reinjected"] = sum(
+        1 for kind, _ in jobs if kind != "cleartext-rejected"
+    )
+    return summary
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--kind",
+        dest="kinds",
+        action="append",
+        choices=KINDS,
+        help="corpus kind to send, can be given multiple times (default: all)",
+    )
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--large-size",
+        type=int,
+        default=25_000_000,
+        help="approximate size of the large encrypted message in bytes",
+    )
+    parser.add_argument(
+        "--set",
+        dest="settings",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="chatmail.ini setting for filtermail, e.g. filtermail_workers=4",
+    )
+    parser.add_argument("--output", type=Path, help="write JSON to file")
+    args = parser.parse_args(args)
+
+    summary = run_benchmark(
+        kinds=args.kinds,
+        repeat=args.repeat,
+        concurrency=args.concurrency,
+        large_size=args.large_size,
+        settings=dict(x.split("=", 1) for x in args.settings),
+    )
+    out = json.dumps(summary, indent=2)
+    if args.output:
+        args.output.write_text(out + "\n")
+    else:
+        print(out)
+    if summary["reinjected"] < summary["expected_reinjected"]:
+        print(
+            f"only {summary['reinjected']} of {summary['expected_reinjected']} "
+            "messages were re-injected",
+            file=sys.stderr,
+        )
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
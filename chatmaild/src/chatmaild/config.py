@@ -1,3 +1,6 @@
+import hashlib
+import os
+import re
 from pathlib import Path
 
 import iniconfig
@@ -6,6 +9,11 @@ from chatmaild.user import User
 
 echobot_password_path = Path("/run/echobot/password")
 
+MAILBOXES_LAYOUTS = ("flat", "hashed")
+
+# directories of the two levels of the hashed mailboxes layout
+SHARD_RE = re.compile("[0-9a-f]{2}")
+
 
 def read_config(inipath):
     assert Path(inipath).exists(), inipath
@@ -14,6 +22,64 @@ def read_config(inipath):
     return Config(inipath, params=params)
 
 
+def hashed_maildir(mailboxes_dir, addr):
+    """Return the maildir of `addr` in the hashed layout, `ab/cd/<addr>`
+    with the first hex digits of the MD5 of `addr` like dovecot's `%2Mu/%2.2Mu/%u`."""
+    digest = hashlib.md5(addr.encode()).hexdigest()
+    return mailboxes_dir.joinpath(digest[:2], digest[2:4], addr)
+
+
+def get_maildir(mailboxes_dir, addr, layout="flat"):
+    """Return the maildir of `addr` in `mailboxes_dir`.
+
+    With the hashed layout, accounts which are not moved yet
+    by `python -m chatmaild.migrate_layout` stay at their flat location.
+    """
+    flat = mailboxes_dir.joinpath(addr)
+    if layout == "flat":
+        return flat
+    hashed = hashed_maildir(mailboxes_dir, addr)
+    if not hashed.exists() and flat.exists():
+        return flat
+    return hashed
+
+
+def iter_mailbox_entries(mailboxes_dir):
+    """Iterate over the `os.DirEntry` of all entries in `mailboxes_dir`,
+    descending into the directories of the hashed layout."""
+    with os.scandir(mailboxes_dir) as entries:
+        for entry in entries:
+            if not (SHARD_RE.fullmatch(entry.name) and entry.is_dir()):
+                yield entry
+                continue
+            with os.scandir(entry.path) as shards:
+                for shard in shards:
+                    if SHARD_RE.fullmatch(shard.name) and shard.is_dir():
+                        with os.scandir(shard.path) as maildirs:
+                            yield from maildirs
+
+
+class PassthroughMatcher:
+    """Matches addresses against passthrough senders and recipients.
+
+    Recipients starting with "@" whitelist a whole recipient domain.
+    """
+
+    def __init__(self, senders, recipients):
+        self.senders = frozenset(senders)
+        self.recipients = frozenset(x for x in recipients if x[0] != "@")
+        self.recipient_domains = frozenset(x for x in recipients if x[0] == "@")
+
+    def is_passthrough_sender(self, addr):
+        return addr in self.senders
+
+    def is_passthrough_recipient(self, addr):
+        if addr in self.recipients:
+            return True
+        at = addr.rfind("@")
+        return at != -1 and addr[at:] in self.recipient_domains
+
+
 class Config:
     def __init__(self, inipath, params):
         self._inipath = inipath
@@ -26,13 +92,40 @@ class Config:
         self.username_min_length = int(params["username_min_length"])
         self.username_max_length = int(params["username_max_length"])
         self.password_min_length = int(params["password_min_length"])
+        self.password_hash_scheme = (
+            params.get("password_hash_scheme", "SHA512-CRYPT").strip().upper()
+        )
+        rounds = params.get("password_hash_rounds", "").strip()
+        self.password_hash_rounds = int(rounds) if rounds else None
         self.passthrough_senders = params["passthrough_senders"].split()
         self.passthrough_recipients = params["passthrough_recipients"].split()
         self.filtermail_smtp_port = int(params["filtermail_smtp_port"])
+        self.filtermail_processes = int(params.get("filtermail_processes", "1"))
+        self.filtermail_workers = int(params.get("filtermail_workers", "0"))
+        self.filtermail_spool_threshold = int(
+            params.get("filtermail_spool_threshold", "1048576")
+        )
+        self.filtermail_max_inflight_checks = int(
+            params.get("filtermail_max_inflight_checks", "100")
+        )
+        self.filtermail_max_buffered_bytes = int(
+            params.get("filtermail_max_buffered_bytes", "1073741824")
+        )
+        self.filtermail_lmtp_socket = params.get("filtermail_lmtp_socket")
+        self.filtermail_metrics_port = int(params.get("filtermail_metrics_port", "0"))
         self.postfix_reinject_port = int(params["postfix_reinject_port"])
+        self.postfix_reinject_maxproc = int(
+            params.get("postfix_reinject_maxproc", "10")
+        )
         self.mtail_address = params.get("mtail_address")
         self.disable_ipv6 = params.get("disable_ipv6", "false").lower() == "true"
         self.imap_rawlog = params.get("imap_rawlog", "false").lower() == "true"
+        dict_capture_dir = params.get("dict_capture_dir", "").strip()
+        self.dict_capture_dir = Path(dict_capture_dir) if dict_capture_dir else None
+        account_index_path = params.get("account_index_path", "").strip()
+        self.account_index_path = (
+            Path(account_index_path) if account_index_path else None
+        )
         if "iroh_relay" not in params:
             self.iroh_relay = "https://" + params["mail_domain"]
             self.enable_iroh_relay = True
@@ -47,10 +140,49 @@ class Config:
         # deprecated option
         mbdir = params.get("mailboxes_dir", f"/home/vmail/mail/{self.mail_domain}")
         self.mailboxes_dir = Path(mbdir.strip())
+        self.mailboxes_layout = params.get("mailboxes_layout", "flat").strip()
+        if self.mailboxes_layout not in MAILBOXES_LAYOUTS:
+            raise ValueError(f"invalid mailboxes_layout {self.mailboxes_layout!r}")
 
         # old unused option (except for first migration from sqlite to maildir store)
         self.passdb_path = Path(params.get("passdb_path", "/home/vmail/passdb.sqlite"))
 
+    @property
+    def passthrough_senders(self):
+        return self._passthrough_senders
+
+    @passthrough_senders.setter
+    def passthrough_senders(self, senders):
+        self._passthrough_senders = senders
+        self._passthrough_matcher = None
+
+    @property
+    def passthrough_recipients(self):
+        return self._passthrough_recipients
+
+    @passthrough_recipients.setter
+    def passthrough_recipients(self, recipients):
+        self._passthrough_recipients = recipients
+        self._passthrough_matcher = None
+
+    @property
+    def passthrough_matcher(self):
+        """Matcher compiled from the passthrough settings.
+
+        It is rebuilt when the settings are assigned new values.
+        """
+        if self._passthrough_matcher is None:
+            self._passthrough_matcher = PassthroughMatcher(
+                self.passthrough_senders, self.passthrough_recipients
+            )
+        return self._passthrough_matcher
+
+    def iter_addrs(self):
+        """Iterate over the addresses of all accounts in `mailboxes_dir`."""
+        for entry in iter_mailbox_entries(self.mailboxes_dir):
+            if "@" in entry.name:
+                yield entry.name
+
     def _getbytefile(self):
         return open(self._inipath, "rb")
 
@@ -58,7 +190,7 @@ class Config:
         if not addr or "@" not in addr or "/" in addr:
             raise ValueError(f"invalid address {addr!r}")
 
-        maildir = self.mailboxes_dir.joinpath(addr)
+        maildir = get_maildir(self.mailboxes_dir, addr, self.mailboxes_layout)
         if addr.startswith("echo@"):
             password_path = echobot_password_path
         else:
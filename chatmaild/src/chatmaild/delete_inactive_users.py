@@ -2,27 +2,40 @@
 Remove inactive users
 """
 
-import os
 import shutil
 import sys
 import time
 
+from .accountindex import get_account_index
 from .config import read_config
+from .user import get_daytimestamp
 
 
 def delete_inactive_users(config):
     cutoff_date = time.time() - config.delete_inactive_users_after * 86400
-    for addr in os.listdir(config.mailboxes_dir):
+    account_index = get_account_index(config)
+    if account_index:
+        account_index.ensure_built(config)
+        addrs = list(account_index.iter_inactive(cutoff_date))
+    else:
+        addrs = list(config.iter_addrs())
+    for addr in addrs:
         try:
             user = config.get_user(addr)
         except ValueError:
             continue
 
+        # the password file is authoritative, the index may be outdated
         read_timestamp = user.get_last_login_timestamp()
         if read_timestamp and read_timestamp < cutoff_date:
-            path = config.mailboxes_dir.joinpath(addr)
-            assert path == user.maildir
-            shutil.rmtree(path, ignore_errors=True)
+            assert user.maildir.name == addr
+            shutil.rmtree(user.maildir, ignore_errors=True)
+        elif read_timestamp:
+            if account_index:
+                account_index.set_last_login(addr, get_daytimestamp(read_timestamp))
+            continue
+        if account_index:
+            account_index.remove(addr)
 
 
 def main():
@@ -1,9 +1,64 @@
+import asyncio
+import itertools
+import json
 import logging
 import os
-from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# flags of iterate requests, see dovecot's `enum dict_iterate_flags`
+ITERATE_FLAG_RECURSE = 0x01
+ITERATE_FLAG_SORT_BY_KEY = 0x02
+ITERATE_FLAG_SORT_BY_VALUE = 0x04
+ITERATE_FLAG_NO_VALUE = 0x08
+ITERATE_FLAG_EXACT_KEY = 0x10
+ITERATE_FLAG_ASYNC = 0x20
+
+# the escaped cleartext password in passdb lookup keys
+PASSDB_PASSWORD_RE = re.compile(rb'^(Lshared/passdb/)(?:\\.|[^"\\])*')
+
+
+def parse_set(parts):
+    """Return the key of a set request split at slashes and the value."""
+    # For documentation on key structure see
+    # https://github.com/dovecot/core/blob/main/src/lib-storage/mailbox-attribute.h
+    return parts[1].split("/"), parts[2] if len(parts) > 2 else ""
+
+
+class DictCapture:
+    """Records the request lines of all connections to a JSON lines file
+    which can be replayed with `python -m chatmaild.dictreplay`."""
+
+    def __init__(self, path, redact):
+        self.file = open(path, "a")
+        self.redact = redact
+
+    def record(self, connection_id, lines):
+        now = time.time()
+        for line in lines:
+            request = self.redact(line).decode("utf-8", errors="replace")
+            record = dict(time=now, connection=connection_id, request=request)
+            self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
 
 
 class DictProxy:
+    # number of threads which run the blocking `handle_*` methods
+    executor_workers = 10
+
+    # maximum length of a request line
+    line_limit = 1024 * 1024
+
+    # bytes read from a connection at once
+    read_size = 65536
+
+    # seconds to wait for a client to read streamed replies
+    write_timeout = 60
+
+    # set by `start_capture`
+    capture = None
+
     def loop_forever(self, rfile, wfile):
         # Transaction storage is local to each handler loop.
         # Dovecot reuses transaction IDs across connections,
@@ -12,42 +67,66 @@ class DictProxy:
         transactions = {}
 
         while True:
-            msg = rfile.readline().strip().decode()
+            msg = rfile.readline().strip()
             if not msg:
                 break
 
             res = self.handle_dovecot_request(msg, transactions)
             if res:
-                wfile.write(res.encode("ascii"))
+                for chunk in [res] if isinstance(res, str) else res:
+                    wfile.write(chunk.encode("ascii"))
                 wfile.flush()
 
     def handle_dovecot_request(self, msg, transactions):
-        # see https://doc.dovecot.org/developer_manual/design/dict_protocol/#dovecot-dict-protocol
-        short_command = msg[0]
-        parts = msg[1:].split("\t")
-
-        if short_command == "L":
-            return self.handle_lookup(parts)
-        elif short_command == "I":
-            return self.handle_iterate(parts)
-        elif short_command == "H":
-            return  # no version checking
+        """Handle a stripped request line given as `bytes` or `str`.
 
-        if short_command not in ("BSC"):
+        The reply is a `str` or an iterator of `str` chunks
+        for replies which are sent while they are produced.
+        """
+        # see https://doc.dovecot.org/developer_manual/design/dict_protocol/#dovecot-dict-protocol
+        if isinstance(msg, str):
+            msg = msg.encode()
+        name = REQUESTS.get(msg[0])
+        if name is None:
             logging.warning(f"unknown dictproxy request: {msg!r}")
             return
+        return getattr(self, name)(msg[1:], transactions)
 
-        transaction_id = parts[0]
+    # The `request_*` methods get the arguments of a request line as `bytes`
+    # and only decode what the `handle_*` methods need.
 
-        if short_command == "B":
-            return self.handle_begin_transaction(transaction_id, parts, transactions)
-        elif short_command == "C":
-            return self.handle_commit_transaction(transaction_id, parts, transactions)
-        elif short_command == "S":
-            addr = transactions[transaction_id]["addr"]
-            if not self.handle_set(addr, parts):
-                transactions[transaction_id]["res"] = "F\n"
-                logging.error(f"dictproxy-set failed for {addr!r}: {msg!r}")
+    def request_lookup(self, args, transactions):
+        return self.handle_lookup(args.decode().split("\t"))
+
+    def request_iterate(self, args, transactions):
+        return self.handle_iterate(args.decode().split("\t"))
+
+    def request_hello(self, args, transactions):
+        pass  # no version checking
+
+    def request_begin(self, args, transactions):
+        parts = args.decode().split("\t")
+        return self.handle_begin_transaction(parts[0], parts, transactions)
+
+    def request_commit(self, args, transactions):
+        transaction_id = args.decode()
+        return self.handle_commit_transaction(
+            transaction_id, [transaction_id], transactions
+        )
+
+    def request_commit_async(self, args, transactions):
+        # dovecot does not wait for the reply but still expects it in order
+        transaction_id = args.decode()
+        res = self.commit_transaction(transactions.pop(transaction_id))
+        return f"A{res[0]}{transaction_id}\n"
+
+    def request_rollback(self, args, transactions):
+        transactions.pop(args.decode(), None)
+
+    def request_set(self, args, transactions):
+        transaction_id, _, _ = args.partition(b"\t")
+        # sets are decoded when the transaction is committed
+        transactions[transaction_id.decode()]["sets"].append(args)
 
     def handle_lookup(self, parts):
         logging.warning(f"lookup ignored: {parts!r}")
@@ -60,39 +139,163 @@ class DictProxy:
 
     def handle_begin_transaction(self, transaction_id, parts, transactions):
         addr = parts[1]
-        transactions[transaction_id] = dict(addr=addr, res="O\n")
+        transactions[transaction_id] = dict(addr=addr, sets=[])
 
     def handle_set(self, addr, parts):
-        # For documentation on key structure see
-        # https://github.com/dovecot/core/blob/main/src/lib-storage/mailbox-attribute.h
         return False
 
+    def handle_commit(self, addr, sets):
+        """Apply the set requests of a transaction and return whether all succeeded.
+
+        Subclasses can override this to write all sets with one backend write.
+        """
+        ok = True
+        for parts in sets:
+            if not self.handle_set(addr, parts):
+                ok = False
+                logging.error(f"dictproxy-set failed for {addr!r}: {parts!r}")
+        return ok
+
     def handle_commit_transaction(self, transaction_id, parts, transactions):
-        # return whatever "set" command(s) set as result.
-        return transactions.pop(transaction_id)["res"]
+        return self.commit_transaction(transactions.pop(transaction_id))
 
-    def serve_forever_from_socket(self, socket):
-        dictproxy = self
+    def commit_transaction(self, transaction):
+        sets = [args.decode().split("\t") for args in transaction["sets"]]
+        if self.handle_commit(transaction["addr"], sets):
+            return "O\n"
+        return "F\n"
+
+    def start_capture(self, path):
+        """Record all requests to `path` with `redact_request` applied."""
+        self.capture = DictCapture(path, self.redact_request)
+
+    def redact_request(self, line):
+        """Return a request line with secrets replaced for capturing."""
+        return PASSDB_PASSWORD_RE.sub(rb"\1redacted-password", line)
+
+    def handle_requests(self, msgs, transactions, write=None):
+        """Handle pipelined requests and return their replies in order.
+
+        If a `write` function is given, replies which are iterators
+        are passed to it chunk by chunk after all preceding replies,
+        and preceding replies are written before an asynchronous commit
+        so that they are not delayed by writing the transaction.
+        If a request fails, the replies of the preceding requests
+        are written before the exception is raised.
+        """
+        replies = []
+        for msg in msgs:
+            if write is not None and replies and msg[:1] in (b"D", "D"):
+                write("".join(replies))
+                replies = []
+            try:
+                res = self.handle_dovecot_request(msg, transactions)
+            except Exception:
+                if write is not None and replies:
+                    write("".join(replies))
+                raise
+            if not res:
+                continue
+            if isinstance(res, str):
+                replies.append(res)
+            elif write is None:
+                replies.extend(res)
+            else:
+                if replies:
+                    write("".join(replies))
+                    replies = []
+                for chunk in res:
+                    write(chunk)
+        return "".join(replies)
+
+    async def handle_connection(self, reader, writer):
+        """Serve requests of one dovecot connection.
 
-        class Handler(StreamRequestHandler):
-            def handle(self):
-                try:
-                    dictproxy.loop_forever(self.rfile, self.wfile)
-                except Exception:
-                    logging.exception("Exception in the handler")
-                    raise
+        All requests which are already received are handled together
+        and their replies are sent with a single write,
+        except for iteration results which are streamed as they are produced
+        and replies which precede an asynchronous commit.
+        Requests of a connection are handled and answered in order,
+        requests of different connections concurrently in the executor.
+        """
+        transactions = {}
+        loop = asyncio.get_running_loop()
+        connection_id = next(self.connection_ids)
+
+        async def send(data):
+            writer.write(data.encode("ascii"))
+            await writer.drain()
+
+        def write(data):
+            # called from the executor, waits until the client reads the data
+            future = asyncio.run_coroutine_threadsafe(send(data), loop)
+            future.result(timeout=self.write_timeout)
+
+        buffer = b""
+        try:
+            while True:
+                data = await reader.read(self.read_size)
+                buffer += data
+                if data:
+                    *lines, buffer = buffer.split(b"\n")
+                    if len(buffer) > self.line_limit:
+                        logging.error("dictproxy request line too long, disconnecting")
+                        break
+                else:
+                    lines, buffer = [buffer], b""
+
+                # An empty line or the end of the connection stops serving.
+                msgs = []
+                for line in lines:
+                    msg = line.strip()
+                    if not msg:
+                        break
+                    msgs.append(msg)
+                if msgs and self.capture is not None:
+                    self.capture.record(connection_id, msgs)
+                if msgs:
+                    res = await loop.run_in_executor(
+                        self.executor, self.handle_requests, msgs, transactions, write
+                    )
+                    if res:
+                        await send(res)
+                if len(msgs) < len(lines):
+                    break
+        except Exception:
+            logging.exception("Exception in the handler")
+        finally:
+            writer.close()
 
+    async def serve_from_socket(self, socket):
+        self.executor = ThreadPoolExecutor(max_workers=self.executor_workers)
+        self.connection_ids = itertools.count()
         try:
             os.unlink(socket)
         except FileNotFoundError:
             pass
 
-        with CustomThreadingUnixStreamServer(socket, Handler) as server:
-            try:
-                server.serve_forever()
-            except KeyboardInterrupt:
-                pass
+        server = await asyncio.start_unix_server(
+            self.handle_connection, socket, backlog=1000
+        )
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever_from_socket(self, socket):
+        try:
+            asyncio.run(self.serve_from_socket(socket))
+        except KeyboardInterrupt:
+            pass
 
 
-class CustomThreadingUnixStreamServer(ThreadingUnixStreamServer):
-    request_queue_size = 1000
+# Dispatch table of the first byte of request lines to `DictProxy` methods,
+# looked up by name so that subclasses can override them.
+REQUESTS = {
+    ord("L"): "request_lookup",
+    ord("I"): "request_iterate",
+    ord("H"): "request_hello",
+    ord("B"): "request_begin",
+    ord("C"): "request_commit",
+    ord("D"): "request_commit_async",
+    ord("R"): "request_rollback",
+    ord("S"): "request_set",
+}
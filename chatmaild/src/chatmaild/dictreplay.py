@@ -0,0 +1,244 @@
+"""
+Replay load generator for dovecot dict proxies.
+
+Replays requests recorded with the `dict_capture_dir` setting
+over the unix socket of a dict proxy with parallel connections
+at a multiple of the recorded rate
+and prints throughput and latency percentiles as JSON:
+
+    python -m chatmaild.dictreplay doveauth.jsonl --proxy doveauth --speed 10
+
+Unless `--socket` is given, the proxy is started locally
+with a temporary mailboxes directory.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import signal
+import sys
+import tempfile
+import time
+from collections import deque
+from pathlib import Path
+
+from .bench_filtermail import percentile
+from .config import read_config, write_initial_config
+from .doveauth import AuthDictProxy
+from .lastlogin import LastLoginDictProxy
+from .metadata import Metadata, MetadataDictProxy
+from .notifier import Notifier
+
+PROXIES = ["doveauth", "lastlogin", "metadata"]
+
+# commands which dovecot waits for a reply to
+REPLY_COMMANDS = "LICD"
+
+
+def load_capture(path):
+    """Return the recorded requests of a capture file ordered by time."""
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda record: record["time"])
+    return records
+
+
+def guess_mail_domain(records):
+    for record in records:
+        match = re.search(r"@([\w.-]+)", record["request"])
+        if match:
+            return match.group(1)
+    return "replay.example.org"
+
+
+def make_dictproxy(name, config):
+    if name == "doveauth":
+        return AuthDictProxy(config=config)
+    if name == "lastlogin":
+        return LastLoginDictProxy(config=config)
+    queue_dir = config.mailboxes_dir / "pending_notifications"
+    queue_dir.mkdir(exist_ok=True)
+    # Notification threads are not started, so no notifications are sent.
+    return MetadataDictProxy(
+        notifier=Notifier(queue_dir),
+        metadata=Metadata(config.mailboxes_dir, config.mailboxes_layout),
+        iroh_relay=config.iroh_relay,
+    )
+
+
+def rename_transaction(request, connection):
+    """Make transaction IDs unique when connections are merged."""
+    if request[:1] not in ("B", "S", "C", "D", "R"):
+        return request
+    return f"{request[0]}{connection}.{request[1:]}"
+
+
+async def replay_connection(socket, records, t0, start, speed, latencies):
+    """Send `records` over one connection and record reply latencies."""
+    reader, writer = await asyncio.open_unix_connection(socket)
+    pending = deque()
+
+    async def read_replies():
+        while line := await reader.readline():
+            command, sent = pending[0]
+            if command == "I" and line != b"\n":
+                continue  # iteration results end with an empty line
+            pending.popleft()
+            latencies.append((command, time.perf_counter() - sent))
+
+    reader_task = asyncio.create_task(read_replies())
+    for record in records:
+        if speed:
+            delay = start + (record["time"] - t0) / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        request = rename_transaction(record["request"], record["connection"])
+        if request[:1] in REPLY_COMMANDS:
+            pending.append((request[0], time.perf_counter()))
+        writer.write(request.encode() + b"\n")
+        await writer.drain()
+    # the proxy answers all requests and closes the connection
+    writer.write_eof()
+    await reader_task
+    writer.close()
+
+
+async def replay(socket, records, connections, speed):
+    """Replay `records` over `connections` connections,
+    keeping requests of a recorded connection on the same connection."""
+    slots = {}
+    per_connection = [[] for _ in range(connections)]
+    for record in records:
+        slot = slots.setdefault(record["connection"], len(slots) % connections)
+        per_connection[slot].append(record)
+
+    latencies = []
+    t0 = records[0]["time"] if records else 0
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[
+            replay_connection(socket, items, t0, start, speed, latencies)
+            for items in per_connection
+            if items
+        ]
+    )
+    return latencies, time.perf_counter() - start
+
+
+def summarize(records, latencies, duration, connections, speed):
+    def stats(items):
+        values = [latency for _, latency in items]
+        return dict(
+            replies=len(items),
+            latency_p50=percentile(values, 0.50),
+            latency_p99=percentile(values, 0.99),
+        )
+
+    commands = {}
+    for item in latencies:
+        commands.setdefault(item[0], []).append(item)
+
+    summary = stats(latencies)
+    summary.update(
+        requests=len(records),
+        connections=connections,
+        speed=speed,
+        duration=duration,
+        requests_per_second=len(records) / duration if duration else None,
+        commands={command: stats(items) for command, items in sorted(commands.items())},
+    )
+    return summary
+
+
+def wait_for_socket(path, timeout=10):
+    deadline = time.time() + timeout
+    while not Path(path).exists():
+        if time.time() > deadline:
+            raise TimeoutError(f"{path} did not appear")
+        time.sleep(0.05)
+
+
+def run_replay(
+    records, proxy="doveauth", socket=None, connections=10, speed=1.0, settings=None
+):
+    if socket is not None:
+        latencies, duration = asyncio.run(replay(socket, records, connections, speed))
+        return summarize(records, latencies, duration, connections, speed)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inipath = Path(tmpdir).joinpath("chatmail.ini")
+        mailboxes_dir = Path(tmpdir).joinpath("mailboxes")
+        mailboxes_dir.mkdir()
+        overrides = dict(mailboxes_dir=str(mailboxes_dir))
+        overrides.update(settings or {})
+        write_initial_config(inipath, guess_mail_domain(records), overrides=overrides)
+        config = read_config(inipath)
+
+        socket = str(Path(tmpdir).joinpath(f"{proxy}.socket"))
+        dictproxy = make_dictproxy(proxy, config)
+        ctx = multiprocessing.get_context("fork")
+        # not a daemon process, which could not start password hashing workers
+        process = ctx.Process(
+            target=dictproxy.serve_forever_from_socket, args=(socket,)
+        )
+        process.start()
+        try:
+            wait_for_socket(socket)
+            latencies, duration = asyncio.run(
+                replay(socket, records, connections, speed)
+            )
+        finally:
+            # stop like on Ctrl-C so that the proxy shuts down its workers
+            os.kill(process.pid, signal.SIGINT)
+            process.join(timeout=10)
+            if process.exitcode is None:
+                process.terminate()
+                process.join()
+    return summarize(records, latencies, duration, connections, speed)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("capture", type=Path, help="capture file to replay")
+    parser.add_argument("--proxy", choices=PROXIES, default="doveauth")
+    parser.add_argument(
+        "--socket", help="socket of a running dict proxy instead of a local one"
+    )
+    parser.add_argument("--connections", type=int, default=10)
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="multiple of the recorded request rate, 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--set",
+        dest="settings",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="chatmail.ini setting for the local dict proxy",
+    )
+    parser.add_argument("--output", type=Path, help="write JSON to file")
+    args = parser.parse_args(args)
+
+    summary = run_replay(
+        load_capture(args.capture),
+        proxy=args.proxy,
+        socket=args.socket,
+        connections=args.connections,
+        speed=args.speed,
+        settings=dict(x.split("=", 1) for x in args.settings),
+    )
+    out = json.dumps(summary, indent=2)
+    if args.output:
+        args.output.write_text(out + "\n")
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,32 +1,134 @@
+import hmac
+import itertools
 import json
 import logging
+import multiprocessing
 import os
+import re
 import sys
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 try:
     import crypt_r
 except ImportError:
     import crypt as crypt_r
 
+from .accountindex import get_account_index
+from .bloomfilter import BloomFilter
 from .config import Config, read_config
-from .dictproxy import DictProxy
+from .dictproxy import (
+    ITERATE_FLAG_EXACT_KEY,
+    ITERATE_FLAG_SORT_BY_KEY,
+    DictProxy,
+)
 from .migrate_db import migrate_from_db_to_maildir
+from .user import get_daytimestamp
 
 NOCREATE_FILE = "/etc/chatmail-nocreate"
 
 
-def encrypt_password(password: str):
+# dovecot password schemes with their crypt method and default rounds
+HASH_METHODS = {
+    "SHA512-CRYPT": (crypt_r.METHOD_SHA512, 5000),
+    "SHA256-CRYPT": (crypt_r.METHOD_SHA256, 5000),
+    "BLF-CRYPT": (crypt_r.METHOD_BLOWFISH, 4096),
+}
+
+
+def encrypt_password(password: str, scheme="SHA512-CRYPT", rounds=None):
     # https://doc.dovecot.org/configuration_manual/authentication/password_schemes/
-    passhash = crypt_r.crypt(password, crypt_r.METHOD_SHA512)
-    return "{SHA512-CRYPT}" + passhash
+    salt = crypt_r.mksalt(HASH_METHODS[scheme][0], rounds=rounds)
+    passhash = crypt_r.crypt(password, salt)
+    return "{" + scheme + "}" + passhash
 
 
-def is_allowed_to_create(config: Config, user, cleartext_password) -> bool:
-    """Return True if user and password are admissable."""
-    if os.path.exists(NOCREATE_FILE):
-        logging.warning(f"blocked account creation because {NOCREATE_FILE!r} exists.")
-        return False
+def password_hash_params(enc_password: str):
+    """Return the scheme and rounds of a password hash from `encrypt_password`."""
+    scheme, _, passhash = enc_password[1:].partition("}")
+    if scheme not in HASH_METHODS:
+        return scheme, None
+    fields = passhash.split("$")
+    if scheme == "BLF-CRYPT":
+        return scheme, 2 ** int(fields[2])
+    if fields[2].startswith("rounds="):
+        return scheme, int(fields[2][len("rounds=") :])
+    return scheme, HASH_METHODS[scheme][1]
+
+
+def rehash_password(password: str, enc_password: str, scheme, rounds):
+    """Return `password` hashed with `scheme` and `rounds`
+    if it matches `enc_password`, else `None`."""
+    passhash = enc_password.partition("}")[2]
+    if not hmac.compare_digest(crypt_r.crypt(password, passhash) or "", passhash):
+        return None
+    return encrypt_password(password, scheme, rounds)
+
+
+class TemporaryFailure(Exception):
+    """A lookup failed but can be retried later."""
+
 
+class PasswordHashPool:
+    """Hashes passwords in worker processes,
+    which do not hold the GIL of the dict proxy,
+    and fails with `TemporaryFailure` if `max_pending` hashes are in flight
+    or `max_pending_rehashes` of them are rehashes."""
+
+    def __init__(self, workers, max_pending, max_pending_rehashes=1):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.rehash_slots = threading.BoundedSemaphore(max_pending_rehashes)
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def run(self, func, *args):
+        if not self.slots.acquire(blocking=False):
+            raise TemporaryFailure("too many accounts are being created")
+        try:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(
+                        self.workers, mp_context=multiprocessing.get_context("spawn")
+                    )
+                executor = self.executor
+            return executor.submit(func, *args).result()
+        except BrokenProcessPool:
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = None
+            raise TemporaryFailure("password hashing worker died")
+        finally:
+            self.slots.release()
+
+    def rehash(self, *args):
+        """Run `rehash_password` with `args`,
+        leaving all but `max_pending_rehashes` slots to account creation."""
+        if not self.rehash_slots.acquire(blocking=False):
+            raise TemporaryFailure("too many passwords are being rehashed")
+        try:
+            return self.run(rehash_password, *args)
+        finally:
+            self.rehash_slots.release()
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+                self.executor = None
+
+
+def is_allowed_to_create(
+    config: Config, user, cleartext_password, nocreate=None
+) -> bool:
+    """Return True if user and password are admissable.
+
+    `nocreate` tells whether `NOCREATE_FILE` exists if that is already known.
+    """
     if len(cleartext_password) < config.password_min_length:
         logging.warning(
             "Password needs to be at least %s characters long",
@@ -34,8 +136,22 @@ def is_allowed_to_create(config: Config, user, cleartext_password) -> bool:
         )
         return False
 
+    if not is_admissible_address(config, user):
+        return False
+
+    if nocreate is None:
+        nocreate = os.path.exists(NOCREATE_FILE)
+    if nocreate:
+        logging.warning(f"blocked account creation because {NOCREATE_FILE!r} exists.")
+        return False
+
+    return True
+
+
+def is_admissible_address(config: Config, user) -> bool:
+    """Return True if an account may be created for the address `user`."""
     parts = user.split("@")
-    if len(parts) != 2:
+    if len(parts) != 2 or "/" in user:
         logging.warning(f"user {user!r} is not a proper e-mail address")
         return False
     localpart, domain = parts
@@ -59,36 +175,184 @@ def is_allowed_to_create(config: Config, user, cleartext_password) -> bool:
     return True
 
 
+# an escaped character or an unescaped separator
+UNESCAPE_RE = re.compile(r'\\(.)|"', re.DOTALL)
+
+
 def split_and_unescape(s):
     """Split strings using double quote as a separator and backslash as escape character
     into parts."""
 
-    out = ""
-    i = 0
-    while i < len(s):
-        c = s[i]
-        if c == "\\":
-            # Skip escape character.
-            i += 1
-
-            # This will raise IndexError if there is no character
-            # after escape character. This is expected
-            # as this is an invalid input.
-            out += s[i]
-        elif c == '"':
+    chunks = []
+    pos = 0
+    for match in UNESCAPE_RE.finditer(s):
+        chunks.append(s[pos : match.start()])
+        escaped = match.group(1)
+        if escaped is None:
             # Separator
-            yield out
-            out = ""
+            yield "".join(chunks)
+            chunks = []
         else:
-            out += c
-        i += 1
-    yield out
+            chunks.append(escaped)
+        pos = match.end()
+    if s.endswith("\\", pos):
+        # There is no character after the escape character.
+        # This is expected as this is an invalid input.
+        raise IndexError("string ends with escape character")
+    chunks.append(s[pos:])
+    yield "".join(chunks)
+
+
+def password_signature(path):
+    """Return what identifies the content of a password file,
+    or `None` if it does not exist.
+
+    Passwords are replaced by atomic renames, which change the inode.
+    Modification times at the start of a day are ignored
+    because lastlogin sets them to record logins.
+    The path is included because maildirs can move
+    to the hashed layout without changing the inode.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    mtime = st.st_mtime_ns if st.st_mtime_ns % (86400 * 10**9) else None
+    return (str(path), st.st_dev, st.st_ino, st.st_size, mtime)
+
+
+class UserdbCache:
+    """Bounded LRU cache of userdb dicts and their JSON encoding,
+    valid while the `password_signature` of a user does not change."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, addr, signature):
+        with self.lock:
+            entry = self.entries.get(addr)
+            if entry is None or entry[0] != signature:
+                return None
+            self.entries.move_to_end(addr)
+            return entry[1:]
+
+    def put(self, addr, signature, userdb):
+        entry = (signature, userdb, json.dumps(userdb))
+        with self.lock:
+            self.entries[addr] = entry
+            self.entries.move_to_end(addr)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return entry[1:]
+
+
+class NegativeCache:
+    """Bounded set of names which expire `ttl` seconds after they are added."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def add(self, name):
+        with self.lock:
+            self.entries.pop(name, None)
+            self.entries[name] = time.monotonic() + self.ttl
+            while len(self.entries) > self.maxsize:
+                del self.entries[next(iter(self.entries))]
+
+    def __contains__(self, name):
+        expires = self.entries.get(name)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            with self.lock:
+                self.entries.pop(name, None)
+            return False
+        return True
 
 
 class AuthDictProxy(DictProxy):
+    # number of users sent with one write when iterating
+    iterate_chunk_size = 1000
+
+    # number of users whose userdb replies are cached
+    cache_size = 100000
+
+    # seconds and number of entries of the cache of inadmissible addresses
+    negative_cache_ttl = 60
+    negative_cache_size = 100000
+
+    # processes which hash passwords of new accounts and the number of
+    # accounts created at once, less than `executor_workers`
+    # so that lookups of existing accounts are always served
+    hash_workers = 2
+    max_pending_creations = 4
+
+    # number of those hashes which may rehash outdated passwords on login,
+    # other logins skip rehashing until a later login
+    max_pending_rehashes = 1
+
     def __init__(self, config):
         super().__init__()
         self.config = config
+        self.userdb_cache = UserdbCache(self.cache_size)
+        self.negative_cache = NegativeCache(
+            self.negative_cache_size, self.negative_cache_ttl
+        )
+        self.failed_rehashes = NegativeCache(
+            self.negative_cache_size, self.negative_cache_ttl
+        )
+        self.nocreate = False
+        self.nocreate_expires = 0
+        if config.password_hash_scheme not in HASH_METHODS:
+            raise ValueError(
+                f"unsupported password_hash_scheme {config.password_hash_scheme!r}"
+            )
+        # fail at startup instead of at every login if the rounds are invalid
+        method = HASH_METHODS[config.password_hash_scheme][0]
+        try:
+            crypt_r.mksalt(method, rounds=config.password_hash_rounds)
+        except ValueError as e:
+            raise ValueError(f"invalid password_hash_rounds: {e}") from None
+        self.hash_pool = PasswordHashPool(
+            self.hash_workers, self.max_pending_creations, self.max_pending_rehashes
+        )
+        self.account_index = get_account_index(config)
+        if self.account_index:
+            self.account_index.ensure_built(config)
+        self.build_account_filter()
+
+    def build_account_filter(self):
+        """Build the filter of existing accounts from the mailboxes directory.
+
+        Passdb lookups of addresses which are not in the filter
+        do not read from disk unless an account could be created for them.
+        The filter is not built from the account index
+        so that an outdated index does not lock out existing accounts.
+        """
+        try:
+            addrs = list(self.config.iter_addrs())
+        except FileNotFoundError:
+            addrs = []
+        account_filter = BloomFilter(capacity=max(2 * len(addrs), 10000))
+        for addr in addrs:
+            account_filter.add(addr)
+        self.account_filter = account_filter
+
+    def add_account(self, addr):
+        self.account_filter.add(addr)
+        if self.account_filter.full:
+            self.build_account_filter()
+
+    def serve_forever_from_socket(self, socket):
+        try:
+            super().serve_forever_from_socket(socket)
+        finally:
+            self.hash_pool.shutdown()
 
     def handle_lookup(self, parts):
         # Dovecot <2.3.17 has only one part,
@@ -105,48 +369,162 @@ class AuthDictProxy(DictProxy):
             if type == "userdb":
                 user = args[0]
                 if user.endswith(f"@{config.mail_domain}"):
-                    res = self.lookup_userdb(user)
+                    res = self.get_userdb(user)[1]
                 if res:
                     reply_command = "O"
                 else:
                     reply_command = "N"
             elif type == "passdb":
                 user = args[1]
-                if user.endswith(f"@{config.mail_domain}"):
-                    res = self.lookup_passdb(user, cleartext_password=args[0])
+                try:
+                    if user.endswith(f"@{config.mail_domain}"):
+                        res = self.get_passdb(user, cleartext_password=args[0])[1]
+                except TemporaryFailure as e:
+                    logging.warning(f"passdb lookup of {user!r} failed: {e}")
+                    return "F\n"
                 if res:
                     reply_command = "O"
                 else:
                     reply_command = "N"
-        json_res = json.dumps(res) if res else ""
-        return f"{reply_command}{json_res}\n"
+        return f"{reply_command}{res}\n"
 
     def handle_iterate(self, parts):
-        # example: I0\t0\tshared/userdb/
-        if parts[2] == "shared/userdb/":
-            result = "".join(
-                f"Oshared/userdb/{user}\t\n" for user in self.iter_userdb()
-            )
-            return f"{result}\n"
+        # example: I0\t0\tshared/userdb/\tuser@example.org
+        # Dovecot >=2.3.17 appends the username, Dovecot <2.3 sends no row limit.
+        if len(parts) >= 3:
+            flags, max_rows, path = int(parts[0]), int(parts[1]), parts[2]
+        else:
+            *args, path = parts
+            flags = int(args[0]) if args else 0
+            max_rows = 0
+        if path != "shared/userdb/" or flags & ITERATE_FLAG_EXACT_KEY:
+            return "\n"
+
+        users = self.iter_userdb()
+        # the account index is iterated in sorted order
+        if flags & ITERATE_FLAG_SORT_BY_KEY and not self.account_index:
+            users = iter(sorted(users))
+        if max_rows > 0:
+            users = itertools.islice(users, max_rows)
+        return self.iter_userdb_replies(users)
 
-    def iter_userdb(self) -> list:
-        """Get a list of all user addresses."""
-        return [x for x in os.listdir(self.config.mailboxes_dir) if "@" in x]
+    def iter_userdb_replies(self, users):
+        while chunk := list(itertools.islice(users, self.iterate_chunk_size)):
+            yield "".join(f"Oshared/userdb/{user}\t\n" for user in chunk)
+        # Empty line means ITER_FINISHED.
+        yield "\n"
+
+    def iter_userdb(self) -> Iterator[str]:
+        """Iterate over all user addresses, from the account index if enabled."""
+        if self.account_index:
+            return self.account_index.iter_addrs()
+        return self.config.iter_addrs()
+
+    def get_userdb(self, addr):
+        """Return the userdb dict of an existing user and its JSON encoding,
+        or an empty dict and string."""
+        try:
+            user = self.config.get_user(addr)
+        except ValueError:
+            return {}, ""
+        signature = password_signature(user.password_path)
+        if signature is None:
+            return {}, ""
+        entry = self.userdb_cache.get(addr, signature)
+        if entry is None:
+            userdb = user.get_userdb_dict()
+            if not userdb:
+                return {}, ""
+            entry = self.userdb_cache.put(addr, signature, userdb)
+        return entry
+
+    def get_passdb(self, addr, cleartext_password):
+        """Like `get_userdb` but creates the user if it is allowed."""
+        if addr in self.negative_cache:
+            return {}, ""
+        known = addr.startswith("echo@") or addr in self.account_filter
+        if known:
+            entry = self.get_userdb(addr)
+            if entry[0] and not addr.startswith("echo@"):
+                return self.rehash_outdated(addr, cleartext_password, entry)
+            if entry[0]:
+                return entry
+        if not is_admissible_address(self.config, addr):
+            self.negative_cache.add(addr)
+            return {}, ""
+        if not is_allowed_to_create(
+            self.config, addr, cleartext_password, nocreate=self.check_nocreate()
+        ):
+            return {}, ""
+        if not known:
+            # the account may have been created outside of this process
+            entry = self.get_userdb(addr)
+            if entry[0]:
+                self.add_account(addr)
+                return entry
+
+        enc_password = self.hash_pool.run(
+            encrypt_password, cleartext_password, *self.hash_params()
+        )
+        self.config.get_user(addr).set_password(enc_password)
+        self.add_account(addr)
+        if self.account_index:
+            today = get_daytimestamp(time.time())
+            self.account_index.add(addr, created=today, last_login=today)
+        print(f"Created address: {addr}", file=sys.stderr)
+        return self.get_userdb(addr)
+
+    def check_nocreate(self):
+        """Return whether `NOCREATE_FILE` exists,
+        checked at most once every `negative_cache_ttl` seconds
+        so that login attempts of unknown users do not each stat it."""
+        now = time.monotonic()
+        if now >= self.nocreate_expires:
+            self.nocreate = os.path.exists(NOCREATE_FILE)
+            self.nocreate_expires = now + self.negative_cache_ttl
+        return self.nocreate
+
+    def hash_params(self):
+        """Return the configured password scheme and rounds."""
+        scheme = self.config.password_hash_scheme
+        return scheme, self.config.password_hash_rounds or HASH_METHODS[scheme][1]
+
+    def rehash_outdated(self, addr, cleartext_password, entry):
+        """Rehash the password of a user with the configured scheme and rounds
+        if they differ and `cleartext_password` is correct.
+
+        Rehashing is skipped while many passwords are hashed
+        and it is retried on a later login.
+        """
+        enc_password = entry[0]["password"]
+        params = self.hash_params()
+        if password_hash_params(enc_password) == params:
+            return entry
+        if addr in self.failed_rehashes:
+            return entry
+        try:
+            new_password = self.hash_pool.rehash(
+                cleartext_password, enc_password, *params
+            )
+        except TemporaryFailure:
+            return entry
+        except Exception:
+            # the login is valid even if the password can not be rehashed
+            logging.exception(f"rehashing the password of {addr!r} failed")
+            self.failed_rehashes.add(addr)
+            return entry
+        if new_password is None:
+            # wrong password, do not try again for every failing login
+            self.failed_rehashes.add(addr)
+            return entry
+        self.config.get_user(addr).set_password(new_password)
+        return self.get_userdb(addr)
 
     def lookup_userdb(self, addr):
-        return self.config.get_user(addr).get_userdb_dict()
+        return self.get_userdb(addr)[0]
 
     def lookup_passdb(self, addr, cleartext_password):
-        user = self.config.get_user(addr)
-        userdata = user.get_userdb_dict()
-        if userdata:
-            return userdata
-        if not is_allowed_to_create(self.config, addr, cleartext_password):
-            return
-
-        user.set_password(encrypt_password(cleartext_password))
-        print(f"Created address: {addr}", file=sys.stderr)
-        return user.get_userdb_dict()
+        return self.get_passdb(addr, cleartext_password)[0]
 
 
 def main():
@@ -156,5 +534,7 @@ def main():
     migrate_from_db_to_maildir(config)
 
     dictproxy = AuthDictProxy(config=config)
+    if config.dict_capture_dir:
+        dictproxy.start_capture(config.dict_capture_dir.joinpath("doveauth.jsonl"))
 
     dictproxy.serve_forever_from_socket(socket)
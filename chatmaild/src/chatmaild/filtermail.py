@@ -2,17 +2,29 @@
 import asyncio
 import base64
 import binascii
+import hashlib
 import logging
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import struct
 import sys
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from email import policy
-from email.parser import BytesParser
+from email.parser import BytesHeaderParser, BytesParser
 from email.utils import parseaddr
-from smtplib import SMTP as SMTPClient
 
-from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import MISSING, SMTP, Envelope, syntax
 
 from .config import read_config
+from .openmetrics import Registry, start_http_server
+from .smtpclient import LMTPConnectionPool, SMTPConnectionPool, SMTPReplyError
+from .spool import MessageSpool, open_spool_file
 
 
 def check_openpgp_payload(payload: bytes):
@@ -21,6 +33,9 @@ def check_openpgp_payload(payload: bytes):
     OpenPGP payload must consist only of PKESK and SKESK packets
     terminated by a single SEIPD packet.
 
+    `payload` may be `bytes` or `LazyBase64`,
+    only packet headers are read from it.
+
     Returns True if OpenPGP payload is correct,
     False otherwise.
 
@@ -74,30 +89,155 @@ def check_openpgp_payload(payload: bytes):
     return False
 
 
-def check_armored_payload(payload: str):
-    prefix = "-----BEGIN PGP MESSAGE-----\r\n\r\n"
-    if not payload.startswith(prefix):
+# size of the pieces in which a spooled message is scanned
+SCAN_CHUNK_SIZE = 1 << 20
+
+
+def buffer_count(buf, sub: bytes, start: int, end: int):
+    """Return the number of non-overlapping `sub` in `buf[start:end]`.
+
+    `buf` may be an `mmap`, which is read in pieces instead of being copied.
+    """
+    if isinstance(buf, bytes):
+        return buf.count(sub, start, end)
+    count = 0
+    for pos in range(start, end, SCAN_CHUNK_SIZE):
+        # overlap the next piece to find `sub` at the boundary
+        count += buf[pos : min(pos + SCAN_CHUNK_SIZE + len(sub) - 1, end)].count(sub)
+    return count
+
+
+def is_ascii(buf, start: int, end: int):
+    """Return True if `buf[start:end]` is ASCII, reading it in pieces."""
+    return all(
+        buf[pos : min(pos + SCAN_CHUNK_SIZE, end)].isascii()
+        for pos in range(start, end, SCAN_CHUNK_SIZE)
+    )
+
+
+BASE64_CHARS = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+
+
+def is_base64_lines(buf, start: int, end: int, stride: int):
+    """Return True if `buf[start:end]` has only base64 characters
+    and one CRLF in each line of `stride` bytes, reading it in pieces of whole lines.
+    """
+    step = max(1, SCAN_CHUNK_SIZE // stride) * stride
+    for pos in range(start, end, step):
+        piece = buf[pos : min(pos + step, end)]
+        if piece.translate(None, BASE64_CHARS) != b"\r\n" * -(-len(piece) // stride):
+            return False
+    return True
+
+
+class LazyBase64:
+    """Bytes encoded by base64 lines of equal length,
+    decoded lazily one 4-character group at a time.
+
+    Supports `len()` and indexing,
+    which is all that `check_openpgp_payload` needs
+    to walk over OpenPGP packet headers.
+    """
+
+    def __init__(self, text, start: int, line_len: int, size: int):
+        self.text = text
+        self.start = start
+        self.line_len = line_len
+        self.size = size
+        self._group = None
+        self._decoded = b""
+
+    @classmethod
+    def from_lines(cls, text, start: int, end: int):
+        """Return lazily decoded bytes of CRLF-terminated base64 lines
+        in `text[start:end]`, where `text` is `bytes` or an `mmap`.
+
+        Returns `None` if the lines are not laid out
+        as full lines of the same length followed by a shorter or equal last line,
+        if the total length is not a multiple of four characters
+        or if there are other characters than base64 and padding at the end.
+        Only the groups of packet headers are decoded,
+        so all characters are checked here.
+        The decoded size is derived from the number of characters and the padding.
+        """
+        line_end = text.find(b"\r\n", start, end)
+        line_len = line_end - start
+        if line_end == -1 or line_len <= 0 or line_len % 4:
+            return None
+        if end - start < 2 or text[end - 2 : end] != b"\r\n":
+            return None
+
+        stride = line_len + 2
+        num_lines = -(-(end - start) // stride)
+        last_start = start + (num_lines - 1) * stride
+        for line_end in range(start + line_len, end, stride):
+            if text[line_end : line_end + 2] != b"\r\n":
+                return None
+
+        num_chars = (num_lines - 1) * line_len + (end - 2 - last_start)
+        if num_chars % 4:
+            return None
+        tail = text[end - 4 : end - 2]
+        padding = len(tail) - len(tail.rstrip(b"="))
+        if buffer_count(text, b"=", start, end) != padding:
+            return None
+        if not is_base64_lines(text, start, end, stride):
+            return None
+        return cls(text, start, line_len, num_chars // 4 * 3 - padding)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+        group, offset = divmod(i, 3)
+        if group != self._group:
+            pos = group * 4
+            pos = self.start + pos + pos // self.line_len * 2
+            self._decoded = base64.b64decode(self.text[pos : pos + 4], validate=True)
+            self._group = group
+        return self._decoded[offset]
+
+
+def check_armored_payload(payload, start=0, end=None):
+    """Check the ASCII-armored OpenPGP message in `payload[start:end]`.
+
+    `payload` is `bytes` or an `mmap`, only the armor header
+    and the base64 groups of OpenPGP packet headers are copied from it.
+    """
+    if end is None:
+        end = len(payload)
+    prefix = b"-----BEGIN PGP MESSAGE-----\r\n\r\n"
+    if payload[start : start + len(prefix)] != prefix:
         return False
-    payload = payload.removeprefix(prefix)
+    start += len(prefix)
 
-    while payload.endswith("\r\n"):
-        payload = payload.removesuffix("\r\n")
-    suffix = "-----END PGP MESSAGE-----"
-    if not payload.endswith(suffix):
+    # Work with offsets instead of slicing
+    # to not copy potentially large payloads.
+    while end - start >= 2 and payload[end - 2 : end] == b"\r\n":
+        end -= 2
+    suffix = b"-----END PGP MESSAGE-----"
+    if end - start < len(suffix) or payload[end - len(suffix) : end] != suffix:
         return False
-    payload = payload.removesuffix(suffix)
+    end -= len(suffix)
 
     # Remove CRC24.
-    payload = payload.rpartition("=")[0]
-
-    try:
-        payload = base64.b64decode(payload)
-    except binascii.Error:
+    end = payload.rfind(b"=", start, end)
+    if end == -1:
         return False
 
+    data = LazyBase64.from_lines(payload, start, end)
+    if data is None:
+        # Not laid out in lines of equal length, decode everything.
+        try:
+            data = base64.b64decode(payload[start:end])
+        except binascii.Error:
+            return False
+
     try:
-        return check_openpgp_payload(payload)
-    except IndexError:
+        return check_openpgp_payload(data)
+    except (IndexError, binascii.Error):
         return False
 
 
@@ -149,7 +289,11 @@ def check_encrypted(message):
             if part.get_content_type() != "application/octet-stream":
                 return False
 
-            if not check_armored_payload(part.get_payload()):
+            try:
+                payload = part.get_payload().encode("ascii")
+            except UnicodeEncodeError:
+                return False
+            if not check_armored_payload(payload):
                 return False
         else:
             return False
@@ -157,113 +301,837 @@ def check_encrypted(message):
     return True
 
 
-async def asyncmain_beforequeue(config):
+def is_crlf_clean(data, start=0, end=None):
+    """Return True if all line breaks in `data[start:end]` are CRLF."""
+    if end is None:
+        end = len(data)
+    crlf_count = buffer_count(data, b"\r\n", start, end)
+    return (
+        buffer_count(data, b"\r", start, end) == crlf_count
+        and buffer_count(data, b"\n", start, end) == crlf_count
+    )
+
+
+def split_headers(content, start=0, end=None):
+    """Parse the header block of the raw message or part in `content[start:end]`
+    and return the parsed headers and the offset of the raw body.
+
+    Returns `None` if the header block is not in canonical CRLF form
+    and thus can not be split without the full parser.
+    """
+    if end is None:
+        end = len(content)
+    header_end = content.find(b"\r\n\r\n", start, end)
+    if header_end == -1 or not is_crlf_clean(content, start, header_end):
+        return None
+    header_block = content[start : header_end + 4]
+    headers = BytesHeaderParser(policy=policy.default).parsebytes(header_block)
+    if headers.defects:
+        return None
+    return headers, header_end + 4
+
+
+# Top-level headers which postfix removes or replaces
+# when re-injecting submitted mail, see `submission_header_cleanup`.
+SUBMISSION_HEADER_CLEANUP = {
+    b"received": None,
+    b"x-originating-ip": None,
+    b"x-mailer": None,
+    b"user-agent": None,
+    b"subject": b"Subject: [...]\r\n",
+}
+
+
+def clean_submission_headers(content: bytes):
+    """Return the cleaned header block of a submitted mail
+    and the offset of its body in `content`,
+    or `None` if the header block is not terminated by an empty CRLF line.
+    """
+    end = content.find(b"\r\n\r\n")
+    if end == -1:
+        return None
+    out = bytearray()
+    skip = False
+    for line in content[:end].split(b"\r\n"):
+        if line[:1] in (b" ", b"\t"):
+            # continuation of a folded header
+            if not skip:
+                out += line + b"\r\n"
+            continue
+        name = line.split(b":", 1)[0].strip().lower()
+        skip = name in SUBMISSION_HEADER_CLEANUP
+        if skip:
+            out += SUBMISSION_HEADER_CLEANUP[name] or b""
+        else:
+            out += line + b"\r\n"
+    return bytes(out + b"\r\n"), end + 4
+
+
+def split_multipart(content, boundary: str, start=0, end=None):
+    """Split the raw body of a multipart message in `content[start:end]`
+    and return the `(start, end)` offsets of its raw parts.
+
+    Returns `None` if the body is not terminated by a close delimiter
+    or contains a line starting with the boundary
+    that is not a proper delimiter line.
+    """
+    if end is None:
+        end = len(content)
+    separator = b"--" + boundary.encode("ascii")
+    delimiter = b"\r\n" + separator
+    if content[start : start + len(separator)] == separator:
+        start += len(separator)
+    else:
+        pos = content.find(delimiter, start, end)
+        if pos == -1:
+            return None
+        start = pos + len(delimiter)
+
+    parts = []
+    while True:
+        if content[start : start + 2] == b"--":
+            # Close delimiter, the rest of the body is the epilogue.
+            eol = content.find(b"\r\n", start, end)
+            if content[start + 2 : eol if eol != -1 else end].strip(b" \t"):
+                return None
+            return parts
+
+        eol = content.find(b"\r\n", start, end)
+        if eol == -1 or content[start:eol].strip(b" \t"):
+            return None
+        pos = content.find(delimiter, eol, end)
+        if pos == -1:
+            return None
+        parts.append((eol + 2, max(pos, eol + 2)))
+        start = pos + len(delimiter)
+
+
+def check_encrypted_fast(headers, content, start=0):
+    """Check that the message is an OpenPGP-encrypted message
+    without building the full MIME tree.
+
+    `headers` holds the parsed top-level headers
+    and `content[start:]` the raw body.
+    `content` may be an `mmap` of a spooled message, the body is not copied.
+    Returns True or False if the message can be classified
+    by scanning MIME boundaries and `None` if the full parser is needed.
+    """
+    if headers.get_content_type() != "multipart/encrypted":
+        return False
+    boundary = headers.get_boundary()
+    if not boundary or not boundary.isascii():
+        return None
+
+    # Only canonical bodies are split here,
+    # so that the parts are exactly what the full parser would produce.
+    end = len(content)
+    if not is_ascii(content, start, end) or not is_crlf_clean(content, start, end):
+        return None
+    parts = split_multipart(content, boundary, start, end)
+    if parts is None or len(parts) != 2:
+        return None
+
+    payloads = []
+    for part_start, part_end in parts:
+        if content[part_start : part_start + 2] == b"\r\n":
+            return None
+        res = split_headers(content, part_start, part_end)
+        if res is None:
+            return None
+        part_headers, body_start = res
+        payloads.append((part_headers.get_content_type(), body_start, part_end))
+
+    (version_type, *version), (data_type, *data) = payloads
+    if version_type != "application/pgp-encrypted":
+        return False
+    if content[version[0] : version[1]].strip() != b"Version: 1":
+        return False
+    if data_type != "application/octet-stream":
+        return False
+    return check_armored_payload(content, *data)
+
+
+def scan_message(content):
+    """Classify a raw message from its top-level headers and MIME boundaries.
+
+    `content` is `bytes` or an `mmap` of a spooled message,
+    which is only copied as a whole if the full parser is needed.
+
+    Returns a tuple `(message, mail_encrypted)`.
+    If the message could be classified without a full MIME parse,
+    `message` only holds the top-level headers.
+    Otherwise `message` is the fully parsed message.
+    """
+    res = split_headers(content)
+    if res is not None:
+        headers, body_start = res
+        mail_encrypted = check_encrypted_fast(headers, content, body_start)
+        if mail_encrypted is not None:
+            return headers, mail_encrypted
+
+    # `content` may be an `mmap` which the parser can not decode.
+    message = BytesParser(policy=policy.default).parsebytes(bytes(content))
+    return message, check_encrypted(message)
+
+
+SERVICE_BUSY = "451 4.3.2 Too many mails in flight, try again later"
+MESSAGE_TOO_BIG = "552 5.3.4 Message size exceeds fixed maximum message size"
+
+
+class FiltermailSMTP(SMTP):
+    """SMTP server which spools DATA instead of buffering it in memory.
+
+    Once the top-level headers are received, `check_headers` of the handler
+    is called and if it rejects the mail, the rest of DATA is only drained.
+    `handle_DATA` gets the content in `envelope.content`
+    as `bytes` or as an `mmap` of the spool file at `envelope.spool_path`.
+
+    `data_size_limit` is advertised with the SIZE extension,
+    checked against the SIZE parameter of MAIL FROM by aiosmtpd
+    and enforced during DATA by draining the rest without spooling it.
+    """
+
+    # size of the header block up to which headers are checked early
+    max_header_size = 65536
+
+    @syntax("DATA")
+    async def smtp_DATA(self, arg):
+        if await self.check_helo_needed():
+            return
+        if await self.check_auth_needed("DATA"):
+            return
+        if not self.envelope.rcpt_tos:
+            await self.push("503 Error: need RCPT command")
+            return
+        if arg:
+            await self.push("501 Syntax: DATA")
+            return
+
+        handler = self.event_handler
+        error = handler.check_load()
+        if error:
+            await self.push(error)
+            return
+
+        await self.push("354 End data with <CR><LF>.<CR><LF>")
+        spool = MessageSpool(handler.config.filtermail_spool_threshold)
+        self.buffered_bytes = 0
+        try:
+            error = await self.receive_data(spool)
+            if error:
+                await self.push(error)
+                return
+            self.envelope.content = spool.getvalue()
+            self.envelope.original_content = self.envelope.content
+            self.envelope.spool_path = spool.path
+            status = await self._call_handler_hook("DATA")
+            await self.push("250 OK" if status is MISSING else status)
+        finally:
+            self.release_buffered_bytes()
+            spool.close()
+            self._set_post_data_state()
+
+    def release_buffered_bytes(self):
+        self.event_handler.buffered_bytes -= self.buffered_bytes
+        self.buffered_bytes = 0
+
+    async def receive_data(self, spool):
+        """Read DATA lines into `spool` until the final dot.
+
+        Returns an error reply if the mail is rejected
+        in which case the spooled content is discarded
+        and the rest of DATA is drained without spooling it.
+        """
+        handler = self.event_handler
+        max_buffered_bytes = handler.config.filtermail_max_buffered_bytes
+        error = None
+        num_bytes = 0
+        limit = self.data_size_limit
+        headers = bytearray()
+        in_headers = True
+        in_long_line = False
+        while True:
+            try:
+                line = await self._reader.readuntil(b"\r\n")
+            except asyncio.CancelledError:
+                logging.info("Connection lost during DATA")
+                self._writer.close()
+                raise
+            except asyncio.LimitOverrunError as e:
+                # Drain the long line and reply after the final dot.
+                await self._reader.read(e.consumed)
+                in_long_line = True
+                error = error or "500 Line too long (see RFC5321 4.5.3.1.6)"
+                spool.discard()
+                self.release_buffered_bytes()
+                continue
+            if in_long_line:
+                in_long_line = False
+                continue
+            if line == b".\r\n":
+                return error
+            num_bytes += len(line)
+            if error:
+                continue
+            if limit and num_bytes > limit:
+                error = handler.reject("too_big", MESSAGE_TOO_BIG)
+                spool.discard()
+                self.release_buffered_bytes()
+                continue
+
+            if line.startswith(b"."):
+                line = line[1:]
+            spool.write(line)
+            self.buffered_bytes += len(line)
+            handler.buffered_bytes += len(line)
+            if max_buffered_bytes and handler.buffered_bytes > max_buffered_bytes:
+                error = handler.reject("overload", SERVICE_BUSY)
+                spool.discard()
+                self.release_buffered_bytes()
+                continue
+            if not in_headers:
+                continue
+            if line != b"\r\n":
+                headers += line
+                # Very long header blocks are only checked with the whole mail.
+                in_headers = len(headers) <= self.max_header_size
+                continue
+
+            in_headers = False
+            headers += line
+            error = self.check_headers(bytes(headers))
+            if error:
+                spool.discard()
+                self.release_buffered_bytes()
+
+    def check_headers(self, data):
+        try:
+            headers = BytesHeaderParser(policy=policy.default).parsebytes(data)
+            return self.event_handler.check_headers(self.envelope, headers)
+        except Exception:
+            logging.exception("checking headers failed, checking the whole mail")
+
+
+async def asyncmain_beforequeue(
+    config, send_rate_limiter=None, reuse_port=False, process_index=0
+):
     port = config.filtermail_smtp_port
-    Controller(BeforeQueueHandler(config), hostname="127.0.0.1", port=port).start()
+    handler = BeforeQueueHandler(config, send_rate_limiter=send_rate_limiter)
+    loop = asyncio.get_running_loop()
+    await loop.create_server(
+        lambda: FiltermailSMTP(
+            handler, data_size_limit=config.max_message_size, enable_SMTPUTF8=True
+        ),
+        host="127.0.0.1",
+        port=port,
+        reuse_port=reuse_port,
+    )
+    if config.filtermail_metrics_port:
+        await start_http_server(
+            handler.metrics.registry,
+            config.mtail_address or "127.0.0.1",
+            config.filtermail_metrics_port + process_index,
+        )
+    return handler
 
 
-def recipient_matches_passthrough(recipient, passthrough_recipients):
-    for addr in passthrough_recipients:
-        if recipient == addr:
-            return True
-        if addr[0] == "@" and recipient.endswith(addr):
-            return True
-    return False
+class FiltermailMetrics:
+    """Counters and latency histograms of one filtermail process."""
+
+    def __init__(self):
+        self.registry = registry = Registry()
+        self.mails = registry.counter(
+            "filtermail_mails", "Mails checked by filtermail.", ("encryption",)
+        )
+        self.rejected = registry.counter(
+            "filtermail_rejected", "Mails rejected by filtermail.", ("reason",)
+        )
+        self.rate_limited = registry.counter(
+            "filtermail_rate_limited", "Senders refused by the send rate limit."
+        )
+        self.parse_seconds = registry.histogram(
+            "filtermail_parse_seconds", "Time spent parsing mails."
+        )
+        self.check_seconds = registry.histogram(
+            "filtermail_check_seconds", "Time spent checking mails."
+        )
+        self.reinject_seconds = registry.histogram(
+            "filtermail_reinject_seconds", "Time spent re-injecting mails."
+        )
+        self.lmtp_seconds = registry.histogram(
+            "filtermail_lmtp_seconds", "Time spent delivering mails over LMTP."
+        )
+        self.delivered = registry.counter(
+            "filtermail_delivered",
+            "Mails passed on to dovecot over LMTP or re-injected into postfix.",
+            ("route",),
+        )
+
+
+# state of check worker processes, see `init_check_worker`
+_worker = {}
+
+
+def init_check_worker(config):
+    logging.basicConfig(level=logging.WARN)
+    _worker["handler"] = BeforeQueueHandler(config)
+    # workers would outlive a filtermail process which is killed
+    parent = multiprocessing.parent_process()
+    threading.Thread(target=exit_with_parent, args=(parent,), daemon=True).start()
+
+
+def exit_with_parent(parent):
+    multiprocessing.connection.wait([parent.sentinel])
+    os._exit(0)
+
+
+def run_check_worker(mail_from, rcpt_tos, content, spool_path=None):
+    envelope = Envelope()
+    envelope.mail_from = mail_from
+    envelope.rcpt_tos = rcpt_tos
+    if spool_path is not None:
+        content = open_spool_file(spool_path)
+    envelope.content = content
+    handler = _worker["handler"]
+    try:
+        error = handler.check_DATA(envelope)
+    finally:
+        if spool_path is not None:
+            content.close()
+    # metrics are collected by the filtermail process which serves them
+    return error, handler.metrics.registry.pop_state()
 
 
 class BeforeQueueHandler:
-    def __init__(self, config):
+    def __init__(self, config, send_rate_limiter=None):
         self.config = config
-        self.send_rate_limiter = SendRateLimiter()
+        if send_rate_limiter is None:
+            send_rate_limiter = SendRateLimiter()
+        self.send_rate_limiter = send_rate_limiter
+        # share the postfix processes among all filtermail processes
+        reinject_maxsize = (
+            config.postfix_reinject_maxproc // config.filtermail_processes
+        )
+        self.reinject_pool = SMTPConnectionPool(
+            "localhost", config.postfix_reinject_port, maxsize=max(1, reinject_maxsize)
+        )
+        self.lmtp_pool = None
+        if config.filtermail_lmtp_socket:
+            self.lmtp_pool = LMTPConnectionPool(config.filtermail_lmtp_socket)
+        self.check_executor = None
+        self.metrics = FiltermailMetrics()
+        # mails which are checked or re-injected
+        self.inflight_checks = 0
+        # bytes of DATA received by all sessions and not yet handled
+        self.buffered_bytes = 0
+
+    def check_load(self):
+        """Return a temporary error if the configured load limits are reached."""
+        max_checks = self.config.filtermail_max_inflight_checks
+        if max_checks and self.inflight_checks >= max_checks:
+            return self.reject("overload", SERVICE_BUSY)
+        max_bytes = self.config.filtermail_max_buffered_bytes
+        if max_bytes and self.buffered_bytes >= max_bytes:
+            return self.reject("overload", SERVICE_BUSY)
+
+    def get_check_executor(self):
+        if self.check_executor is None:
+            self.check_executor = ProcessPoolExecutor(
+                max_workers=self.config.filtermail_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_check_worker,
+                initargs=(self.config,),
+            )
+        return self.check_executor
+
+    def shutdown(self):
+        if self.check_executor is not None:
+            self.check_executor.shutdown(cancel_futures=True)
+            self.check_executor = None
+
+    async def run_check_DATA(self, envelope):
+        """Run `check_DATA` in a worker process if workers are configured."""
+        if not self.config.filtermail_workers:
+            return self.check_DATA(envelope)
+
+        # Spooled mails are read from the spool file by the worker.
+        spool_path = getattr(envelope, "spool_path", None)
+        content = envelope.content if spool_path is None else None
+        loop = asyncio.get_running_loop()
+        executor = self.get_check_executor()
+        try:
+            error, metrics_state = await loop.run_in_executor(
+                executor,
+                run_check_worker,
+                envelope.mail_from,
+                envelope.rcpt_tos,
+                content,
+                spool_path,
+            )
+        except BrokenProcessPool:
+            logging.exception("filtermail check worker died, restarting workers")
+            self.check_executor = None
+            executor.shutdown(wait=False)
+            return self.reject(
+                "worker_died", "451 4.3.0 Temporary failure checking mail"
+            )
+        self.metrics.registry.add_state(metrics_state)
+        return error
+
+    def reject(self, reason, error):
+        """Count a rejection for `reason` and return the `error` reply."""
+        self.metrics.rejected.inc(reason)
+        return error
 
     async def handle_MAIL(self, server, session, envelope, address, mail_options):
         logging.info(f"handle_MAIL from {address}")
         envelope.mail_from = address
         max_sent = self.config.max_user_send_per_minute
         if not self.send_rate_limiter.is_sending_allowed(address, max_sent):
+            self.metrics.rate_limited.inc()
             return f"450 4.7.1: Too much mail from {address}"
 
         parts = envelope.mail_from.split("@")
         if len(parts) != 2:
-            return f"500 Invalid from address <{envelope.mail_from!r}>"
+            error = f"500 Invalid from address <{envelope.mail_from!r}>"
+            return self.reject("invalid_sender", error)
 
         return "250 OK"
 
     async def handle_DATA(self, server, session, envelope):
         logging.info("handle_DATA before-queue")
-        error = self.check_DATA(envelope)
+        max_checks = self.config.filtermail_max_inflight_checks
+        if max_checks and self.inflight_checks >= max_checks:
+            return self.reject("overload", SERVICE_BUSY)
+        self.inflight_checks += 1
+        try:
+            return await self.check_and_deliver(envelope)
+        finally:
+            self.inflight_checks -= 1
+
+    async def check_and_deliver(self, envelope):
+        with self.metrics.check_seconds.time():
+            error = await self.run_check_DATA(envelope)
         if error:
             return error
+
+        rcpt_tos = envelope.rcpt_tos
+        if self.lmtp_pool is not None and all(map(self.is_local, rcpt_tos)):
+            rcpt_tos = await self.deliver_lmtp(envelope)
+            if not rcpt_tos:
+                return "250 OK"
+        return await self.reinject(envelope, rcpt_tos)
+
+    def is_local(self, recipient):
+        domain = recipient.rpartition("@")[2]
+        return domain.lower() == self.config.mail_domain.lower()
+
+    async def deliver_lmtp(self, envelope):
+        """Deliver a mail to local recipients over dovecot's LMTP socket.
+
+        Returns the recipients it was not delivered to,
+        which are re-injected so that postfix retries or bounces.
+        """
+        res = clean_submission_headers(envelope.content)
+        if res is None:
+            return envelope.rcpt_tos
+        headers, body_start = res
+        logging.info("delivering the mail that passed checks over LMTP")
+        try:
+            with self.metrics.lmtp_seconds.time():
+                refused = await self.lmtp_pool.sendmail(
+                    envelope.mail_from,
+                    envelope.rcpt_tos,
+                    envelope.content,
+                    prefix=headers,
+                    start=body_start,
+                )
+        except (OSError, SMTPReplyError) as e:
+            # Recipients may get the mail twice if the connection broke
+            # after DATA, which is better than losing it.
+            logging.warning(f"LMTP delivery failed, re-injecting: {e!r}")
+            return envelope.rcpt_tos
+        self.metrics.delivered.inc("lmtp", amount=len(envelope.rcpt_tos) - len(refused))
+        for rcpt, (code, text) in refused.items():
+            logging.info(f"LMTP delivery to {rcpt} failed, re-injecting: {code} {text}")
+        return [rcpt for rcpt in envelope.rcpt_tos if rcpt in refused]
+
+    async def reinject(self, envelope, rcpt_tos):
         logging.info("re-injecting the mail that passed checks")
-        client = SMTPClient("localhost", self.config.postfix_reinject_port)
-        client.sendmail(envelope.mail_from, envelope.rcpt_tos, envelope.content)
+        try:
+            with self.metrics.reinject_seconds.time():
+                refused = await self.reinject_pool.sendmail(
+                    envelope.mail_from, rcpt_tos, envelope.content
+                )
+        except SMTPReplyError as e:
+            # only the last line of a multi-line reply, which is passed on as one line
+            text = e.text.rsplit("\n", 1)[-1]
+            return self.reject("reinject_refused", f"{e.code} {text}")
+        except OSError as e:
+            logging.error(f"re-injecting mail failed: {e!r}")
+            error = "451 4.3.0 Temporary failure re-injecting mail"
+            return self.reject("reinject_failed", error)
+        for rcpt, (code, text) in refused.items():
+            logging.warning(f"re-injecting mail to {rcpt} refused: {code} {text}")
+        self.metrics.delivered.inc("reinject", amount=len(rcpt_tos) - len(refused))
         return "250 OK"
 
     def check_DATA(self, envelope):
         """the central filtering function for e-mails."""
         logging.info(f"Processing DATA message from {envelope.mail_from}")
 
-        message = BytesParser(policy=policy.default).parsebytes(envelope.content)
-        mail_encrypted = check_encrypted(message)
+        with self.metrics.parse_seconds.time():
+            message, mail_encrypted = scan_message(envelope.content)
 
         _, from_addr = parseaddr(message.get("from").strip())
-        envelope_from_domain = from_addr.split("@").pop()
+        error = self.check_from(envelope, from_addr)
+        if error:
+            return error
 
-        logging.info(f"mime-from: {from_addr} envelope-from: {envelope.mail_from!r}")
-        if envelope.mail_from.lower() != from_addr.lower():
-            return f"500 Invalid FROM <{from_addr!r}> for <{envelope.mail_from!r}>"
+        self.count_mail("encrypted" if mail_encrypted else "unencrypted")
+
+        passthrough = self.config.passthrough_matcher
+        if passthrough.is_passthrough_sender(envelope.mail_from):
+            return
 
         if mail_encrypted:
-            print("Filtering encrypted mail.", file=sys.stderr)
-        else:
-            print("Filtering unencrypted mail.", file=sys.stderr)
+            return
 
-        if envelope.mail_from in self.config.passthrough_senders:
+        if message.get("secure-join") and not message.is_multipart():
+            # Only top-level headers were parsed, securejoin needs the parts.
+            with self.metrics.parse_seconds.time():
+                parser = BytesParser(policy=policy.default)
+                message = parser.parsebytes(bytes(envelope.content))
+        if is_securejoin(message):
             return
 
-        passthrough_recipients = self.config.passthrough_recipients
+        return self.check_recipients(envelope, from_addr)
 
-        if mail_encrypted or is_securejoin(message):
+    def check_headers(self, envelope, headers):
+        """Return an error if the top-level `headers` make rejection certain.
+
+        Called while DATA is still received,
+        so that the rest of a rejected message is not stored.
+        Returns `None` if the whole message is needed for `check_DATA`.
+        """
+        _, from_addr = parseaddr(headers.get("from").strip())
+        error = self.check_from(envelope, from_addr)
+        if error:
+            return error
+
+        passthrough = self.config.passthrough_matcher
+        if passthrough.is_passthrough_sender(envelope.mail_from):
+            return
+        if headers.get_content_type() == "multipart/encrypted":
+            return
+        if headers.get("secure-join") in ("vc-request", "vg-request"):
             return
 
+        error = self.check_recipients(envelope, from_addr)
+        if error:
+            self.count_mail("unencrypted")
+        return error
+
+    def count_mail(self, kind):
+        self.metrics.mails.inc(kind)
+        # parsed by mtail/delivered_mail.mtail
+        print(f"Filtering {kind} mail.", file=sys.stderr)
+
+    def check_from(self, envelope, from_addr):
+        logging.info(f"mime-from: {from_addr} envelope-from: {envelope.mail_from!r}")
+        if envelope.mail_from.lower() != from_addr.lower():
+            error = f"500 Invalid FROM <{from_addr!r}> for <{envelope.mail_from!r}>"
+            return self.reject("invalid_from", error)
+
+    def check_recipients(self, envelope, from_addr):
+        """Reject unencrypted mail to recipients on other domains."""
+        passthrough = self.config.passthrough_matcher
+        envelope_from_domain = from_addr.split("@").pop()
         for recipient in envelope.rcpt_tos:
             if envelope.mail_from == recipient:
                 # Always allow sending emails to self.
                 continue
-            if recipient_matches_passthrough(recipient, passthrough_recipients):
+            if passthrough.is_passthrough_recipient(recipient):
                 continue
             res = recipient.split("@")
             if len(res) != 2:
-                return f"500 Invalid address <{recipient}>"
+                error = f"500 Invalid address <{recipient}>"
+                return self.reject("invalid_recipient", error)
             _recipient_addr, recipient_domain = res
 
             is_outgoing = recipient_domain != envelope_from_domain
             if is_outgoing:
                 print("Rejected unencrypted mail.", file=sys.stderr)
-                return f"500 Invalid unencrypted mail to <{recipient}>"
+                error = f"500 Invalid unencrypted mail to <{recipient}>"
+                return self.reject("unencrypted", error)
+
+
+class SendWindow:
+    """Per-second send counters of one sender over the last minute."""
+
+    __slots__ = ("counts", "total", "last_second")
+
+    def __init__(self, now_second):
+        self.counts = [0] * 60
+        self.total = 0
+        self.last_second = now_second
+
+    def advance(self, now_second):
+        """Expire the counters of seconds which left the window."""
+        if now_second - self.last_second >= 60:
+            self.counts[:] = [0] * 60
+            self.total = 0
+        else:
+            for second in range(self.last_second + 1, now_second + 1):
+                self.total -= self.counts[second % 60]
+                self.counts[second % 60] = 0
+        self.last_second = max(self.last_second, now_second)
 
 
 class SendRateLimiter:
+    # seconds between sweeps which drop senders that were idle for a minute
+    SWEEP_INTERVAL = 60
+
     def __init__(self):
-        self.addr2timestamps = {}
+        self.addr2window = {}
+        self.next_sweep = time.time() + self.SWEEP_INTERVAL
 
     def is_sending_allowed(self, mail_from, max_send_per_minute):
-        last = self.addr2timestamps.setdefault(mail_from, [])
         now = time.time()
-        last[:] = [ts for ts in last if ts >= (now - 60)]
-        if len(last) <= max_send_per_minute:
-            last.append(now)
+        if now >= self.next_sweep:
+            self.sweep(now)
+
+        now_second = int(now)
+        window = self.addr2window.get(mail_from)
+        if window is None:
+            window = self.addr2window[mail_from] = SendWindow(now_second)
+        window.advance(now_second)
+        if window.total <= max_send_per_minute:
+            window.counts[now_second % 60] += 1
+            window.total += 1
             return True
         return False
 
+    def sweep(self, now):
+        cutoff = int(now) - 60
+        idle = [a for a, w in self.addr2window.items() if w.last_second <= cutoff]
+        for addr in idle:
+            del self.addr2window[addr]
+        self.next_sweep = now + self.SWEEP_INTERVAL
+
+
+class SharedSendRateLimiter:
+    """Send rate limiter with counters in a shared memory table,
+    so that forked filtermail processes enforce the limit together.
+
+    Senders are hashed into buckets of `BUCKET_SLOTS` slots.
+    Slots of senders which were idle for a minute are reused.
+    If all slots of a bucket are in use, the least recently active one is evicted.
+    """
+
+    # sender key, last active second and per-second counters
+    SLOT = struct.Struct("<Qq60H")
+    BUCKET_SLOTS = 8
+
+    def __init__(self, num_buckets=4096):
+        self.num_buckets = num_buckets
+        self.mmap = mmap.mmap(-1, num_buckets * self.BUCKET_SLOTS * self.SLOT.size)
+        self.lock = multiprocessing.get_context("fork").Lock()
+
+    def get_key(self, mail_from):
+        digest = hashlib.blake2b(mail_from.encode(), digest_size=8).digest()
+        # key 0 marks an empty slot
+        return int.from_bytes(digest, "little") or 1
+
+    def find_slot(self, key, now_second):
+        """Return the offset of the slot for `key`, or of a slot to reuse."""
+        first = key % self.num_buckets * self.BUCKET_SLOTS
+        free = evict = None
+        for slot in range(first, first + self.BUCKET_SLOTS):
+            offset = slot * self.SLOT.size
+            slot_key, last_second = struct.unpack_from("<Qq", self.mmap, offset)
+            if slot_key == key:
+                return offset
+            if free is None and (slot_key == 0 or last_second <= now_second - 60):
+                free = offset
+            if evict is None or last_second < evict[0]:
+                evict = (last_second, offset)
+        if free is None:
+            logging.warning("send rate limiter table is full, evicting a sender")
+            free = evict[1]
+        return free
+
+    def is_sending_allowed(self, mail_from, max_send_per_minute):
+        now_second = int(time.time())
+        key = self.get_key(mail_from)
+        with self.lock:
+            offset = self.find_slot(key, now_second)
+            slot_key, last_second, *counts = self.SLOT.unpack_from(self.mmap, offset)
+            window = SendWindow(now_second)
+            if slot_key == key:
+                window.counts = counts
+                window.total = sum(counts)
+                window.last_second = last_second
+                window.advance(now_second)
+            allowed = window.total <= max_send_per_minute
+            if allowed:
+                window.counts[now_second % 60] += 1
+            self.SLOT.pack_into(
+                self.mmap, offset, key, window.last_second, *window.counts
+            )
+            return allowed
+
+
+def serve(config, send_rate_limiter=None, reuse_port=False, process_index=0):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = loop.run_until_complete(
+        asyncmain_beforequeue(
+            config,
+            send_rate_limiter,
+            reuse_port=reuse_port,
+            process_index=process_index,
+        )
+    )
+    try:
+        loop.run_forever()
+    finally:
+        handler.shutdown()
+
+
+def serve_multiprocess(config):
+    """Run `filtermail_processes` processes listening on the same port.
+
+    The kernel distributes connections among them with SO_REUSEPORT
+    and the send rate limit is shared.
+    Each process serves its own metrics on the next metrics port.
+    If one of the processes exits, all are stopped.
+    """
+    send_rate_limiter = SharedSendRateLimiter()
+    ctx = multiprocessing.get_context("fork")
+    processes = [
+        ctx.Process(target=serve, args=(config, send_rate_limiter, True, index))
+        for index in range(config.filtermail_processes)
+    ]
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.start()
+        multiprocessing.connection.wait([p.sentinel for p in processes])
+        logging.error("a filtermail process exited, stopping all of them")
+        sys.exit(1)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
 
 def main():
     args = sys.argv[1:]
     assert len(args) == 1
     config = read_config(args[0])
     logging.basicConfig(level=logging.WARN)
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    task = asyncmain_beforequeue(config)
-    loop.create_task(task)
-    loop.run_forever()
+    if config.filtermail_processes > 1:
+        serve_multiprocess(config)
+    else:
+        serve(config)
@@ -35,6 +35,12 @@ username_max_length = 9
 # minimum length a password must have
 password_min_length = 9
 
+# scheme for hashing passwords: SHA512-CRYPT, SHA256-CRYPT or BLF-CRYPT,
+# and its rounds, a power of two for BLF-CRYPT (default: 5000 or 4096).
+# Stored passwords are rehashed when users log in after a change.
+password_hash_scheme = SHA512-CRYPT
+# password_hash_rounds = 5000
+
 # list of chatmail addresses which can send outbound un-encrypted mail
 passthrough_senders =
 
@@ -49,9 +55,61 @@ passthrough_recipients = xstore@testrun.org
 # where the filtermail SMTP service listens
 filtermail_smtp_port = 10080
 
+# number of filtermail processes sharing the filtermail SMTP port,
+# connections are distributed among them by the kernel
+filtermail_processes = 1
+
+# number of worker processes which check mails for each filtermail process,
+# set to 0 to check mails in the main filtermail process
+filtermail_workers = 0
+
+# size in bytes above which filtermail spools a received mail
+# to a temporary file instead of keeping it in memory
+filtermail_spool_threshold = 1048576
+
+# limits for each filtermail process on the number of mails
+# which are checked or re-injected at the same time
+# and on the total size of mail received and not yet handled.
+# If a limit is reached, mails are refused with a temporary error
+# so that clients retry later. Set to 0 for no limit.
+filtermail_max_inflight_checks = 100
+filtermail_max_buffered_bytes = 1073741824
+
+# if set, filtermail delivers mail whose recipients are all on mail_domain
+# directly to dovecot over this LMTP socket instead of re-injecting it
+# into postfix, and only re-injects mail for recipients it could not deliver.
+# Such mail is not DKIM-signed as it never leaves the server.
+# filtermail_lmtp_socket = /run/dovecot/filtermail-lmtp
+
+# port on which filtermail serves OpenMetrics at /metrics,
+# listening on `mtail_address` or 127.0.0.1 if that is not set.
+# Additional filtermail processes use the following ports,
+# e.g. 10081 and 10082 with `filtermail_processes = 2`.
+# The endpoint is disabled with 0, mail counters are also logged for mtail.
+filtermail_metrics_port = 0
+
+# layout of the mailbox directories: "flat" keeps all of them in one directory,
+# "hashed" in two levels of subdirectories like "ab/cd/<address>"
+# for servers with many accounts. Existing mailboxes are moved
+# to the hashed layout with `python -m chatmaild.migrate_layout`
+# while they stay accessible.
+mailboxes_layout = flat
+
+# if set, doveauth, lastlogin and delete_inactive_users keep an index of accounts
+# with their creation and last login day in this sqlite database,
+# used instead of scanning `mailboxes_dir` to list and expire accounts.
+# It is built from the mailboxes when doveauth starts without an index,
+# `python -m chatmaild.accountindex <chatmail.ini> check` compares them
+# and `rebuild` builds it again.
+# account_index_path = /home/vmail/accounts.sqlite
+
 # postfix accepts on the localhost reinject SMTP port
 postfix_reinject_port = 10025
 
+# maximum number of postfix processes accepting re-injected mail,
+# each filtermail process keeps up to its share of them connected
+postfix_reinject_maxproc = 10
+
 # if set to "True" IPv6 is disabled
 disable_ipv6 = False
 
@@ -88,6 +146,12 @@ disable_ipv6 = False
 # so use this option with caution on production servers. 
 imap_rawlog = false 
 
+# if set, doveauth, lastlogin and chatmail-metadata append the requests
+# they get from dovecot to "<name>.jsonl" files in this directory,
+# with passwords and device tokens redacted.
+# The files can be replayed with `python -m chatmaild.dictreplay`.
+# dict_capture_dir = /var/lib/chatmail-capture
+
 
 #
 # Privacy Policy
@@ -1,31 +1,45 @@
+import logging
 import sys
 
+from .accountindex import get_account_index
 from .config import read_config
-from .dictproxy import DictProxy
+from .dictproxy import DictProxy, parse_set
+from .user import get_daytimestamp
 
 
 class LastLoginDictProxy(DictProxy):
     def __init__(self, config):
         super().__init__()
         self.config = config
+        self.account_index = get_account_index(config)
 
-    def handle_set(self, addr, parts):
-        keyname = parts[1].split("/")
-        value = parts[2] if len(parts) > 2 else ""
-        if keyname[0] == "shared" and keyname[1] == "last-login":
-            if addr.startswith("echo@"):
-                return True
-            addr = keyname[2]
-            timestamp = int(value)
-            user = self.config.get_user(addr)
-            user.set_last_login_timestamp(timestamp)
-            return True
+    def handle_commit(self, addr, sets):
+        # Only the latest login of a transaction is written.
+        timestamps = {}
+        ok = True
+        for parts in sets:
+            keyname, value = parse_set(parts)
+            if keyname[0] == "shared" and keyname[1] == "last-login":
+                timestamps[keyname[2]] = int(value)
+            else:
+                ok = False
+                logging.error(f"dictproxy-set failed for {addr!r}: {parts!r}")
+        if addr.startswith("echo@"):
+            return ok
+        for login_addr, timestamp in timestamps.items():
+            self.set_last_login(login_addr, timestamp)
+        return ok
 
-        return False
+    def set_last_login(self, addr, timestamp):
+        user = self.config.get_user(addr)
+        if user.set_last_login_timestamp(timestamp) and self.account_index:
+            self.account_index.set_last_login(addr, get_daytimestamp(timestamp))
 
 
 def main():
     socket, config_path = sys.argv[1:]
     config = read_config(config_path)
     dictproxy = LastLoginDictProxy(config=config)
+    if config.dict_capture_dir:
+        dictproxy.start_capture(config.dict_capture_dir.joinpath("lastlogin.jsonl"))
     dictproxy.serve_forever_from_socket(socket)
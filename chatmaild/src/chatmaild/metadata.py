@@ -1,8 +1,9 @@
 import logging
+import re
 import sys
 
-from .config import read_config
-from .dictproxy import DictProxy
+from .config import get_maildir, read_config
+from .dictproxy import DictProxy, parse_set
 from .filedict import FileDict
 from .notifier import Notifier
 
@@ -12,17 +13,23 @@ class Metadata:
     # which only ever get removed if the upstream indicates the token is invalid
     DEVICETOKEN_KEY = "devicetoken"
 
-    def __init__(self, vmail_dir):
+    def __init__(self, vmail_dir, layout="flat"):
         self.vmail_dir = vmail_dir
+        self.layout = layout
 
     def get_metadata_dict(self, addr):
-        return FileDict(self.vmail_dir / addr / "metadata.json")
+        maildir = get_maildir(self.vmail_dir, addr, self.layout)
+        return FileDict(maildir / "metadata.json")
 
     def add_token_to_addr(self, addr, token):
+        self.add_tokens_to_addr(addr, [token])
+
+    def add_tokens_to_addr(self, addr, new_tokens):
         with self.get_metadata_dict(addr).modify() as data:
             tokens = data.setdefault(self.DEVICETOKEN_KEY, [])
-            if token not in tokens:
-                tokens.append(token)
+            for token in new_tokens:
+                if token not in tokens:
+                    tokens.append(token)
 
     def remove_token_from_addr(self, addr, token):
         with self.get_metadata_dict(addr).modify() as data:
@@ -35,6 +42,10 @@ class Metadata:
         return mdict.get(self.DEVICETOKEN_KEY, [])
 
 
+# set requests of device tokens which identify devices at push services
+DEVICETOKEN_SET_RE = re.compile(rb"^(S[^\t]*\tpriv/[^/\t]*/devicetoken\t).*", re.DOTALL)
+
+
 class MetadataDictProxy(DictProxy):
     def __init__(self, notifier, metadata, iroh_relay=None):
         super().__init__()
@@ -42,6 +53,10 @@ class MetadataDictProxy(DictProxy):
         self.metadata = metadata
         self.iroh_relay = iroh_relay
 
+    def redact_request(self, line):
+        line = super().redact_request(line)
+        return DEVICETOKEN_SET_RE.sub(rb"\1redacted-token", line)
+
     def handle_lookup(self, parts):
         # Lpriv/43f5f508a7ea0366dff30200c15250e3/devicetoken\tlkj123poi@c2.testrun.org
         keyparts = parts[0].split("/", 2)
@@ -62,19 +77,26 @@ class MetadataDictProxy(DictProxy):
         logging.warning(f"lookup ignored: {parts!r}")
         return "N\n"
 
-    def handle_set(self, addr, parts):
-        # For documentation on key structure see
-        # https://github.com/dovecot/core/blob/main/src/lib-storage/mailbox-attribute.h
-        keyname = parts[1].split("/")
-        value = parts[2] if len(parts) > 2 else ""
-        if keyname[0] == "priv" and keyname[2] == self.metadata.DEVICETOKEN_KEY:
-            self.metadata.add_token_to_addr(addr, value)
-            return True
-        elif keyname[0] == "priv" and keyname[2] == "messagenew":
+    def handle_commit(self, addr, sets):
+        # All device tokens of a transaction are added with one write
+        # and a new message is notified once.
+        tokens = []
+        messagenew = False
+        ok = True
+        for parts in sets:
+            keyname, value = parse_set(parts)
+            if keyname[0] == "priv" and keyname[2] == self.metadata.DEVICETOKEN_KEY:
+                tokens.append(value)
+            elif keyname[0] == "priv" and keyname[2] == "messagenew":
+                messagenew = True
+            else:
+                ok = False
+                logging.error(f"dictproxy-set failed for {addr!r}: {parts!r}")
+        if tokens:
+            self.metadata.add_tokens_to_addr(addr, tokens)
+        if messagenew:
             self.notifier.new_message_for_addr(addr, self.metadata)
-            return True
-
-        return False
+        return ok
 
 
 def main():
@@ -90,12 +112,14 @@ def main():
 
     queue_dir = vmail_dir / "pending_notifications"
     queue_dir.mkdir(exist_ok=True)
-    metadata = Metadata(vmail_dir)
+    metadata = Metadata(vmail_dir, config.mailboxes_layout)
     notifier = Notifier(queue_dir)
     notifier.start_notification_threads(metadata.remove_token_from_addr)
 
     dictproxy = MetadataDictProxy(
         notifier=notifier, metadata=metadata, iroh_relay=iroh_relay
     )
+    if config.dict_capture_dir:
+        dictproxy.start_capture(config.dict_capture_dir.joinpath("metadata.jsonl"))
 
     dictproxy.serve_forever_from_socket(socket)
@@ -2,6 +2,8 @@
 import sys
 from pathlib import Path
 
+from chatmaild.config import iter_mailbox_entries
+
 
 def main(vmail_dir=None):
     if vmail_dir is None:
@@ -10,9 +12,9 @@ def main(vmail_dir=None):
     accounts = 0
     ci_accounts = 0
 
-    for path in Path(vmail_dir).iterdir():
+    for entry in iter_mailbox_entries(Path(vmail_dir)):
         accounts += 1
-        if path.name[:3] in ("ci-", "ac_"):
+        if entry.name[:3] in ("ci-", "ac_"):
             ci_accounts += 1
 
     print("# HELP total number of accounts")
@@ -0,0 +1,161 @@
+"""
+Move mailboxes from the flat to the hashed layout of `mailboxes_dir`
+while dovecot and chatmaild keep running:
+
+    python -m chatmaild.migrate_layout /usr/local/lib/chatmaild/chatmail.ini
+
+Set `mailboxes_layout = hashed` and deploy before migrating.
+Each mailbox is moved with a single rename
+and accounts are found at either location while the migration runs,
+so it can be interrupted and resumed at any time.
+After each move dovecot's auth cache is flushed for the account
+and its clients are disconnected with `doveadm`.
+
+Deliveries and logins which looked up the old location before
+can recreate a flat maildir next to the moved one.
+Its mails are moved into the hashed maildir,
+and dovecot's index files, which are rebuilt from the mails, are removed.
+Other files which exist at both locations are left in place
+and reported, and the command then fails.
+"""
+
+import argparse
+import errno
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from .config import hashed_maildir, read_config
+
+
+def makedirs_like(path, template):
+    """Create `path` and missing parents owned like the `template` directory."""
+    if path.exists():
+        return
+    makedirs_like(path.parent, template)
+    st = template.stat()
+    try:
+        path.mkdir()
+    except FileExistsError:
+        return
+    os.chown(path, st.st_uid, st.st_gid)
+
+
+def get_flat_addrs(mailboxes_dir):
+    with os.scandir(mailboxes_dir) as entries:
+        return sorted(entry.name for entry in entries if "@" in entry.name)
+
+
+def merge_leftover(src, dst):
+    """Move the files of the flat maildir `src` into the hashed maildir `dst`
+    and return True if nothing is left in `src`."""
+    conflicts = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        target = dst.joinpath(os.path.relpath(dirpath, src))
+        makedirs_like(target, dst)
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                # unlike a rename, does not replace an existing file
+                os.link(path, target.joinpath(name))
+            except FileExistsError:
+                if not name.startswith("dovecot"):
+                    conflicts.append(path)
+                    continue
+            os.unlink(path)
+    for dirpath, dirnames, filenames in os.walk(src, topdown=False):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            pass
+    for path in conflicts:
+        logging.error(f"{path} exists in {dst}, merge it manually")
+    return not conflicts
+
+
+def doveadm(*args):
+    res = subprocess.run(["doveadm", *args], check=False)
+    if res.returncode:
+        logging.warning(f"doveadm {' '.join(args)} failed with {res.returncode}")
+
+
+def migrate_layout(config, limit=0, pause=0.0, kick=True):
+    """Move up to `limit` mailboxes to the hashed layout, all if `limit` is 0,
+    and return the number of moved mailboxes.
+
+    Dovecot's auth cache is flushed for each moved mailbox
+    so that deliveries and logins do not use the old location,
+    and its clients are disconnected if `kick` is true.
+    A flat maildir next to a hashed one is merged into it with `merge_leftover`."""
+    if config.mailboxes_layout != "hashed":
+        raise ValueError("set mailboxes_layout = hashed before migrating")
+
+    mailboxes_dir = config.mailboxes_dir
+    moved = 0
+    for addr in get_flat_addrs(mailboxes_dir):
+        if limit and moved >= limit:
+            break
+        src = mailboxes_dir.joinpath(addr)
+        dst = hashed_maildir(mailboxes_dir, addr)
+        makedirs_like(dst.parent, mailboxes_dir)
+        try:
+            # replaces an empty directory at dst
+            os.rename(src, dst)
+        except FileNotFoundError:
+            continue  # deleted in the meantime
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                logging.error(f"could not move {src} to {dst}: {e}")
+                continue
+            logging.warning(f"merging leftover {src} into {dst}")
+        else:
+            moved += 1
+        # the cached userdb reply still contains the old home
+        doveadm("auth", "cache", "flush", addr)
+        if kick:
+            # make clients reconnect to the new location
+            doveadm("kick", addr)
+        if src.exists():
+            # recreated by a delivery or login which used the old location
+            merge_leftover(src, dst)
+        if pause:
+            time.sleep(pause)
+    return moved
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("config", help="path to chatmail.ini")
+    parser.add_argument(
+        "--limit", type=int, default=0, help="maximum number of mailboxes to move"
+    )
+    parser.add_argument(
+        "--pause", type=float, default=0.0, help="seconds to wait after each move"
+    )
+    parser.add_argument(
+        "--no-kick",
+        dest="kick",
+        action="store_false",
+        help="do not disconnect the clients of each moved mailbox with `doveadm kick`",
+    )
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+
+    config = read_config(args.config)
+    moved = migrate_layout(config, limit=args.limit, pause=args.pause, kick=args.kick)
+    remaining = get_flat_addrs(config.mailboxes_dir)
+    logging.info(f"moved {moved} mailboxes, {len(remaining)} remaining")
+    leftovers = [
+        addr
+        for addr in remaining
+        if hashed_maildir(config.mailboxes_dir, addr).exists()
+    ]
+    if leftovers:
+        logging.error(f"{len(leftovers)} flat maildirs could not be merged")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+"""
+Minimal in-process counters and histograms
+rendered in the OpenMetrics text format
+and served over HTTP with asyncio.
+
+All metric state is additive so that state collected in worker processes
+can be moved into the registry of the serving process,
+see `Registry.pop_state` and `Registry.add_state`.
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    inner = ",".join(f'{name}="{value}"' for name, value in pairs)
+    return "{" + inner + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def get(self, *labelvalues):
+        return self.values.get(labelvalues, 0)
+
+    def pop_state(self):
+        state, self.values = self.values, {}
+        return state
+
+    def add_state(self, state):
+        for labelvalues, value in state.items():
+            self.inc(*labelvalues, amount=value)
+
+    def render(self):
+        yield f"# TYPE {self.name} counter"
+        yield f"# HELP {self.name} {self.help}"
+        for labelvalues, value in sorted(self.values.items()):
+            labels = format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_total{labels} {value}"
+
+
+class Histogram:
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def pop_state(self):
+        state = (self.counts, self.sum)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        return state
+
+    def add_state(self, state):
+        counts, total = state
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += total
+
+    def render(self):
+        yield f"# TYPE {self.name} histogram"
+        yield f"# HELP {self.name} {self.help}"
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            yield f'{self.name}_bucket{{le="{le}"}} {cumulative}'
+        yield f"{self.name}_count {cumulative}"
+        yield f"{self.name}_sum {self.sum}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, buckets=Histogram.BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def _register(self, metric):
+        assert metric.name not in self.metrics, metric.name
+        self.metrics[metric.name] = metric
+        return metric
+
+    def pop_state(self):
+        """Return the state of all metrics and reset them."""
+        return {name: metric.pop_state() for name, metric in self.metrics.items()}
+
+    def add_state(self, state):
+        for name, metric_state in state.items():
+            self.metrics[name].add_state(metric_state)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+async def start_http_server(registry, host, port):
+    """Serve the registry on `http://{host}:{port}/metrics`."""
+
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass  # skip request headers
+            parts = request_line.decode("ascii", errors="replace").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+                status, content_type = "200 OK", CONTENT_TYPE
+                body = registry.render().encode()
+            else:
+                status, content_type = "404 Not Found", "text/plain"
+                body = b"not found\n"
+            writer.write(
+                f"HTTP/1.0 {status}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except OSError as e:
+            logging.info(f"metrics request failed: {e!r}")
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,251 @@
+"""
+asyncio-native SMTP and LMTP clients with bounded pools of persistent connections,
+used by filtermail to re-inject mail into postfix
+or to deliver it to dovecot without blocking the event loop.
+"""
+
+import asyncio
+import logging
+import re
+import time
+from collections import deque
+
+
+class SMTPReplyError(Exception):
+    """The server replied with an error code."""
+
+    def __init__(self, code, text):
+        super().__init__(f"{code} {text}")
+        self.code = code
+        self.text = text
+
+
+def iter_quoted_chunks(content, chunk_size=65536, prefix=b"", start=0):
+    """Yield dot-stuffed chunks of `prefix` and `content[start:]`
+    followed by the terminator of the DATA command.
+
+    Chunks end at line boundaries, so `content` may also be
+    an `mmap` of a spool file which is never copied as a whole.
+    `start` must be at the beginning of a line.
+    """
+    last = prefix
+    if prefix:
+        yield re.sub(rb"(?m)^\.", b"..", prefix)
+    while start < len(content):
+        end = content.find(b"\n", start + chunk_size)
+        end = len(content) if end == -1 else end + 1
+        last = content[start:end]
+        yield re.sub(rb"(?m)^\.", b"..", last)
+        start = end
+    if not last.endswith(b"\r\n"):
+        yield b"\r\n"
+    yield b".\r\n"
+
+
+def quote_periods(content: bytes):
+    """Dot-stuff message content and terminate it for the DATA command."""
+    return b"".join(iter_quoted_chunks(content))
+
+
+class SMTPConnection:
+    """A single SMTP connection on which multiple mails can be sent."""
+
+    greeting = "EHLO localhost"
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, host, port, timeout=60):
+        return await cls.start(asyncio.open_connection(host, port), timeout)
+
+    @classmethod
+    async def start(cls, open_connection, timeout):
+        reader, writer = await asyncio.wait_for(open_connection, timeout)
+        conn = cls(reader, writer)
+        try:
+            await conn.expect(220, conn.read_reply())
+            await conn.expect(250, conn.command(cls.greeting))
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    async def read_reply(self):
+        """Read a possibly multi-line reply and return `(code, text)`."""
+        lines = []
+        while True:
+            line = await self.reader.readline()
+            if not line.endswith(b"\n"):
+                raise ConnectionError("connection closed while reading reply")
+            line = line.decode("utf-8", errors="replace").rstrip("\r\n")
+            lines.append(line[4:])
+            if line[3:4] != "-":
+                return int(line[:3]), "\n".join(lines)
+
+    async def command(self, line):
+        self.writer.write(line.encode("utf-8") + b"\r\n")
+        await self.writer.drain()
+        return await self.read_reply()
+
+    async def expect(self, code, coro):
+        reply_code, text = await coro
+        if reply_code != code:
+            raise SMTPReplyError(reply_code, text)
+        return text
+
+    async def rset(self):
+        await self.expect(250, self.command("RSET"))
+
+    async def sendmail(self, mail_from, rcpt_tos, content: bytes, **kw):
+        """Send a mail and return a dict of refused recipients.
+
+        Like `smtplib.SMTP.sendmail` this only raises `SMTPReplyError`
+        if the sender, all recipients or the content are rejected.
+        Keyword arguments are passed to `iter_quoted_chunks`.
+        """
+        refused = await self.send_envelope(mail_from, rcpt_tos)
+        if len(refused) == len(rcpt_tos):
+            code, text = next(iter(refused.values()))
+            raise SMTPReplyError(code, text)
+        await self.send_data(content, **kw)
+        await self.expect(250, self.read_reply())
+        return refused
+
+    async def send_envelope(self, mail_from, rcpt_tos):
+        """Send MAIL FROM and RCPT TO and return a dict of refused recipients."""
+        await self.expect(250, self.command(f"MAIL FROM:<{mail_from}>"))
+        refused = {}
+        for rcpt in rcpt_tos:
+            code, text = await self.command(f"RCPT TO:<{rcpt}>")
+            if code not in (250, 251):
+                refused[rcpt] = (code, text)
+        return refused
+
+    async def send_data(self, content, **kw):
+        await self.expect(354, self.command("DATA"))
+        for chunk in iter_quoted_chunks(content, **kw):
+            self.writer.write(chunk)
+            await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+class LMTPConnection(SMTPConnection):
+    """A single LMTP connection to a unix socket, see RFC 2033."""
+
+    greeting = "LHLO localhost"
+
+    @classmethod
+    async def connect_unix(cls, path, timeout=60):
+        return await cls.start(asyncio.open_unix_connection(path), timeout)
+
+    async def sendmail(self, mail_from, rcpt_tos, content: bytes, **kw):
+        """Send a mail and return a dict of recipients it was not delivered to.
+
+        LMTP replies for each recipient after DATA,
+        so recipients are also refused if their delivery failed.
+        Only raises `SMTPReplyError` if the sender or DATA command is rejected.
+        """
+        refused = await self.send_envelope(mail_from, rcpt_tos)
+        if len(refused) == len(rcpt_tos):
+            return refused
+        await self.send_data(content, **kw)
+        for rcpt in rcpt_tos:
+            if rcpt not in refused:
+                code, text = await self.read_reply()
+                if code != 250:
+                    refused[rcpt] = (code, text)
+        return refused
+
+
+class SMTPConnectionPool:
+    """Bounded pool of persistent SMTP connections to one host and port.
+
+    Idle connections are checked with RSET before they are reused
+    and are replaced by a fresh connection if that fails.
+    Connections which are idle for `idle_timeout` seconds are closed,
+    so that they do not occupy server processes.
+    """
+
+    idle_timeout = 5
+
+    def __init__(self, host, port, maxsize=10):
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        # connections with the time they became idle, most recent last
+        self.idle = deque()
+        self._semaphore = None
+        self._expire_handle = None
+
+    def connect(self):
+        return SMTPConnection.connect(self.host, self.port)
+
+    def _release(self, conn):
+        self.idle.append((conn, time.monotonic()))
+        if self._expire_handle is None:
+            self._schedule_expire(self.idle_timeout)
+
+    def _schedule_expire(self, delay):
+        loop = asyncio.get_running_loop()
+        self._expire_handle = loop.call_later(delay, self._expire_idle)
+
+    def _expire_idle(self):
+        self._expire_handle = None
+        now = time.monotonic()
+        while self.idle and self.idle[0][1] + self.idle_timeout <= now:
+            self.idle.popleft()[0].close()
+        if self.idle:
+            self._schedule_expire(self.idle[0][1] + self.idle_timeout - now)
+
+    async def _get_connection(self):
+        while self.idle:
+            conn, _ = self.idle.pop()
+            try:
+                await conn.rset()
+            except (OSError, SMTPReplyError) as e:
+                logging.info(f"dropping stale connection: {e}")
+                conn.close()
+            else:
+                return conn
+        return await self.connect()
+
+    async def sendmail(self, mail_from, rcpt_tos, content: bytes, **kw):
+        # Created lazily so that it belongs to the loop which runs the server.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.maxsize)
+
+        async with self._semaphore:
+            conn = await self._get_connection()
+            try:
+                refused = await conn.sendmail(mail_from, rcpt_tos, content, **kw)
+            except SMTPReplyError:
+                # The connection itself is still usable.
+                self._release(conn)
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            self._release(conn)
+            return refused
+
+    def close(self):
+        if self._expire_handle is not None:
+            self._expire_handle.cancel()
+            self._expire_handle = None
+        while self.idle:
+            self.idle.pop()[0].close()
+
+
+class LMTPConnectionPool(SMTPConnectionPool):
+    """Bounded pool of persistent LMTP connections to a unix socket."""
+
+    def __init__(self, path, maxsize=10):
+        super().__init__(None, None, maxsize=maxsize)
+        self.path = path
+
+    def connect(self):
+        return LMTPConnection.connect_unix(self.path)
@@ -0,0 +1,67 @@
+"""
+Spool for incoming message content which is kept in memory
+up to a threshold and moved to a temporary file beyond it,
+so that large messages do not stay in process memory while they are handled.
+"""
+
+import mmap
+import tempfile
+
+
+class MessageSpool:
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.buffer = bytearray()
+        self.file = None
+        self.mmap = None
+        self.discarded = False
+
+    @property
+    def path(self):
+        """Path of the spool file, or `None` if content is kept in memory."""
+        return self.file.name if self.file is not None else None
+
+    def write(self, data: bytes):
+        if self.discarded:
+            return
+        if self.file is not None:
+            self.file.write(data)
+            return
+        self.buffer += data
+        if len(self.buffer) > self.threshold:
+            self.file = tempfile.NamedTemporaryFile(prefix="filtermail-")
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+
+    def discard(self):
+        """Drop all content written so far and any content written later."""
+        self.close()
+        self.discarded = True
+
+    def getvalue(self):
+        """Return the content as `bytes` or as a read-only `mmap` of the spool file.
+
+        The `mmap` supports `len()`, `find()` and slicing like `bytes`
+        and is valid until the spool is closed.
+        """
+        if self.file is None:
+            return bytes(self.buffer)
+        if self.mmap is None:
+            self.file.flush()
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mmap
+
+    def close(self):
+        self.buffer = bytearray()
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def open_spool_file(path):
+    """Return a read-only `mmap` of a spool file given by `MessageSpool.path`."""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,143 @@
+import time
+
+import pytest
+
+from chatmaild.accountindex import AccountIndex, main
+from chatmaild.delete_inactive_users import delete_inactive_users
+from chatmaild.doveauth import AuthDictProxy, encrypt_password
+from chatmaild.lastlogin import LastLoginDictProxy
+from chatmaild.user import get_daytimestamp
+
+
+@pytest.fixture
+def config(make_config, tmp_path):
+    index_path = tmp_path.joinpath("accounts.sqlite")
+    return make_config("chat.example.org", dict(account_index_path=str(index_path)))
+
+
+@pytest.fixture
+def dictproxy(config):
+    dictproxy = AuthDictProxy(config=config)
+    yield dictproxy
+    dictproxy.hash_pool.shutdown()
+
+
+def test_index_queries(tmp_path):
+    index = AccountIndex(tmp_path.joinpath("accounts.sqlite"))
+    index.add("a@x.org", created=86400, last_login=86400)
+    index.add("b@x.org", created=86400, last_login=3 * 86400)
+    index.set_last_login("c@x.org", 2 * 86400)
+    assert index.count() == 3
+    assert list(index.iter_addrs()) == ["a@x.org", "b@x.org", "c@x.org"]
+    assert list(index.iter_inactive(3 * 86400)) == ["a@x.org", "c@x.org"]
+    assert index.get("c@x.org") == (None, 2 * 86400)
+
+    index.set_last_login("a@x.org", 4 * 86400)
+    assert index.get("a@x.org") == (86400, 4 * 86400)
+    index.remove("b@x.org")
+    assert index.get("b@x.org") is None
+
+    # changes are visible to other connections
+    assert AccountIndex(index.path).count() == 2
+
+
+def test_doveauth_and_lastlogin_update_index(config, dictproxy):
+    index = dictproxy.account_index
+    addrs = [f"user{i:05d}@chat.example.org" for i in range(3)]
+    for addr in addrs:
+        dictproxy.lookup_passdb(addr, "q9mr3faue")
+    today = get_daytimestamp(time.time())
+    assert index.get(addrs[0]) == (today, today)
+    assert list(dictproxy.iter_userdb()) == addrs
+
+    lastlogin = LastLoginDictProxy(config=config)
+    transactions = {}
+    lastlogin.handle_dovecot_request(f"B1\t{addrs[0]}", transactions)
+    lastlogin.handle_dovecot_request(
+        f"S1\tshared/last-login/{addrs[0]}\t{86400 * 3 + 5}", transactions
+    )
+    lastlogin.handle_dovecot_request("C1", transactions)
+    assert index.get(addrs[0]) == (today, 86400 * 3)
+    assert not index.check(config)
+
+
+def test_index_built_for_existing_accounts(make_config, tmp_path):
+    config = make_config("chat.example.org")
+    dictproxy = AuthDictProxy(config=config)
+    addrs = [f"user{i:05d}@chat.example.org" for i in range(3)]
+    for addr in addrs:
+        dictproxy.lookup_passdb(addr, "q9mr3faue")
+    dictproxy.hash_pool.shutdown()
+    old = time.time() - (config.delete_inactive_users_after * 86400) - 86400
+    config.get_user(addrs[0]).set_last_login_timestamp(old)
+    # an account which could not be created with the current settings
+    short = "short@chat.example.org"
+    config.get_user(short).set_password(encrypt_password("q9mr3faue"))
+
+    index_path = tmp_path.joinpath("accounts.sqlite")
+    config = make_config("chat.example.org", dict(account_index_path=index_path))
+    dictproxy = AuthDictProxy(config=config)
+    assert dictproxy.account_index.built
+    assert list(dictproxy.iter_userdb()) == [short] + addrs
+    assert dictproxy.lookup_passdb(short, "q9mr3faue")
+    dictproxy.hash_pool.shutdown()
+
+    index_path.unlink()
+    delete_inactive_users(config)
+    assert sorted(config.iter_addrs()) == [short] + addrs[1:]
+    assert AccountIndex(index_path).count() == 3
+
+
+def test_delete_inactive_users_from_index(config, dictproxy):
+    index = dictproxy.account_index
+    old = time.time() - (config.delete_inactive_users_after * 86400) - 86400
+    addrs = [f"user{i:05d}@chat.example.org" for i in range(4)]
+    for addr in addrs:
+        dictproxy.lookup_passdb(addr, "q9mr3faue")
+    for addr in addrs[:2]:
+        config.get_user(addr).set_last_login_timestamp(old)
+        index.set_last_login(addr, get_daytimestamp(old))
+    # outdated in the index but recently used according to the password file
+    index.set_last_login(addrs[2], get_daytimestamp(old))
+    # indexed but already removed from disk
+    index.add("user99999@chat.example.org", created=0, last_login=0)
+
+    delete_inactive_users(config)
+    assert sorted(config.iter_addrs()) == addrs[2:]
+    assert list(index.iter_addrs()) == addrs[2:]
+    assert not index.check(config)
+
+
+def test_rebuild_and_check(config, dictproxy, capsys):
+    index = dictproxy.account_index
+    addrs = [f"user{i:05d}@chat.example.org" for i in range(3)]
+    for addr in addrs:
+        dictproxy.lookup_passdb(addr, "q9mr3faue")
+    created = index.get(addrs[0])[0]
+    inipath = str(config._inipath)
+
+    assert main([inipath, "check"]) == 0
+    index.remove(addrs[1])
+    index.add("user99999@chat.example.org", created=0, last_login=0)
+    config.get_user(addrs[2]).set_last_login_timestamp(86400)
+    assert main([inipath, "check"]) == 1
+    out = capsys.readouterr().out
+    assert f"{addrs[1]}: not indexed" in out
+    assert "user99999@chat.example.org: indexed but does not exist" in out
+    assert f"{addrs[2]}: indexed last login" in out
+
+    assert main([inipath, "rebuild"]) is None
+    assert "indexed 3 accounts" in capsys.readouterr().out
+    assert main([inipath, "check"]) == 0
+    assert list(index.iter_addrs()) == addrs
+    assert index.get(addrs[0]) == (created, created)
+    assert index.get(addrs[1]) == (None, created)
+    assert index.get(addrs[2]) == (created, 86400)
+
+    main([inipath, "inactive"])
+    assert capsys.readouterr().out == f"{addrs[2]}\n"
+
+
+def test_not_enabled(example_config, capsys):
+    assert main([str(example_config._inipath), "count"]) == 1
+    assert "account_index_path is not set" in capsys.readouterr().err
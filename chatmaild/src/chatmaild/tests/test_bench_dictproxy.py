@@ -0,0 +1,19 @@
+import json
+
+from chatmaild.bench_dictproxy import SCENARIOS, main, make_requests
+
+
+def test_make_requests():
+    lines = make_requests("transaction", "a@example.org", 2)
+    assert [line[:1] for line in lines] == [b"B", b"S", b"C"] * 2
+    assert len(make_requests("lookup-passdb", "a@example.org", 3)) == 3
+
+
+def test_benchmark(tmp_path):
+    output = tmp_path.joinpath("bench.json")
+    main(["--number=200", "--users=5", "--batch=10", f"--output={output}"])
+    summary = json.loads(output.read_text())
+    assert list(summary["scenarios"]) == SCENARIOS
+    for result in summary["scenarios"].values():
+        assert result["operations"] == 200
+        assert result["operations_per_second"] > 0
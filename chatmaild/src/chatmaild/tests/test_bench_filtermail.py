@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from chatmaild.bench_filtermail import KINDS, main, make_corpus, percentile
+
+
+def test_percentile():
+    values = list(range(100, 0, -1))
+    assert percentile(values, 0.5) == 51
+    assert percentile(values, 0.99) == 100
+    assert percentile([], 0.5) is None
+
+
+def test_make_corpus():
+    corpus = make_corpus(large_size=100000)
+    assert list(corpus) == KINDS
+    _, _, content = corpus["encrypted-large"]
+    assert 100000 < len(content) < 110000
+    _, rcpt_tos, _ = corpus["many-recipients"]
+    assert len(rcpt_tos) == 50
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_benchmark(tmp_path, workers):
+    output = tmp_path.joinpath("bench.json")
+    res = main(
+        [
+            "--repeat=3",
+            "--concurrency=2",
+            "--large-size=100000",
+            f"--set=filtermail_workers={workers}",
+            f"--output={output}",
+        ]
+    )
+    assert res is None
+    summary = json.loads(output.read_text())
+    assert summary["messages"] == 3 * len(KINDS)
+    assert summary["rejected"] == 3
+    assert summary["reinjected"] == summary["messages"] - summary["rejected"]
+    assert summary["reinjected"] == summary["expected_reinjected"]
+    assert summary["messages_per_second"] > 0
+    assert summary["kinds"]["cleartext-rejected"]["rejected"] == 3
+    for stats in summary["kinds"].values():
+        assert stats["latency_p50"] <= stats["latency_p99"]
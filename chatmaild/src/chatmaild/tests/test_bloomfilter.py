@@ -0,0 +1,16 @@
+from chatmaild.bloomfilter import BloomFilter
+
+
+def test_bloomfilter():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    items = [f"user{i}@example.org" for i in range(1000)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+    assert not bloom.full
+
+    false_positives = sum(f"other{i}@example.org" in bloom for i in range(10000))
+    assert false_positives < 300
+
+    bloom.add("one-more@example.org")
+    assert bloom.full
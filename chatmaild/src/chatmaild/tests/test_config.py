@@ -1,6 +1,6 @@
 import pytest
 
-from chatmaild.config import read_config
+from chatmaild.config import hashed_maildir, read_config
 
 
 def test_read_config_basic(example_config):
@@ -24,12 +24,25 @@ def test_read_config_testrun(make_config):
     assert config.privacy_mail == "privacy@testrun.org"
     assert config.filtermail_smtp_port == 10080
     assert config.postfix_reinject_port == 10025
+    assert config.postfix_reinject_maxproc == 10
+    assert config.filtermail_processes == 1
+    assert config.filtermail_workers == 0
+    assert config.filtermail_metrics_port == 0
+    assert config.filtermail_spool_threshold == 1048576
+    assert config.filtermail_max_inflight_checks == 100
+    assert config.filtermail_max_buffered_bytes == 1073741824
+    assert config.filtermail_lmtp_socket is None
+    assert config.dict_capture_dir is None
+    assert config.account_index_path is None
     assert config.max_user_send_per_minute == 60
     assert config.max_mailbox_size == "100M"
     assert config.delete_mails_after == "20"
     assert config.username_min_length == 9
     assert config.username_max_length == 9
     assert config.password_min_length == 9
+    assert config.password_hash_scheme == "SHA512-CRYPT"
+    assert config.password_hash_rounds is None
+    assert config.mailboxes_layout == "flat"
     assert "privacy@testrun.org" in config.passthrough_recipients
     assert config.passthrough_senders == []
 
@@ -61,6 +74,58 @@ def test_config_userstate_paths(make_config, tmp_path):
         config.get_user(".")
 
 
+def test_config_defaults_for_missing_options(example_config):
+    inipath = example_config._inipath
+    lines = inipath.read_text().splitlines()
+    inipath.write_text(
+        "\n".join(line for line in lines if "filtermail_metrics_port" not in line)
+    )
+    config = read_config(inipath)
+    assert config.filtermail_metrics_port == 0
+
+
 def test_config_max_message_size(make_config, tmp_path):
     config = make_config("something.testrun.org", dict(max_message_size="10000"))
     assert config.max_message_size == 10000
+
+
+def test_passthrough_matcher(make_config):
+    config = make_config("something.testrun.org")
+    config.passthrough_senders = ["sender@something.testrun.org"]
+    config.passthrough_recipients = ["privacy@x.org", "@y.org", "@sub.z.org"]
+    matcher = config.passthrough_matcher
+    assert matcher is config.passthrough_matcher
+
+    assert matcher.is_passthrough_sender("sender@something.testrun.org")
+    assert not matcher.is_passthrough_sender("other@something.testrun.org")
+
+    assert matcher.is_passthrough_recipient("privacy@x.org")
+    assert not matcher.is_passthrough_recipient("other@x.org")
+    assert matcher.is_passthrough_recipient("anyone@y.org")
+    assert matcher.is_passthrough_recipient("anyone@sub.z.org")
+    assert not matcher.is_passthrough_recipient("anyone@z.org")
+    assert not matcher.is_passthrough_recipient("anyone@xy.org")
+    assert not matcher.is_passthrough_recipient("y.org")
+
+    config.passthrough_recipients = ["@x.org"]
+    assert config.passthrough_matcher.is_passthrough_recipient("other@x.org")
+
+
+def test_config_hashed_layout(make_config):
+    config = make_config("chat.example.org", dict(mailboxes_layout="hashed"))
+    addr = "user1@chat.example.org"
+    maildir = config.get_user(addr).maildir
+    assert maildir.relative_to(config.mailboxes_dir).parts[2] == addr
+    assert maildir == hashed_maildir(config.mailboxes_dir, addr)
+
+    # not yet migrated accounts keep their flat location
+    config.mailboxes_dir.joinpath("user2@chat.example.org").mkdir()
+    maildir = config.get_user("user2@chat.example.org").maildir
+    assert maildir == config.mailboxes_dir.joinpath("user2@chat.example.org")
+
+    config.get_user(addr).set_password("1l2k3j1l2k3j123")
+    config.mailboxes_dir.joinpath("pending_notifications").mkdir()
+    assert sorted(config.iter_addrs()) == [addr, "user2@chat.example.org"]
+
+    with pytest.raises(ValueError):
+        make_config("chat.example.org", dict(mailboxes_layout="sharded"))
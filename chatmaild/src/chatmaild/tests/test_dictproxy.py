@@ -0,0 +1,177 @@
+import asyncio
+import threading
+
+from chatmaild.dictproxy import DictProxy
+
+
+class RecordingDictProxy(DictProxy):
+    executor_workers = 2
+
+    def __init__(self):
+        self.sets = []
+        self.threads = set()
+
+    def handle_lookup(self, parts):
+        self.threads.add(threading.get_ident())
+        return f"O{parts[0]}\n"
+
+    def handle_set(self, addr, parts):
+        self.sets.append((addr, parts))
+        return True
+
+
+def test_serve_from_socket(tmp_path):
+    dictproxy = RecordingDictProxy()
+    socket = str(tmp_path.joinpath("dict.socket"))
+
+    async def request(lines):
+        reader, writer = await asyncio.open_unix_connection(socket)
+        replies = []
+        for line in lines:
+            writer.write(line.encode() + b"\n")
+            await writer.drain()
+            if line[0] in "LC":
+                replies.append((await reader.readline()).decode())
+        writer.close()
+        return replies
+
+    async def run():
+        serve_task = asyncio.create_task(dictproxy.serve_from_socket(socket))
+        while not tmp_path.joinpath("dict.socket").exists():
+            await asyncio.sleep(0.01)
+
+        # many idle connections do not block others
+        idle = [await asyncio.open_unix_connection(socket) for _ in range(200)]
+        lookups = [request(["H3\t2\t0\t\tauth", f"Lkey{i}\tuser"]) for i in range(50)]
+        results = await asyncio.gather(*lookups)
+        # transaction IDs are local to each connection
+        transactions = await asyncio.gather(
+            request(["B1\ta@example.org", "S1\tkey\tvalue", "C1"]),
+            request(["B1\tb@example.org", "S1\tkey\tvalue", "C1"]),
+        )
+        for _, writer in idle:
+            writer.close()
+        serve_task.cancel()
+        return results, transactions
+
+    results, transactions = asyncio.run(run())
+    assert results == [[f"Okey{i}\n"] for i in range(50)]
+    assert transactions == [["O\n"], ["O\n"]]
+    assert sorted(addr for addr, _ in dictproxy.sets) == [
+        "a@example.org",
+        "b@example.org",
+    ]
+    assert len(dictproxy.threads) <= 2
+
+
+def test_pipelined_requests(tmp_path):
+    class BatchRecordingDictProxy(RecordingDictProxy):
+        batches = []
+
+        def handle_requests(self, msgs, *args):
+            self.batches.append(len(msgs))
+            return super().handle_requests(msgs, *args)
+
+    dictproxy = BatchRecordingDictProxy()
+    socket = str(tmp_path.joinpath("dict.socket"))
+    lines = ["H3\t2\t0\t\tauth"]
+    for i in range(100):
+        lines += [f"B{i}\tuser{i}", f"S{i}\tkey\tvalue", f"Lkey{i}\tuser{i}", f"C{i}"]
+
+    async def run():
+        serve_task = asyncio.create_task(dictproxy.serve_from_socket(socket))
+        while not tmp_path.joinpath("dict.socket").exists():
+            await asyncio.sleep(0.01)
+        reader, writer = await asyncio.open_unix_connection(socket)
+        writer.write("".join(line + "\n" for line in lines).encode())
+        writer.write_eof()
+        replies = await reader.read()
+        serve_task.cancel()
+        return replies.decode()
+
+    replies = asyncio.run(run())
+    expected = "".join(f"Okey{i}\nO\n" for i in range(100))
+    assert replies == expected
+    # requests which arrived together are handled together
+    assert len(dictproxy.batches) < 10
+    assert sum(dictproxy.batches) == len(lines)
+
+
+def test_async_commit(tmp_path):
+    dictproxy = RecordingDictProxy()
+    socket = str(tmp_path.joinpath("dict.socket"))
+    lines = [
+        "Lkey0\tuser",
+        "B1\tuser",
+        "S1\tkey\tvalue",
+        "S1\tkey2\tvalue2",
+        "D1",
+        "Lkey1\tuser",
+        "B2\tuser",
+        "S2\tkey3\tvalue3",
+        "C2",
+        "Lkey2\tuser",
+    ]
+
+    async def run():
+        serve_task = asyncio.create_task(dictproxy.serve_from_socket(socket))
+        while not tmp_path.joinpath("dict.socket").exists():
+            await asyncio.sleep(0.01)
+        reader, writer = await asyncio.open_unix_connection(socket)
+        writer.write("".join(line + "\n" for line in lines).encode())
+        await writer.drain()
+        writer.write_eof()
+        replies = await reader.read()
+        serve_task.cancel()
+        return replies
+
+    # replies are sent in the order of the pipelined requests
+    replies = asyncio.run(run())
+    assert replies == b"Okey0\nAO1\nOkey1\nO\nOkey2\n"
+    assert dictproxy.sets == [
+        ("user", ["1", "key", "value"]),
+        ("user", ["1", "key2", "value2"]),
+        ("user", ["2", "key3", "value3"]),
+    ]
+
+
+def test_failed_request_in_batch(tmp_path):
+    dictproxy = RecordingDictProxy()
+    socket = str(tmp_path.joinpath("dict.socket"))
+    # the set of an unknown transaction fails
+    lines = ["Lkey0\tuser", "B1\tuser", "Lkey1\tuser", "S2\tkey\tvalue", "Lkey2"]
+
+    async def run():
+        serve_task = asyncio.create_task(dictproxy.serve_from_socket(socket))
+        while not tmp_path.joinpath("dict.socket").exists():
+            await asyncio.sleep(0.01)
+        reader, writer = await asyncio.open_unix_connection(socket)
+        writer.write("".join(line + "\n" for line in lines).encode())
+        await writer.drain()
+        replies = await reader.read()
+        serve_task.cancel()
+        return replies
+
+    # the replies of the preceding requests are sent before disconnecting
+    assert asyncio.run(run()) == b"Okey0\nOkey1\n"
+
+
+def test_request_methods_can_be_overridden():
+    class HelloDictProxy(RecordingDictProxy):
+        def request_hello(self, args, transactions):
+            return f"hello {args.decode()}\n"
+
+    dictproxy = HelloDictProxy()
+    transactions = {}
+    assert dictproxy.handle_dovecot_request(b"H3\t2", transactions) == "hello 3\t2\n"
+    assert dictproxy.handle_dovecot_request("Lkey", transactions) == "Okey\n"
+    assert dictproxy.handle_dovecot_request(b"X", transactions) is None
+
+    dictproxy.handle_dovecot_request(b"B1\tuser@example.org", transactions)
+    dictproxy.handle_dovecot_request(b"S1\tpriv/key\tva\xc3\xa4lue", transactions)
+    dictproxy.handle_dovecot_request(b"R1", transactions)
+    dictproxy.handle_dovecot_request(b"B2\tuser@example.org", transactions)
+    dictproxy.handle_dovecot_request(b"S2\tpriv/key\tva\xc3\xa4lue", transactions)
+    assert dictproxy.handle_dovecot_request(b"C2", transactions) == "O\n"
+    assert dictproxy.sets == [("user@example.org", ["2", "priv/key", "vaälue"])]
+    assert transactions == {}
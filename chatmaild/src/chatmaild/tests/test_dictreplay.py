@@ -0,0 +1,70 @@
+import asyncio
+import json
+
+from chatmaild.dictreplay import main, rename_transaction
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.metadata import MetadataDictProxy
+
+
+def test_redact_request():
+    dictproxy = MetadataDictProxy(notifier=None, metadata=None)
+    line = b'Lshared/passdb/se\\"cr\\\\et"user@example.org\tuser@example.org'
+    assert dictproxy.redact_request(line) == (
+        b'Lshared/passdb/redacted-password"user@example.org\tuser@example.org'
+    )
+    line = b"S1\tpriv/0123/devicetoken\tsecret-token"
+    assert dictproxy.redact_request(line) == (
+        b"S1\tpriv/0123/devicetoken\tredacted-token"
+    )
+    line = b"S1\tpriv/0123/messagenew"
+    assert dictproxy.redact_request(line) == line
+
+
+def test_rename_transaction():
+    assert rename_transaction("B1\tuser@example.org", 3) == "B3.1\tuser@example.org"
+    assert rename_transaction("C1", 3) == "C3.1"
+    assert rename_transaction("Lshared/userdb/x\tx", 3) == "Lshared/userdb/x\tx"
+
+
+def test_capture_and_replay(tmp_path, example_config, gencreds):
+    capture = tmp_path.joinpath("doveauth.jsonl")
+    socket = str(tmp_path.joinpath("doveauth.socket"))
+    dictproxy = AuthDictProxy(config=example_config)
+    dictproxy.start_capture(capture)
+    addrs = [gencreds()[0] for _ in range(3)]
+
+    async def record():
+        serve_task = asyncio.create_task(dictproxy.serve_from_socket(socket))
+        while not tmp_path.joinpath("doveauth.socket").exists():
+            await asyncio.sleep(0.01)
+        for addr in addrs:
+            reader, writer = await asyncio.open_unix_connection(socket)
+            lines = [
+                "H3\t2\t0\t\tauth",
+                f'Lshared/passdb/sec\\"ret_password"{addr}\t{addr}',
+                f"Lshared/userdb/{addr}\t{addr}",
+                "I0\t0\tshared/userdb/",
+            ]
+            writer.write("".join(line + "\n" for line in lines).encode())
+            writer.write_eof()
+            await reader.read()
+            writer.close()
+        serve_task.cancel()
+
+    asyncio.run(record())
+    dictproxy.capture.file.close()
+
+    text = capture.read_text()
+    assert "ret_password" not in text
+    records = [json.loads(line) for line in text.splitlines()]
+    assert len(records) == 12
+    assert len({record["connection"] for record in records}) == 3
+
+    output = tmp_path.joinpath("replay.json")
+    main([str(capture), "--connections=2", "--speed=0", f"--output={output}"])
+    summary = json.loads(output.read_text())
+    assert summary["requests"] == 12
+    assert summary["replies"] == 9
+    assert summary["commands"]["L"]["replies"] == 6
+    assert summary["commands"]["I"]["replies"] == 3
+    assert summary["latency_p50"] <= summary["latency_p99"]
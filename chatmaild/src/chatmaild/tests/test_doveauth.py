@@ -1,15 +1,24 @@
+import asyncio
 import io
 import json
+import os
 import queue
 import threading
+import time
 import traceback
 
 import pytest
 
 import chatmaild.doveauth
+import chatmaild.user
 from chatmaild.doveauth import (
     AuthDictProxy,
+    TemporaryFailure,
+    UserdbCache,
+    encrypt_password,
     is_allowed_to_create,
+    password_hash_params,
+    split_and_unescape,
 )
 from chatmaild.newemail import create_newemail_dict
 
@@ -39,6 +48,78 @@ def test_iterate_addresses(dictproxy):
     assert set(res) == set(addresses)
 
 
+def test_userdb_cache(dictproxy, monkeypatch):
+    addr = "asdf12345@chat.example.org"
+    dictproxy.lookup_passdb(addr, "q9mr3faue")
+    reads = []
+    orig = chatmaild.user.User.get_userdb_dict
+
+    def get_userdb_dict(user):
+        reads.append(user.addr)
+        return orig(user)
+
+    monkeypatch.setattr(chatmaild.user.User, "get_userdb_dict", get_userdb_dict)
+    res = dictproxy.handle_lookup([f"shared/userdb/{addr}", addr])
+    assert res == f"O{json.dumps(dictproxy.lookup_userdb(addr))}\n"
+    assert dictproxy.lookup_passdb(addr, "q9mr3faue")
+    assert reads == []
+
+    # recording a login does not invalidate the cache
+    user = dictproxy.config.get_user(addr)
+    user.set_last_login_timestamp(time.time())
+    dictproxy.lookup_userdb(addr)
+    user.set_last_login_timestamp(time.time() - 86400 * 3)
+    dictproxy.lookup_userdb(addr)
+    assert reads == [addr]
+
+    # changing the password does
+    user.set_password(encrypt_password("newpassword"))
+    assert dictproxy.lookup_userdb(addr)["password"].startswith("{SHA512-CRYPT}")
+    assert reads == [addr, addr]
+    user.password_path.unlink()
+    assert not dictproxy.lookup_userdb(addr)
+
+
+def test_userdb_cache_bounded():
+    cache = UserdbCache(maxsize=2)
+    cache.put("a", 1, dict(addr="a"))
+    cache.put("b", 1, dict(addr="b"))
+    assert cache.get("a", 1) == (dict(addr="a"), '{"addr": "a"}')
+    cache.put("c", 1, dict(addr="c"))
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 2) is None
+    assert list(cache.entries) == ["a", "c"]
+
+
+def test_unknown_accounts_not_read(example_config, monkeypatch):
+    existing = "asdf12345@chat.example.org"
+    AuthDictProxy(config=example_config).lookup_passdb(existing, "q9mr3faue")
+    dictproxy = AuthDictProxy(config=example_config)
+    reads = []
+    monkeypatch.setattr(chatmaild.doveauth, "password_signature", reads.append)
+
+    # inadmissible addresses and too short passwords
+    for addr in ["a@chat.example.org", "x/y123456@chat.example.org"]:
+        assert not dictproxy.lookup_passdb(addr, "q9mr3faue")
+        assert addr in dictproxy.negative_cache
+    assert not dictproxy.lookup_passdb("unknown12@chat.example.org", "short")
+    assert reads == []
+
+    # the filter of existing accounts was built on startup
+    dictproxy.lookup_passdb(existing, "q9mr3faue")
+    assert reads
+
+
+def test_account_created_elsewhere(example_config):
+    dictproxy = AuthDictProxy(config=example_config)
+    addr = "asdf12345@chat.example.org"
+    AuthDictProxy(config=example_config).lookup_passdb(addr, "q9mr3faue")
+    assert addr not in dictproxy.account_filter
+    password = dictproxy.config.get_user(addr).password_path.read_text()
+    assert dictproxy.lookup_passdb(addr, "q9mr3faue")["password"] == password
+    assert addr in dictproxy.account_filter
+
+
 def test_invalid_username_length(example_config):
     config = example_config
     config.username_min_length = 6
@@ -72,6 +153,29 @@ def test_nocreate_file(monkeypatch, tmpdir, dictproxy):
     assert not dictproxy.lookup_userdb("newuser12@chat.example.org")
 
 
+def test_nocreate_file_checked_once_per_ttl(monkeypatch, tmp_path, dictproxy):
+    p = tmp_path.joinpath("nocreate")
+    monkeypatch.setattr(chatmaild.doveauth, "NOCREATE_FILE", str(p))
+    stats = []
+    exists = os.path.exists
+    monkeypatch.setattr(
+        os.path, "exists", lambda path: stats.append(path) or exists(path)
+    )
+
+    for i in range(3):
+        addr = f"newuser{i:02d}@chat.example.org"
+        dictproxy.lookup_passdb(addr, "zequ0Aimuchoodaechik")
+        assert dictproxy.lookup_userdb(addr)
+    assert stats.count(str(p)) == 1
+
+    p.write_text("")
+    dictproxy.lookup_passdb("newuser03@chat.example.org", "zequ0Aimuchoodaechik")
+    assert dictproxy.lookup_userdb("newuser03@chat.example.org")
+    dictproxy.nocreate_expires = 0
+    dictproxy.lookup_passdb("newuser04@chat.example.org", "zequ0Aimuchoodaechik")
+    assert not dictproxy.lookup_userdb("newuser04@chat.example.org")
+
+
 def test_handle_dovecot_request(dictproxy):
     transactions = {}
     # Test that password can contain ", ', \ and /
@@ -120,6 +224,64 @@ def test_handle_dovecot_protocol_iterate(gencreds, example_config):
     assert not lines[2]
 
 
+def test_iterate_flags_and_limits(dictproxy):
+    addrs = [f"asdf0000{i}@chat.example.org" for i in range(5)]
+    for addr in reversed(addrs):
+        dictproxy.lookup_passdb(addr, "q9mr3faue")
+
+    def iterate(msg):
+        res = dictproxy.handle_dovecot_request(msg, {})
+        return "".join([res] if isinstance(res, str) else res).split("\n")
+
+    lines = iterate("I2\t0\tshared/userdb/")
+    assert lines == [f"Oshared/userdb/{addr}\t" for addr in addrs] + ["", ""]
+    lines = iterate("I2\t3\tshared/userdb/")
+    assert lines == [f"Oshared/userdb/{addr}\t" for addr in addrs[:3]] + ["", ""]
+    assert len(iterate("I0\t2\tshared/userdb/")) == 4
+    assert iterate("I16\t0\tshared/userdb/") == ["", ""]
+    assert iterate("I0\t0\tshared/other/") == ["", ""]
+
+    # Dovecot >=2.3.17 sends the username, older versions no row limit
+    lines = iterate(f"I2\t0\tshared/userdb/\t{addrs[0]}")
+    assert lines == [f"Oshared/userdb/{addr}\t" for addr in addrs] + ["", ""]
+    assert len(iterate("I2\tshared/userdb/")) == 7
+
+
+def test_iterate_streamed(tmp_path, dictproxy):
+    dictproxy.iterate_chunk_size = 3
+    addrs = {f"asdf{i:05d}@chat.example.org" for i in range(20)}
+    for addr in addrs:
+        dictproxy.lookup_passdb(addr, "q9mr3faue")
+    socket = str(tmp_path.joinpath("auth.socket"))
+    chunks = []
+
+    def write(data):
+        chunks.append(data)
+
+    dictproxy.handle_requests(["I0\t0\tshared/userdb/"], {}, write=write)
+    assert len(chunks) == 8
+
+    async def run():
+        serve_task = asyncio.create_task(dictproxy.serve_from_socket(socket))
+        while not tmp_path.joinpath("auth.socket").exists():
+            await asyncio.sleep(0.01)
+        reader, writer = await asyncio.open_unix_connection(socket)
+        addr = min(addrs)
+        writer.write(f"I0\t0\tshared/userdb/\nLshared/userdb/{addr}\t{addr}\n".encode())
+        lines = []
+        while not lines or lines[-1][:1] != b"O" or b"{" not in lines[-1]:
+            lines.append(await reader.readline())
+        writer.close()
+        serve_task.cancel()
+        return lines
+
+    lines = asyncio.run(run())
+    users = {line.decode()[len("Oshared/userdb/") : -2] for line in lines[:20]}
+    assert users == addrs
+    assert lines[20] == b"\n"
+    assert json.loads(lines[21][1:])["home"]
+
+
 def test_50_concurrent_lookups_different_accounts(gencreds, dictproxy):
     num_threads = 50
     req_per_thread = 5
@@ -129,7 +291,13 @@ def test_50_concurrent_lookups_different_accounts(gencreds, dictproxy):
         for i in range(req_per_thread):
             addr, password = gencreds()
             try:
-                dictproxy.lookup_passdb(addr, password)
+                while True:
+                    try:
+                        dictproxy.lookup_passdb(addr, password)
+                        break
+                    except TemporaryFailure:
+                        # dovecot retries when too many accounts are created
+                        time.sleep(0.01)
             except Exception:
                 results.put(traceback.format_exc())
             else:
@@ -148,3 +316,97 @@ def test_50_concurrent_lookups_different_accounts(gencreds, dictproxy):
         res = results.get()
         if res is not None:
             pytest.fail(f"concurrent lookup failed\n{res}")
+
+
+def test_account_creation_limit(dictproxy):
+    existing = "asdf12345@chat.example.org"
+    assert dictproxy.lookup_passdb(existing, "q9mr3faue")
+
+    # all creation slots are taken
+    for _ in range(dictproxy.max_pending_creations):
+        dictproxy.hash_pool.slots.acquire()
+    addr = "newuser12@chat.example.org"
+    res = dictproxy.handle_lookup([f'shared/passdb/q9mr3faue1"{addr}', addr])
+    assert res == "F\n"
+    res = dictproxy.handle_lookup([f'shared/passdb/q9mr3faue"{existing}', existing])
+    assert res[0] == "O"
+
+    dictproxy.hash_pool.slots.release()
+    res = dictproxy.handle_lookup([f'shared/passdb/q9mr3faue1"{addr}', addr])
+    assert res[0] == "O"
+    dictproxy.hash_pool.shutdown()
+
+
+@pytest.mark.parametrize(
+    ("scheme", "rounds", "expected"),
+    [
+        ("SHA512-CRYPT", None, 5000),
+        ("SHA512-CRYPT", 6000, 6000),
+        ("SHA256-CRYPT", 1000, 1000),
+        ("BLF-CRYPT", 16, 16),
+    ],
+)
+def test_encrypt_password(scheme, rounds, expected):
+    enc_password = encrypt_password("q9mr3faue", scheme, rounds)
+    assert enc_password.startswith("{" + scheme + "}$")
+    assert password_hash_params(enc_password) == (scheme, expected)
+
+
+def test_rehash_on_login(dictproxy):
+    addr = "asdf12345@chat.example.org"
+    old_password = dictproxy.lookup_passdb(addr, "q9mr3faue")["password"]
+    assert password_hash_params(old_password) == ("SHA512-CRYPT", 5000)
+
+    dictproxy.config.password_hash_scheme = "SHA256-CRYPT"
+    dictproxy.config.password_hash_rounds = 1000
+    # wrong passwords do not change the hash
+    assert dictproxy.lookup_passdb(addr, "wrongpassword")["password"] == old_password
+    assert addr in dictproxy.failed_rehashes
+    dictproxy.failed_rehashes.entries.clear()
+
+    new_password = dictproxy.lookup_passdb(addr, "q9mr3faue")["password"]
+    assert password_hash_params(new_password) == ("SHA256-CRYPT", 1000)
+    user = dictproxy.config.get_user(addr)
+    assert user.password_path.read_text() == new_password
+    assert dictproxy.lookup_passdb(addr, "q9mr3faue")["password"] == new_password
+
+    # rehashing is skipped while its slots are taken,
+    # which leaves the other slots to account creation
+    dictproxy.config.password_hash_rounds = 2000
+    for _ in range(dictproxy.max_pending_rehashes):
+        dictproxy.hash_pool.rehash_slots.acquire()
+    assert dictproxy.lookup_passdb(addr, "q9mr3faue")["password"] == new_password
+    assert addr not in dictproxy.failed_rehashes
+    newaddr = "newuser12@chat.example.org"
+    assert dictproxy.lookup_passdb(newaddr, "q9mr3faue")
+    for _ in range(dictproxy.max_pending_rehashes):
+        dictproxy.hash_pool.rehash_slots.release()
+    new_password = dictproxy.lookup_passdb(addr, "q9mr3faue")["password"]
+    assert password_hash_params(new_password) == ("SHA256-CRYPT", 2000)
+
+    # logins succeed even if rehashing fails
+    dictproxy.config.password_hash_scheme = "BLF-CRYPT"
+    dictproxy.config.password_hash_rounds = 1000
+    assert dictproxy.lookup_passdb(addr, "q9mr3faue")["password"] == new_password
+    assert addr in dictproxy.failed_rehashes
+    dictproxy.hash_pool.shutdown()
+
+
+@pytest.mark.parametrize(
+    ("scheme", "rounds"), [("BLF-CRYPT", 1000), ("SHA512-CRYPT", 1), ("MD5", None)]
+)
+def test_invalid_password_hash_config(example_config, scheme, rounds):
+    example_config.password_hash_scheme = scheme
+    example_config.password_hash_rounds = rounds
+    with pytest.raises(ValueError):
+        AuthDictProxy(config=example_config)
+
+
+def test_split_and_unescape():
+    assert list(split_and_unescape('pass\\"word\\\\"user@example.org')) == [
+        'pass"word\\',
+        "user@example.org",
+    ]
+    assert list(split_and_unescape("")) == [""]
+    with pytest.raises(IndexError):
+        list(split_and_unescape("password\\"))
@@ -1,12 +1,33 @@
+import asyncio
+import base64
+import multiprocessing
+import os
+import socket
+import time
+import tracemalloc
+from email import policy
+
 import pytest
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import Envelope
 
 from chatmaild.filtermail import (
+    SCAN_CHUNK_SIZE,
     BeforeQueueHandler,
+    FiltermailSMTP,
+    LazyBase64,
     SendRateLimiter,
+    SharedSendRateLimiter,
     check_armored_payload,
     check_encrypted,
+    check_encrypted_fast,
+    clean_submission_headers,
     is_securejoin,
+    scan_message,
+    split_headers,
 )
+from chatmaild.smtpclient import SMTPConnection, SMTPReplyError
+from chatmaild.spool import MessageSpool
 
 
 @pytest.fixture
@@ -208,16 +229,16 @@ UN4fiB0KR9JyG2ayUdNJVkXZSZLnHyRgiaadlpUo16LVvw==\r
 \r
 """
 
-    assert check_armored_payload(payload) == True
+    assert check_armored_payload(payload.encode()) == True
 
     payload = payload.removesuffix("\r\n")
-    assert check_armored_payload(payload) == True
+    assert check_armored_payload(payload.encode()) == True
 
     payload = payload.removesuffix("\r\n")
-    assert check_armored_payload(payload) == True
+    assert check_armored_payload(payload.encode()) == True
 
     payload = payload.removesuffix("\r\n")
-    assert check_armored_payload(payload) == True
+    assert check_armored_payload(payload.encode()) == True
 
     payload = """-----BEGIN PGP MESSAGE-----\r
 \r
@@ -225,7 +246,7 @@ HELLOWORLD
 -----END PGP MESSAGE-----\r
 \r
 """
-    assert check_armored_payload(payload) == False
+    assert check_armored_payload(payload.encode()) == False
 
     payload = """-----BEGIN PGP MESSAGE-----\r
 \r
@@ -233,4 +254,645 @@ HELLOWORLD
 -----END PGP MESSAGE-----\r
 \r
 """
-    assert check_armored_payload(payload) == False
+    assert check_armored_payload(payload.encode()) == False
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "encrypted.eml",
+        "fake-encrypted.eml",
+        "literal.eml",
+        "mdn.eml",
+        "plain.eml",
+        "securejoin-vc.eml",
+        "securejoin-vc-fake.eml",
+    ],
+)
+def test_scan_message_matches_full_parse(maildata, name):
+    msg = maildata(name, from_addr="1@example.org", to_addr="2@example.org")
+    content = msg.as_bytes(policy=policy.SMTP)
+    headers, body_start = split_headers(content)
+    fast = check_encrypted_fast(headers, content, body_start)
+    assert fast in (check_encrypted(msg), None)
+
+    message, mail_encrypted = scan_message(content)
+    assert mail_encrypted == check_encrypted(msg)
+    assert message.get("from") == msg.get("from")
+
+
+def test_scan_message_fast_path(maildata):
+    msg = maildata("encrypted.eml", from_addr="1@example.org", to_addr="2@example.org")
+    content = msg.as_bytes(policy=policy.SMTP)
+    headers, body_start = split_headers(content)
+    assert check_encrypted_fast(headers, content, body_start) is True
+
+    msg = maildata("plain.eml", from_addr="1@example.org", to_addr="2@example.org")
+    content = msg.as_bytes(policy=policy.SMTP)
+    headers, body_start = split_headers(content)
+    assert check_encrypted_fast(headers, content, body_start) is False
+
+
+def test_scan_message_fallback(maildata):
+    msg = maildata("encrypted.eml", from_addr="1@example.org", to_addr="2@example.org")
+    content = msg.as_bytes(policy=policy.SMTP)
+    headers, body_start = split_headers(content)
+    body = content[body_start:]
+
+    # a bare LF could be a line break for the full parser
+    assert (
+        check_encrypted_fast(headers, body.replace(b"Version: 1\r\n", b"Version: 1\n"))
+        is None
+    )
+
+    # a line starting with the boundary which is not a delimiter line
+    boundary = headers.get_boundary().encode()
+    forged = body.replace(b"\r\n--" + boundary, b"\r\n--" + boundary + b"x", 1)
+    assert check_encrypted_fast(headers, forged) is None
+
+    # missing close delimiter
+    assert check_encrypted_fast(headers, body.rpartition(b"\r\n--")[0]) is None
+
+    assert split_headers(content.replace(b"\r\n", b"\n")) is None
+    message, _ = scan_message(content.replace(b"\r\n", b"\n"))
+    assert message.is_multipart()
+
+
+def test_check_workers(maildata, gencreds, make_config, maildomain):
+    config = make_config(maildomain, dict(filtermail_workers="2"))
+    assert config.filtermail_workers == 2
+    handler = BeforeQueueHandler(config)
+
+    from_addr = gencreds()[0]
+    to_addr = "somebody@example.org"
+    plain = maildata("plain.eml", from_addr=from_addr, to_addr=to_addr)
+    encrypted = maildata("encrypted.eml", from_addr=from_addr, to_addr=to_addr)
+
+    def envelope(msg):
+        env = Envelope()
+        env.mail_from = from_addr
+        env.rcpt_tos = [to_addr]
+        env.content = msg.as_bytes(policy=policy.SMTP)
+        return env
+
+    async def check_all():
+        return await asyncio.gather(
+            handler.run_check_DATA(envelope(plain)),
+            handler.run_check_DATA(envelope(encrypted)),
+        )
+
+    try:
+        rejected, accepted = asyncio.run(check_all())
+    finally:
+        handler.shutdown()
+    assert rejected.startswith("500")
+    assert accepted is None
+
+    # metrics collected in the workers are moved to the serving process
+    metrics = handler.metrics
+    assert metrics.mails.get("encrypted") == metrics.mails.get("unencrypted") == 1
+    assert metrics.rejected.get("unencrypted") == 1
+    assert metrics.parse_seconds.count == 2
+
+
+def test_check_workers_exit_with_filtermail(maildata, make_config, maildomain):
+    config = make_config(maildomain, dict(filtermail_workers="2"))
+    msg = maildata("plain.eml", from_addr="a@x.org", to_addr="b@x.org")
+    reader, writer = multiprocessing.Pipe(duplex=False)
+
+    def serve_killed():
+        handler = BeforeQueueHandler(config)
+        env = Envelope()
+        env.mail_from = "a@x.org"
+        env.rcpt_tos = ["b@x.org"]
+        env.content = msg.as_bytes(policy=policy.SMTP)
+        asyncio.run(handler.run_check_DATA(env))
+        writer.send([p.pid for p in handler.check_executor._processes.values()])
+        # like a filtermail process which is killed
+        os._exit(0)
+
+    process = multiprocessing.get_context("fork").Process(target=serve_killed)
+    process.start()
+    pids = reader.recv()
+    process.join()
+    assert pids
+    deadline = time.time() + 10
+    while any(map(is_running, pids)) and time.time() < deadline:
+        time.sleep(0.05)
+    assert not any(map(is_running, pids))
+
+
+def is_running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # zombies are not reaped by every init
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_metrics(maildata, gencreds, make_config, maildomain):
+    config = make_config(maildomain, dict(max_user_send_per_minute="0"))
+    handler = BeforeQueueHandler(config)
+    from_addr = gencreds()[0]
+    env = Envelope()
+
+    async def mail_from(addr):
+        return await handler.handle_MAIL(None, None, env, addr, [])
+
+    assert asyncio.run(mail_from(from_addr)).startswith("250")
+    assert asyncio.run(mail_from(from_addr)).startswith("450")
+    assert asyncio.run(mail_from("invalid")).startswith("500")
+    assert handler.metrics.rate_limited.get() == 1
+    assert handler.metrics.rejected.get("invalid_sender") == 1
+
+    env.mail_from = from_addr
+    env.rcpt_tos = ["somebody@example.org"]
+    msg = maildata("plain.eml", from_addr="forged@example.org", to_addr="x@y.org")
+    env.content = msg.as_bytes(policy=policy.SMTP)
+    assert handler.check_DATA(env).startswith("500")
+    assert handler.metrics.rejected.get("invalid_from") == 1
+    assert handler.metrics.parse_seconds.count == 1
+
+    text = handler.metrics.registry.render()
+    assert 'filtermail_rejected_total{reason="invalid_from"} 1' in text
+    assert "filtermail_rate_limited_total 1" in text
+    assert "filtermail_check_seconds_count 0" in text
+
+
+def armor(data, line_len=64):
+    encoded = base64.b64encode(data).decode()
+    lines = [encoded[i : i + line_len] for i in range(0, len(encoded), line_len)]
+    return "\r\n".join(
+        ["-----BEGIN PGP MESSAGE-----", ""]
+        + lines
+        + ["=AAAA", "-----END PGP MESSAGE-----", ""]
+    ).encode()
+
+
+@pytest.mark.parametrize("seipd_len", [1000, 1001, 1002, 300000])
+def test_check_armored_payload_lazy(seipd_len):
+    pkesk = bytes([0xC1, 10]) + os.urandom(10)
+    seipd = bytes([0xD2, 0xFF]) + seipd_len.to_bytes(4, "big") + os.urandom(seipd_len)
+    data = pkesk + seipd
+
+    payload = armor(data)
+    start = payload.index(b"\r\n\r\n") + 4
+    lazy = LazyBase64.from_lines(payload, start, payload.rindex(b"=AAAA"))
+    assert len(lazy) == len(data)
+    assert bytes(lazy[i] for i in range(20)) == data[:20]
+    assert check_armored_payload(payload)
+    assert check_armored_payload(armor(data, line_len=76))
+
+    # truncated or overlong SEIPD packets
+    assert not check_armored_payload(armor(data[:-1]))
+    assert not check_armored_payload(armor(data + b"x"))
+
+    # irregular lines are decoded fully
+    head, body = payload.split(b"\r\n\r\n", 1)
+    irregular = head + b"\r\n\r\n" + body.replace(b"\r\n", b"", 1)
+    assert not LazyBase64.from_lines(irregular, start, irregular.rindex(b"=AAAA"))
+    assert check_armored_payload(irregular)
+    assert not check_armored_payload(armor(pkesk[:-1] + seipd))
+
+    # irregular line lengths with the same total length as regular lines
+    lines = payload.split(b"\r\n")
+    lines[3:5] = [lines[3][:-4], lines[3][-4:] + lines[4]]
+    irregular = b"\r\n".join(lines)
+    assert len(irregular) == len(payload)
+    assert not LazyBase64.from_lines(irregular, start, irregular.rindex(b"=AAAA"))
+    assert check_armored_payload(irregular)
+
+
+def test_check_armored_payload_forged_header():
+    # a SEIPD header followed by cleartext which is not base64
+    line_len = 76
+    num_lines = 20
+    header = base64.b64encode(
+        bytes([0xD2, 0xFF]) + (num_lines * line_len // 4 * 3 - 6).to_bytes(4, "big")
+    )
+    text = b"Hello, this is cleartext which should not pass as encrypted mail! "
+    body = (header + text * (num_lines * line_len // len(text) + 1))[
+        : num_lines * line_len
+    ]
+    lines = [body[i : i + line_len] for i in range(0, len(body), line_len)]
+    payload = b"\r\n".join(
+        [b"-----BEGIN PGP MESSAGE-----", b""]
+        + lines
+        + [b"=AAAA", b"-----END PGP MESSAGE-----", b""]
+    )
+    start = payload.index(b"\r\n\r\n") + 4
+    assert not LazyBase64.from_lines(payload, start, payload.rindex(b"=AAAA"))
+    assert not check_armored_payload(payload)
+
+    # padding and line breaks are only allowed at the ends of lines
+    data = bytes([0xD2, 0xFF]) + (1000).to_bytes(4, "big") + os.urandom(1000)
+    payload = armor(data)
+    pos = payload.index(b"\r\n\r\n") + 40
+    for chars in (b"====", b"AA\rA", b"A\nAA"):
+        changed = payload[:pos] + chars + payload[pos + 4 :]
+        start = changed.index(b"\r\n\r\n") + 4
+        assert not LazyBase64.from_lines(changed, start, changed.rindex(b"=AAAA"))
+        assert not check_armored_payload(changed)
+
+
+def test_scan_spooled_message_memory(tmp_path):
+    seipd_len = 20 * 1024 * 1024
+    seipd = bytes([0xD2, 0xFF]) + seipd_len.to_bytes(4, "big") + os.urandom(seipd_len)
+    content = (
+        b"From: 1@example.org\r\n"
+        b"To: 2@example.org\r\n"
+        b'Content-Type: multipart/encrypted; boundary="XYZ"\r\n'
+        b"\r\n"
+        b"--XYZ\r\n"
+        b"Content-Type: application/pgp-encrypted\r\n"
+        b"\r\n"
+        b"Version: 1\r\n"
+        b"--XYZ\r\n"
+        b"Content-Type: application/octet-stream\r\n"
+        b"\r\n" + armor(bytes([0xC1, 10]) + os.urandom(10) + seipd) + b"\r\n"
+        b"--XYZ--\r\n"
+    )
+    spool = MessageSpool(threshold=1024)
+    spool.write(content)
+    del content, seipd
+
+    tracemalloc.start()
+    try:
+        message, mail_encrypted = scan_message(spool.getvalue())
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        spool.close()
+    assert mail_encrypted
+    assert message.get("from") == "1@example.org"
+    # only pieces of the spooled message are read into memory
+    assert peak < 3 * SCAN_CHUNK_SIZE
+
+
+@pytest.mark.parametrize(("processes", "maxsize"), [(1, 10), (3, 3), (20, 1)])
+def test_reinject_pool_size(make_config, processes, maxsize):
+    config = make_config(
+        "chatmail.example.org", dict(filtermail_processes=str(processes))
+    )
+    handler = BeforeQueueHandler(config)
+    assert handler.reinject_pool.maxsize == maxsize
+
+
+def test_send_rate_limiter_window(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, "time", lambda: now)
+    limiter = SendRateLimiter()
+    for i in range(11):
+        assert limiter.is_sending_allowed("some@example.org", 10)
+        now += 3
+    assert not limiter.is_sending_allowed("some@example.org", 10)
+    assert limiter.is_sending_allowed("other@example.org", 10)
+
+    # the first sent mail leaves the window after 60 seconds
+    now = 1060.0
+    assert limiter.is_sending_allowed("some@example.org", 10)
+    assert not limiter.is_sending_allowed("some@example.org", 10)
+
+    # idle senders are dropped by the periodic sweep
+    now = 1200.0
+    limiter.is_sending_allowed("third@example.org", 10)
+    assert list(limiter.addr2window) == ["third@example.org"]
+
+
+def test_shared_send_rate_limiter():
+    limiter = SharedSendRateLimiter(num_buckets=16)
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+
+    def send():
+        for _ in range(10):
+            results.put(limiter.is_sending_allowed("some@example.org", 19))
+
+    processes = [ctx.Process(target=send) for _ in range(4)]
+    for process in processes:
+        process.start()
+    allowed = [results.get(timeout=10) for _ in range(40)]
+    for process in processes:
+        process.join()
+    assert allowed.count(True) == 20
+    assert not limiter.is_sending_allowed("some@example.org", 19)
+    assert limiter.is_sending_allowed("other@example.org", 19)
+
+
+def test_shared_send_rate_limiter_eviction(monkeypatch, caplog):
+    now = 1000.0
+    monkeypatch.setattr(time, "time", lambda: now)
+    limiter = SharedSendRateLimiter(num_buckets=1)
+    for i in range(limiter.BUCKET_SLOTS):
+        assert limiter.is_sending_allowed(f"user{i}@example.org", 0)
+        assert not limiter.is_sending_allowed(f"user{i}@example.org", 0)
+        now += 1
+    assert not caplog.records
+
+    # the least recently active sender is evicted
+    assert limiter.is_sending_allowed("new@example.org", 0)
+    assert "full" in caplog.records[0].msg
+    assert limiter.is_sending_allowed("user0@example.org", 0)
+
+    # idle senders make room without eviction
+    now += 60
+    assert limiter.is_sending_allowed("other@example.org", 0)
+    assert len(caplog.records) == 2
+
+
+async def with_filtermail_connection(handler, func):
+    """Run `func` with a client connection to a filtermail server."""
+    server = await asyncio.get_running_loop().create_server(
+        lambda: FiltermailSMTP(
+            handler, data_size_limit=handler.config.max_message_size
+        ),
+        host="127.0.0.1",
+        port=0,
+    )
+    port = server.sockets[0].getsockname()[1]
+    conn = await SMTPConnection.connect("127.0.0.1", port)
+    try:
+        return await func(conn)
+    finally:
+        conn.close()
+        server.close()
+
+
+@pytest.mark.parametrize("workers", ["0", "1"])
+def test_spooled_data(maildata, gencreds, make_config, maildomain, workers):
+    class SinkHandler:
+        contents = []
+
+        async def handle_DATA(self, server, session, envelope):
+            self.contents.append(envelope.content)
+            return "250 OK"
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        sink_port = sock.getsockname()[1]
+    sink = SinkHandler()
+    controller = Controller(sink, hostname="127.0.0.1", port=sink_port)
+    controller.start()
+    config = make_config(
+        maildomain,
+        dict(
+            postfix_reinject_port=str(sink_port),
+            filtermail_spool_threshold="100",
+            filtermail_workers=workers,
+        ),
+    )
+    handler = BeforeQueueHandler(config)
+
+    from_addr = gencreds()[0]
+    to_addr = "somebody@example.org"
+    encrypted = maildata("encrypted.eml", from_addr=from_addr, to_addr=to_addr)
+    plain = maildata("plain.eml", from_addr=from_addr, to_addr=to_addr)
+    encrypted = encrypted.as_bytes(policy=policy.SMTP)
+    # a body line starting with a period is dot-stuffed on the wire
+    plain = plain.as_bytes(policy=policy.SMTP) + b".signature\r\n" * 1000
+
+    async def send_all(conn):
+        await conn.sendmail(from_addr, [to_addr], encrypted)
+        with pytest.raises(SMTPReplyError) as excinfo:
+            await conn.sendmail(from_addr, [to_addr], plain)
+        return excinfo.value
+
+    try:
+        error = asyncio.run(with_filtermail_connection(handler, send_all))
+    finally:
+        controller.stop()
+        if handler.check_executor is not None:
+            handler.check_executor.shutdown()
+
+    assert sink.contents == [encrypted]
+    assert error.code == 500 and "unencrypted" in error.text
+    # the cleartext mail was rejected from its headers without a full check
+    assert handler.metrics.rejected.get("unencrypted") == 1
+    assert handler.metrics.mails.get("unencrypted") == 1
+    assert handler.metrics.parse_seconds.count == 1
+
+
+def test_load_limits(maildata, gencreds, make_config, maildomain):
+    config = make_config(
+        maildomain,
+        dict(filtermail_max_inflight_checks="1", filtermail_max_buffered_bytes="2000"),
+    )
+    handler = BeforeQueueHandler(config)
+    from_addr = gencreds()[0]
+    msg = maildata("plain.eml", from_addr=from_addr, to_addr=from_addr)
+    content = msg.as_bytes(policy=policy.SMTP) + b"x" * 998 + b"\r\n"
+
+    async def send(conn):
+        with pytest.raises(SMTPReplyError) as excinfo:
+            await conn.sendmail(from_addr, [from_addr], content * 2)
+        assert excinfo.value.code == 451
+        await conn.rset()
+        assert handler.buffered_bytes == 0
+
+        # the DATA command is refused while too many mails are checked
+        handler.inflight_checks = 1
+        await conn.expect(250, conn.command(f"MAIL FROM:<{from_addr}>"))
+        await conn.expect(250, conn.command(f"RCPT TO:<{from_addr}>"))
+        code, text = await conn.command("DATA")
+        assert code == 451
+        await conn.rset()
+        handler.inflight_checks = 0
+
+    asyncio.run(with_filtermail_connection(handler, send))
+    assert handler.metrics.rejected.get("overload") == 2
+
+
+def test_max_message_size(maildata, gencreds, make_config, maildomain):
+    config = make_config(maildomain, dict(max_message_size="5000"))
+    handler = BeforeQueueHandler(config)
+    from_addr = gencreds()[0]
+    msg = maildata("plain.eml", from_addr=from_addr, to_addr=from_addr)
+    content = msg.as_bytes(policy=policy.SMTP) + (b"x" * 998 + b"\r\n") * 10
+
+    async def send(conn):
+        assert "SIZE 5000" in await conn.expect(250, conn.command("EHLO localhost"))
+        code, _ = await conn.command(f"MAIL FROM:<{from_addr}> SIZE=5001")
+        assert code == 552
+
+        with pytest.raises(SMTPReplyError) as excinfo:
+            await conn.sendmail(from_addr, [from_addr], content)
+        assert excinfo.value.code == 552
+        assert handler.buffered_bytes == 0
+        # the rest of DATA was drained and the connection can be used
+        await conn.rset()
+        await conn.expect(250, conn.command(f"MAIL FROM:<{from_addr}>"))
+
+    asyncio.run(with_filtermail_connection(handler, send))
+    assert handler.metrics.rejected.get("too_big") == 1
+    assert handler.buffered_bytes == 0
+
+
+def test_clean_submission_headers():
+    content = (
+        b"Received: from client\r\n\tby chatmail\r\n"
+        b"From: <a@example.org>\r\n"
+        b"Subject: secret\r\n continued\r\n"
+        b"User-Agent: x\r\n"
+        b"\r\n"
+        b"Received: in the body\r\n"
+    )
+    headers, body_start = clean_submission_headers(content)
+    assert headers == b"From: <a@example.org>\r\nSubject: [...]\r\n\r\n"
+    assert content[body_start:] == b"Received: in the body\r\n"
+    assert clean_submission_headers(b"From: <a@example.org>\n\nbody\n") is None
+
+
+@pytest.fixture
+def lmtp_server(tmp_path):
+    """Minimal LMTP server on a unix socket which replies for each recipient."""
+
+    class LMTPServer:
+        path = str(tmp_path.joinpath("lmtp.sock"))
+        delivered = []
+
+        async def handle(self, reader, writer):
+            async def reply(line):
+                writer.write(line.encode() + b"\r\n")
+                await writer.drain()
+
+            await reply("220 localhost LMTP")
+            rcpt_tos = []
+            while line := await reader.readline():
+                command = line.decode().strip()
+                if command.startswith("LHLO"):
+                    await reply("250 localhost")
+                elif command.startswith(("MAIL", "RSET")):
+                    rcpt_tos = []
+                    await reply("250 OK")
+                elif command.startswith("RCPT"):
+                    rcpt = command.split("<")[1].rstrip(">")
+                    if rcpt.startswith("unknown@"):
+                        await reply("550 5.1.1 User doesn't exist")
+                    else:
+                        rcpt_tos.append(rcpt)
+                        await reply("250 OK")
+                elif command == "DATA":
+                    await reply("354 OK")
+                    data = b""
+                    while (line := await reader.readline()) != b".\r\n":
+                        data += line
+                    for rcpt in rcpt_tos:
+                        if rcpt.startswith("full@"):
+                            await reply("552 5.2.2 Quota exceeded")
+                        else:
+                            self.delivered.append((rcpt, data))
+                            await reply("250 OK")
+            writer.close()
+
+    return LMTPServer()
+
+
+@pytest.fixture
+def reinject_sink():
+    class SinkHandler:
+        envelopes = []
+
+        async def handle_DATA(self, server, session, envelope):
+            self.envelopes.append(envelope)
+            return "250 OK"
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    sink = SinkHandler()
+    sink.port = port
+    controller = Controller(sink, hostname="127.0.0.1", port=port)
+    controller.start()
+    yield sink
+    controller.stop()
+
+
+def test_reinject_refused(make_config, maildomain):
+    class RefusingHandler:
+        async def handle_RCPT(self, server, session, envelope, address, options):
+            if address.startswith("refused@"):
+                return "550 5.1.1 unknown recipient"
+            envelope.rcpt_tos.append(address)
+            return "250 OK"
+
+        async def handle_DATA(self, server, session, envelope):
+            if "reject@example.org" in envelope.rcpt_tos:
+                return "554-5.7.1 first line\r\n554 5.7.1 last line"
+            return "250 OK"
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    controller = Controller(RefusingHandler(), hostname="127.0.0.1", port=port)
+    controller.start()
+    config = make_config(maildomain, dict(postfix_reinject_port=str(port)))
+    handler = BeforeQueueHandler(config)
+    env = Envelope()
+    env.mail_from = "a@example.org"
+    env.content = b"Subject: test\r\n\r\nbody\r\n"
+
+    async def reinject():
+        try:
+            accepted = await handler.reinject(
+                env, ["b@example.org", "refused@example.org"]
+            )
+            rejected = await handler.reinject(env, ["reject@example.org"])
+            return accepted, rejected
+        finally:
+            handler.reinject_pool.close()
+
+    try:
+        accepted, rejected = asyncio.run(reinject())
+    finally:
+        controller.stop()
+    assert accepted == "250 OK"
+    assert rejected == "554 5.7.1 last line"
+    assert handler.metrics.delivered.get("reinject") == 1
+    assert handler.metrics.rejected.get("reinject_refused") == 1
+
+
+def test_lmtp_delivery(
+    maildata, gencreds, make_config, maildomain, lmtp_server, reinject_sink
+):
+    config = make_config(
+        maildomain,
+        dict(
+            filtermail_lmtp_socket=lmtp_server.path,
+            postfix_reinject_port=str(reinject_sink.port),
+        ),
+    )
+    handler = BeforeQueueHandler(config)
+    from_addr = gencreds()[0]
+    msg = maildata("encrypted.eml", from_addr=from_addr, to_addr=from_addr)
+    content = b"Received: from client\r\n" + msg.as_bytes(policy=policy.SMTP)
+    local = [f"user@{maildomain}", f"full@{maildomain}", f"unknown@{maildomain}"]
+
+    async def deliver():
+        server = await asyncio.start_unix_server(lmtp_server.handle, lmtp_server.path)
+        env = Envelope()
+        env.mail_from = from_addr
+        env.content = content
+        try:
+            env.rcpt_tos = local
+            assert await handler.handle_DATA(None, None, env) == "250 OK"
+            # mail to other domains is only re-injected
+            env.rcpt_tos = [f"user@{maildomain}", "other@example.org"]
+            assert await handler.handle_DATA(None, None, env) == "250 OK"
+        finally:
+            server.close()
+
+    asyncio.run(deliver())
+
+    [(rcpt, data)] = lmtp_server.delivered
+    assert rcpt == f"user@{maildomain}"
+    assert b"Received:" not in data
+    assert b"\r\nSubject: [...]\r\n" in data
+    assert data.endswith(content.split(b"\r\n\r\n", 1)[1])
+
+    first, second = reinject_sink.envelopes
+    assert first.rcpt_tos == [f"full@{maildomain}", f"unknown@{maildomain}"]
+    assert first.content == content
+    assert second.rcpt_tos == [f"user@{maildomain}", "other@example.org"]
+    assert handler.metrics.delivered.get("lmtp") == 1
+    assert handler.metrics.delivered.get("reinject") == 4
@@ -19,7 +19,7 @@ def test_handle_dovecot_request_last_login(testaddr, example_config):
     msg = f"B{tx}\t{testaddr}"
     res = dictproxy.handle_dovecot_request(msg, dictproxy_transactions)
     assert not res
-    assert dictproxy_transactions == {tx: dict(addr=testaddr, res="O\n")}
+    assert dictproxy_transactions == {tx: dict(addr=testaddr, sets=[])}
 
     # set last-login info for user
     user = dictproxy.config.get_user(testaddr)
@@ -28,14 +28,14 @@ def test_handle_dovecot_request_last_login(testaddr, example_config):
     res = dictproxy.handle_dovecot_request(msg, dictproxy_transactions)
     assert not res
     assert len(dictproxy_transactions) == 1
-    read_timestamp = user.get_last_login_timestamp()
-    assert read_timestamp == timestamp // 86400 * 86400
 
-    # finish transaction
+    # finish transaction, which writes the set
     msg = f"C{tx}"
     res = dictproxy.handle_dovecot_request(msg, dictproxy_transactions)
     assert res == "O\n"
     assert len(dictproxy_transactions) == 0
+    read_timestamp = user.get_last_login_timestamp()
+    assert read_timestamp == timestamp // 86400 * 86400
 
 
 def test_handle_dovecot_request_last_login_echobot(example_config):
@@ -53,12 +53,48 @@ def test_handle_dovecot_request_last_login_echobot(example_config):
     msg = f"B{tx}\t{testaddr}"
     res = dictproxy.handle_dovecot_request(msg, transactions)
     assert not res
-    assert transactions == {tx: dict(addr=testaddr, res="O\n")}
+    assert transactions == {tx: dict(addr=testaddr, sets=[])}
 
     timestamp = int(time.time())
     msg = f"S{tx}\tshared/last-login/{testaddr}\t{timestamp}"
     res = dictproxy.handle_dovecot_request(msg, transactions)
     assert not res
     assert len(transactions) == 1
+    assert dictproxy.handle_dovecot_request(f"C{tx}", transactions) == "O\n"
     read_timestamp = user.get_last_login_timestamp()
     assert read_timestamp is None
+
+
+def test_async_commit_writes_latest_login(testaddr, example_config):
+    dictproxy = LastLoginDictProxy(config=example_config)
+    authproxy = AuthDictProxy(config=example_config)
+    authproxy.lookup_passdb(testaddr, "1l2k3j1l2k3jl123")
+    user = dictproxy.config.get_user(testaddr)
+
+    timestamp = int(time.time())
+    msgs = [
+        f"B1\t{testaddr}",
+        f"S1\tshared/last-login/{testaddr}\t{timestamp - 86400 * 10}",
+        f"S1\tshared/last-login/{testaddr}\t{timestamp}",
+        "D1",
+    ]
+    transactions = {}
+    assert dictproxy.handle_requests(msgs, transactions) == "AO1\n"
+    assert not transactions
+    assert user.get_last_login_timestamp() == timestamp // 86400 * 86400
+
+
+def test_last_login_unknown_key_fails_commit(testaddr, example_config):
+    dictproxy = LastLoginDictProxy(config=example_config)
+    AuthDictProxy(config=example_config).lookup_passdb(testaddr, "1l2k3j1l2k3jl123")
+    transactions = {}
+    timestamp = int(time.time())
+    dictproxy.handle_dovecot_request(f"B1\t{testaddr}", transactions)
+    dictproxy.handle_dovecot_request("S1\tshared/other/key\tvalue", transactions)
+    dictproxy.handle_dovecot_request(
+        f"S1\tshared/last-login/{testaddr}\t{timestamp}", transactions
+    )
+    assert dictproxy.handle_dovecot_request("C1", transactions) == "F\n"
+    # the last login is still written
+    user = dictproxy.config.get_user(testaddr)
+    assert user.get_last_login_timestamp() == timestamp // 86400 * 86400
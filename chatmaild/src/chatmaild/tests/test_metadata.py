@@ -106,13 +106,13 @@ def test_handle_dovecot_request_happy_path(dictproxy, testaddr, token):
     msg = f"B{tx}\t{testaddr}"
     res = dictproxy.handle_dovecot_request(msg, transactions)
     assert not res and not metadata.get_tokens_for_addr(testaddr)
-    assert transactions == {tx: dict(addr=testaddr, res="O\n")}
+    assert transactions == {tx: dict(addr=testaddr, sets=[])}
 
     msg = f"S{tx}\tpriv/guid00/devicetoken\t{token}"
     res = dictproxy.handle_dovecot_request(msg, transactions)
     assert not res
     assert len(transactions) == 1
-    assert metadata.get_tokens_for_addr(testaddr) == [token]
+    assert not metadata.get_tokens_for_addr(testaddr)
 
     msg = f"C{tx}"
     res = dictproxy.handle_dovecot_request(msg, transactions)
@@ -125,9 +125,9 @@ def test_handle_dovecot_request_happy_path(dictproxy, testaddr, token):
     assert dictproxy.handle_dovecot_request(f"B{tx2}\t{testaddr}", transactions) is None
     msg = f"S{tx2}\tpriv/guid00/messagenew"
     assert dictproxy.handle_dovecot_request(msg, transactions) is None
+    assert dictproxy.handle_dovecot_request(f"C{tx2}", transactions) == "O\n"
     queue_item = notifier.retry_queues[0].get()[1]
     assert queue_item.token == token
-    assert dictproxy.handle_dovecot_request(f"C{tx2}", transactions) == "O\n"
     assert not transactions
     assert queue_item.path.exists()
 
@@ -311,3 +311,22 @@ def test_iroh_relay(dictproxy):
     dictproxy.iroh_relay = "https://example.org/"
     dictproxy.loop_forever(rfile, wfile)
     assert wfile.getvalue() == b"Ohttps://example.org/\n"
+
+
+def test_handle_dovecot_request_multi_set(dictproxy, testaddr):
+    transactions = {}
+    msgs = [
+        f"B1\t{testaddr}",
+        "S1\tpriv/guid00/devicetoken\t01234",
+        "S1\tpriv/guid00/unknown\tvalue",
+        "S1\tpriv/guid00/devicetoken\t56789",
+        "C1",
+        f"B2\t{testaddr}",
+        "S2\tpriv/guid00/devicetoken\tabcde",
+        "R2",
+    ]
+    # a failed set fails the commit but does not drop the other sets
+    assert dictproxy.handle_requests(msgs, transactions) == "F\n"
+    assert not transactions
+    tokens = dictproxy.metadata.get_tokens_for_addr(testaddr)
+    assert tokens == ["01234", "56789"]
@@ -0,0 +1,121 @@
+import subprocess
+
+import pytest
+
+from chatmaild.config import hashed_maildir, read_config
+from chatmaild.delete_inactive_users import delete_inactive_users
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.metadata import Metadata
+from chatmaild.metrics import main as metrics_main
+from chatmaild.migrate_layout import get_flat_addrs, main, migrate_layout
+
+
+def test_migrate_layout(make_config, capsys, monkeypatch):
+    commands = []
+
+    def run(args, check):
+        commands.append(args)
+        return subprocess.CompletedProcess(args, 0)
+
+    monkeypatch.setattr(subprocess, "run", run)
+    config = make_config("chat.example.org")
+    dictproxy = AuthDictProxy(config=config)
+    addrs = [f"user{i:05d}@chat.example.org" for i in range(10)]
+    for addr in addrs:
+        dictproxy.lookup_passdb(addr, "q9mr3faue")
+    Metadata(config.mailboxes_dir).add_token_to_addr(addrs[0], "01234")
+    passwords = {
+        addr: config.get_user(addr).password_path.read_text() for addr in addrs
+    }
+
+    with pytest.raises(ValueError):
+        migrate_layout(config)
+
+    inipath = config._inipath
+    ini = inipath.read_text()
+    inipath.write_text(
+        ini.replace("mailboxes_layout = flat", "mailboxes_layout = hashed")
+    )
+    config = read_config(inipath)
+    assert migrate_layout(config, limit=4) == 4
+    assert len(get_flat_addrs(config.mailboxes_dir)) == 6
+    assert commands[:2] == [
+        ["doveadm", "auth", "cache", "flush", addrs[0]],
+        ["doveadm", "kick", addrs[0]],
+    ]
+    assert len(commands) == 8
+
+    # accounts are found during the migration
+    dictproxy = AuthDictProxy(config=config)
+    assert sorted(dictproxy.iter_userdb()) == addrs
+    for addr in addrs:
+        assert dictproxy.lookup_passdb(addr, "q9mr3faue")["password"] == passwords[addr]
+
+    main([str(inipath), "--no-kick"])
+    assert not get_flat_addrs(config.mailboxes_dir)
+    # the auth cache is flushed even without kicking clients
+    assert commands[8:] == [
+        ["doveadm", "auth", "cache", "flush", addr] for addr in addrs[4:]
+    ]
+    for addr in addrs:
+        maildir = hashed_maildir(config.mailboxes_dir, addr)
+        assert dictproxy.lookup_userdb(addr)["home"] == str(maildir)
+    metadata = Metadata(config.mailboxes_dir, config.mailboxes_layout)
+    assert metadata.get_tokens_for_addr(addrs[0]) == ["01234"]
+
+    metrics_main(config.mailboxes_dir)
+    assert "\naccounts 10\n" in capsys.readouterr().out
+
+    for addr in addrs[:3]:
+        config.get_user(addr).set_last_login_timestamp(86400)
+    delete_inactive_users(config)
+    assert sorted(config.iter_addrs()) == addrs[3:]
+    dictproxy.hash_pool.shutdown()
+
+
+def test_migrate_layout_merges_leftover(make_config, monkeypatch, caplog):
+    config = make_config("chat.example.org", dict(mailboxes_layout="hashed"))
+    dictproxy = AuthDictProxy(config=config)
+    addrs = [f"user{i:05d}@chat.example.org" for i in range(2)]
+    for addr in addrs:
+        flat = config.mailboxes_dir.joinpath(addr)
+        flat.joinpath("cur").mkdir(parents=True)
+        flat.joinpath("cur", "1.mail").write_text("old")
+        flat.joinpath("dovecot.index.log").write_text("old")
+        flat.joinpath("password").write_text("secret")
+    dictproxy.hash_pool.shutdown()
+
+    delivered = set()
+
+    def run(args, check):
+        # a delivery which looked up the flat location before the move
+        if args[1:3] == ["auth", "cache"] and args[-1] not in delivered:
+            delivered.add(args[-1])
+            flat = config.mailboxes_dir.joinpath(args[-1])
+            flat.joinpath("new").mkdir(parents=True)
+            flat.joinpath("new", "2.mail").write_text("new")
+            flat.joinpath("dovecot.index.log").write_text("new")
+            if args[-1] == addrs[1]:
+                flat.joinpath("password").write_text("other")
+        return subprocess.CompletedProcess(args, 0)
+
+    monkeypatch.setattr(subprocess, "run", run)
+    assert main([str(config._inipath)]) == 1
+
+    maildir = hashed_maildir(config.mailboxes_dir, addrs[0])
+    assert maildir.joinpath("cur", "1.mail").read_text() == "old"
+    assert maildir.joinpath("new", "2.mail").read_text() == "new"
+    assert maildir.joinpath("dovecot.index.log").read_text() == "old"
+    assert get_flat_addrs(config.mailboxes_dir) == [addrs[1]]
+
+    # conflicting files are left in place and reported
+    flat = config.mailboxes_dir.joinpath(addrs[1])
+    assert [p.name for p in flat.iterdir()] == ["password"]
+    assert f"{flat.joinpath('password')} exists" in caplog.text
+    maildir = hashed_maildir(config.mailboxes_dir, addrs[1])
+    assert maildir.joinpath("new", "2.mail").read_text() == "new"
+
+    # after resolving the conflict a later run merges the leftover
+    flat.joinpath("password").unlink()
+    assert main([str(config._inipath)]) is None
+    assert not get_flat_addrs(config.mailboxes_dir)
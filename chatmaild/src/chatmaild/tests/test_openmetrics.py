@@ -0,0 +1,75 @@
+import asyncio
+
+from chatmaild.openmetrics import CONTENT_TYPE, Registry, start_http_server
+
+
+def test_render():
+    registry = Registry()
+    counter = registry.counter("mails", "Mails seen.", ("kind",))
+    histogram = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1))
+    counter.inc("a")
+    counter.inc("a")
+    counter.inc("b", amount=3)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.render().splitlines() == [
+        "# TYPE mails counter",
+        "# HELP mails Mails seen.",
+        'mails_total{kind="a"} 2',
+        'mails_total{kind="b"} 3',
+        "# TYPE latency_seconds histogram",
+        "# HELP latency_seconds Latency.",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_count 3",
+        "latency_seconds_sum 5.55",
+        "# EOF",
+    ]
+
+
+def test_move_state():
+    def make_registry():
+        registry = Registry()
+        registry.counter("mails", "Mails seen.")
+        registry.histogram("latency_seconds", "Latency.")
+        return registry
+
+    worker, main = make_registry(), make_registry()
+    worker.metrics["mails"].inc()
+    worker.metrics["latency_seconds"].observe(0.2)
+    main.add_state(worker.pop_state())
+    main.add_state(worker.pop_state())
+
+    assert main.metrics["mails"].get() == 1
+    assert main.metrics["latency_seconds"].count == 1
+    assert worker.metrics["mails"].get() == 0
+    assert worker.metrics["latency_seconds"].count == 0
+
+
+def test_http_server():
+    registry = Registry()
+    registry.counter("mails", "Mails seen.").inc()
+
+    async def get(port, path):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        return response.decode()
+
+    async def run():
+        server = await start_http_server(registry, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await get(port, "/metrics"), await get(port, "/other")
+        finally:
+            server.close()
+
+    metrics, other = asyncio.run(run())
+    assert metrics.startswith("HTTP/1.0 200 OK\r\n")
+    assert f"Content-Type: {CONTENT_TYPE}\r\n" in metrics
+    assert metrics.endswith("mails_total 1\n# EOF\n")
+    assert other.startswith("HTTP/1.0 404")
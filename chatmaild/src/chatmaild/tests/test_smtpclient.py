@@ -0,0 +1,124 @@
+import asyncio
+import socket
+
+import pytest
+from aiosmtpd.controller import Controller
+
+from chatmaild.smtpclient import SMTPConnectionPool, SMTPReplyError, quote_periods
+
+
+@pytest.fixture
+def sink():
+    class SinkHandler:
+        envelopes = []
+        sessions = set()
+
+        async def handle_RCPT(self, server, session, envelope, address, options):
+            if address.startswith("refused"):
+                return "550 5.1.1 refused"
+            envelope.rcpt_tos.append(address)
+            return "250 OK"
+
+        async def handle_DATA(self, server, session, envelope):
+            self.sessions.add(id(session))
+            self.envelopes.append(envelope)
+            return "250 OK"
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    handler = SinkHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    handler.port = port
+    yield handler
+    controller.stop()
+
+
+def test_quote_periods():
+    assert quote_periods(b"a\r\n.b\r\n") == b"a\r\n..b\r\n.\r\n"
+    assert quote_periods(b".a") == b"..a\r\n.\r\n"
+
+
+def test_pool_reuses_connections(sink):
+    pool = SMTPConnectionPool("127.0.0.1", sink.port, maxsize=2)
+    content = b"Subject: hello\r\n\r\n.hidden line\r\nend\r\n"
+
+    async def send_all():
+        await asyncio.gather(
+            *[
+                pool.sendmail(f"a{i}@example.org", [f"b{i}@example.org"], content)
+                for i in range(10)
+            ]
+        )
+        pool.close()
+
+    asyncio.run(send_all())
+    assert len(sink.envelopes) == 10
+    assert len(sink.sessions) <= 2
+    for envelope in sink.envelopes:
+        assert envelope.content == content
+
+
+def test_pool_refused_recipients(sink):
+    pool = SMTPConnectionPool("127.0.0.1", sink.port)
+
+    async def send():
+        refused = await pool.sendmail(
+            "a@example.org", ["refused@example.org", "b@example.org"], b"x\r\n"
+        )
+        assert list(refused) == ["refused@example.org"]
+
+        with pytest.raises(SMTPReplyError) as excinfo:
+            await pool.sendmail("a@example.org", ["refused@example.org"], b"x\r\n")
+        assert excinfo.value.code == 550
+
+        # the connection is reset and reused after an error reply
+        await pool.sendmail("a@example.org", ["c@example.org"], b"x\r\n")
+        pool.close()
+
+    asyncio.run(send())
+    assert [e.rcpt_tos for e in sink.envelopes] == [
+        ["b@example.org"],
+        ["c@example.org"],
+    ]
+    assert len(sink.sessions) == 1
+
+
+def test_pool_reconnects(sink):
+    pool = SMTPConnectionPool("127.0.0.1", sink.port)
+
+    async def send():
+        await pool.sendmail("a@example.org", ["b@example.org"], b"x\r\n")
+        # simulate the server closing an idle connection
+        pool.idle[0][0].writer.close()
+        await pool.sendmail("a@example.org", ["b@example.org"], b"x\r\n")
+        pool.close()
+
+    asyncio.run(send())
+    assert len(sink.envelopes) == 2
+    assert len(sink.sessions) == 2
+
+
+def test_pool_closes_idle_connections(sink, monkeypatch):
+    monkeypatch.setattr(SMTPConnectionPool, "idle_timeout", 0.5)
+    pool = SMTPConnectionPool("127.0.0.1", sink.port)
+
+    async def send():
+        await pool.sendmail("a@example.org", ["b@example.org"], b"x\r\n")
+        ((conn, _),) = pool.idle
+        await asyncio.sleep(0.2)
+        # a used connection stays open
+        await pool.sendmail("a@example.org", ["b@example.org"], b"x\r\n")
+        await asyncio.sleep(0.35)
+        assert pool.idle
+        await asyncio.sleep(0.4)
+        assert not pool.idle
+        assert conn.writer.is_closing()
+        await pool.sendmail("a@example.org", ["b@example.org"], b"x\r\n")
+        pool.close()
+
+    asyncio.run(send())
+    assert len(sink.envelopes) == 3
+    assert len(sink.sessions) == 2
@@ -0,0 +1,46 @@
+import os
+import re
+
+from chatmaild.spool import MessageSpool, open_spool_file
+
+
+def test_spool_in_memory():
+    spool = MessageSpool(threshold=10)
+    spool.write(b"hello\r\n")
+    assert spool.path is None
+    assert spool.getvalue() == b"hello\r\n"
+    spool.close()
+
+
+def test_spool_to_file():
+    spool = MessageSpool(threshold=10)
+    spool.write(b"hello\r\n")
+    spool.write(b"world\r\n")
+    spool.write(b".\r\n")
+    path = spool.path
+    assert os.path.exists(path)
+    assert not spool.buffer
+
+    content = spool.getvalue()
+    assert len(content) == 17
+    assert content.find(b"world") == 7
+    assert content[7:12] == b"world"
+    assert re.sub(rb"(?m)^\.", b"..", content).endswith(b"\r\n..\r\n")
+
+    mapped = open_spool_file(path)
+    assert mapped[:] == content[:]
+    mapped.close()
+
+    spool.close()
+    assert not os.path.exists(path)
+
+
+def test_spool_discard():
+    spool = MessageSpool(threshold=10)
+    spool.write(b"x" * 20)
+    path = spool.path
+    spool.discard()
+    spool.write(b"more")
+    assert not os.path.exists(path)
+    assert spool.path is None
+    assert spool.getvalue() == b""
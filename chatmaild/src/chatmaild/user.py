@@ -53,18 +53,22 @@ class User:
 
     def set_last_login_timestamp(self, timestamp):
         """Track login time with daily granularity
-        to minimize touching files and to minimize metadata leakage."""
+        to minimize touching files and to minimize metadata leakage.
+
+        Return True if the tracked login day changed."""
         if not self.can_track:
-            return
+            return False
         try:
             mtime = int(os.stat(self.password_path).st_mtime)
         except FileNotFoundError:
             logging.error(f"Can not get last login timestamp for {self.addr}")
-            return
+            return False
 
         timestamp = get_daytimestamp(timestamp)
-        if mtime != timestamp:
-            os.utime(self.password_path, (timestamp, timestamp))
+        if mtime == timestamp:
+            return False
+        os.utime(self.password_path, (timestamp, timestamp))
+        return True
 
     def get_last_login_timestamp(self):
         if self.can_track: